@@ -9,19 +9,20 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-import webhook_api.routing as routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'realmate_challenge.settings')
 
-# Aplicação HTTP padrão
+# Aplicação HTTP padrão (configura o Django antes de importar os consumers)
 django_asgi_app = get_asgi_application()
 
-# Protocolo WebSocket via Channels
+from channels.routing import ProtocolTypeRouter, URLRouter
+from webhook_api.middleware import JWTWebSocketMiddleware
+import webhook_api.routing as routing
+
+# Protocolo WebSocket via Channels, autenticado por JWT
 application = ProtocolTypeRouter({
     'http': django_asgi_app,
-    'websocket': AuthMiddlewareStack(
+    'websocket': JWTWebSocketMiddleware(
         URLRouter(
             routing.websocket_urlpatterns
         )
@@ -55,19 +55,82 @@ export default function ConversationDetail({ conversationId }) {
 
   useEffect(() => {
     if (!conversationId) return;
-    // Conectar no WebSocket do backend (porta 8000)
-    const wsUrl = `ws://${window.location.hostname}:8000/ws/conversations/${conversationId}/`;
-    const ws = new WebSocket(wsUrl);
-    ws.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-      setPendingMessages(prev => prev.filter(m => m.id !== data.id));
-      setMessageStatuses(prev => ({ ...prev, [data.id]: 'processed' }));
-      setConversation(prev => ({
-        ...prev,
-        messages: [...prev.messages, data]
-      }));
+    // Conectar no WebSocket do backend (porta 8000), autenticando com o JWT
+    const token = localStorage.getItem('token');
+    const baseUrl = `ws://${window.location.hostname}:8000/ws/conversations/${conversationId}/?token=${encodeURIComponent(token)}`;
+    // Maior sequência recebida: ao reconectar, o servidor reenvia só o que veio depois (?since=)
+    let lastSeq = null;
+    let ws = null;
+    let retryTimer = null;
+    let retryDelay = 1000;
+    let stopped = false;
+
+    const appendMessages = (received) => {
+      const ids = new Set(received.map(m => m.id));
+      setPendingMessages(prev => prev.filter(m => !ids.has(m.id)));
+      setMessageStatuses(prev => ({ ...prev, ...Object.fromEntries(received.map(m => [m.id, 'processed'])) }));
+      // Replay e eventos ao vivo podem se sobrepor: ignora ids já exibidos
+      setConversation(prev => {
+        const known = new Set(prev.messages.map(m => m.id));
+        return { ...prev, messages: [...prev.messages, ...received.filter(m => !known.has(m.id))] };
+      });
+    };
+
+    const reconnect = (since, delay) => {
+      if (stopped) return;
+      if (since !== null && since !== undefined) lastSeq = since;
+      clearTimeout(retryTimer);
+      retryTimer = setTimeout(() => connect(lastSeq ?? 0), delay);
+    };
+
+    const connect = (since) => {
+      ws = new WebSocket(since === null ? baseUrl : `${baseUrl}&since=${since}`);
+      const socket = ws;
+      socket.onmessage = (event) => {
+        retryDelay = 1000;
+        const data = JSON.parse(event.data);
+        if (data.type === 'resync') {
+          // Histórico perdido saiu do log do servidor: substitui pela página mais recente
+          lastSeq = data.seq;
+          setConversation(prev => ({ ...prev, messages: data.messages }));
+          return;
+        }
+        // Cliente atrasado recebe várias mensagens em um frame 'batch'
+        const frames = data.type === 'batch' ? data.messages : [data];
+        const gap = frames.find(m => m.type === 'gap');
+        const received = frames.filter(m => m.id);
+        received.forEach(m => {
+          if (m.seq !== undefined && (lastSeq === null || m.seq > lastSeq)) lastSeq = m.seq;
+        });
+        if (received.length) appendMessages(received);
+        if (gap) {
+          // O servidor descartou mensagens da fila: retoma a partir da lacuna
+          socket.onclose = null;
+          socket.close();
+          reconnect(gap.since, 0);
+        }
+      };
+      socket.onclose = (event) => {
+        // 4008: fila de saída estourou; reason traz 'since=<seq>' para a retomada
+        if (event.code === 4008) {
+          const since = parseInt((event.reason || '').replace('since=', ''), 10);
+          reconnect(Number.isNaN(since) ? null : since, 0);
+          return;
+        }
+        reconnect(null, retryDelay);
+        retryDelay = Math.min(retryDelay * 2, 30000);
+      };
+    };
+
+    connect(null);
+    return () => {
+      stopped = true;
+      clearTimeout(retryTimer);
+      if (ws) {
+        ws.onclose = null;
+        ws.close();
+      }
     };
-    return () => ws.close();
   }, [conversationId]);
 
   // Rola até o bottom na primeira renderização dos messages
@@ -10,15 +10,19 @@ import { v4 as uuidv4 } from 'uuid';
 export default function ConversationList() {
   const [conversations, setConversations] = useState([]);
   const [loading, setLoading] = useState(true);
+  // URL da próxima página (conversas mais antigas), ou null na última
+  const [nextPage, setNextPage] = useState(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const router = useRouter();
   const toast = useToast();
 
   useEffect(() => {
     async function fetchConversations() {
       try {
+        // A API já retorna as conversas ordenadas por updated_at (mais recentes primeiro)
         const response = await api.get('/my-conversations/');
-        const sortedConversations = response.data.sort((a, b) => new Date(b.updated_at) - new Date(a.updated_at));
-        setConversations(sortedConversations);
+        setConversations(response.data.results);
+        setNextPage(response.data.next);
       } catch {
         toast({
           title: 'Erro',
@@ -34,6 +38,25 @@ export default function ConversationList() {
     fetchConversations();
   }, [toast]);
 
+  const handleLoadMore = async () => {
+    setLoadingMore(true);
+    try {
+      const response = await api.get(nextPage);
+      setConversations(prev => [...prev, ...response.data.results]);
+      setNextPage(response.data.next);
+    } catch {
+      toast({
+        title: 'Erro',
+        description: 'Não foi possível carregar mais conversas',
+        status: 'error',
+        duration: 5000,
+        isClosable: true,
+      });
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleCreateConversation = async () => {
     try {
       const createConversationPayload = {
@@ -113,6 +136,14 @@ export default function ConversationList() {
           ))}
         </List>
       )}
+
+      {nextPage && (
+        <Flex mt={4} justify="center">
+          <Button size="sm" variant="outline" onClick={handleLoadMore} isLoading={loadingMore}>
+            Carregar mais
+          </Button>
+        </Flex>
+      )}
     </Box>
   );
 } 
\ No newline at end of file
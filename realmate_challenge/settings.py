@@ -96,6 +96,110 @@ DATABASES = {
 CELERY_BROKER_URL = os.environ.get('REDIS_URL', 'redis://redis:6379/0')
 CELERY_RESULT_BACKEND = CELERY_BROKER_URL
 
+# Pools de conexão por processo (ver webhook_api/connections.py): máximo de
+# conexões e espera (s) por uma conexão livre; timeout de publicação no channel layer
+REDIS_POOL_MAX_CONNECTIONS = int(os.environ.get('REDIS_POOL_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+CHANNEL_LAYER_MAX_CONNECTIONS = int(os.environ.get('CHANNEL_LAYER_MAX_CONNECTIONS', 50))
+CHANNEL_LAYER_PUBLISH_TIMEOUT = float(os.environ.get('CHANNEL_LAYER_PUBLISH_TIMEOUT', 5))
+
+# Publicação em lote de new_message pelos workers: descarrega ao juntar N
+# eventos ou após T ms; acima de MAX_PENDING o publish espera a descarga
+WS_PUBLISH_MAX_BATCH = int(os.environ.get('WS_PUBLISH_MAX_BATCH', 500))
+WS_PUBLISH_MAX_DELAY_MS = float(os.environ.get('WS_PUBLISH_MAX_DELAY_MS', 5))
+WS_PUBLISH_MAX_PENDING = int(os.environ.get('WS_PUBLISH_MAX_PENDING', 10000))
+# Tentativas por grupo em cada descarga e espera inicial (ms) entre elas
+WS_PUBLISH_MAX_ATTEMPTS = int(os.environ.get('WS_PUBLISH_MAX_ATTEMPTS', 3))
+WS_PUBLISH_RETRY_DELAY_MS = float(os.environ.get('WS_PUBLISH_RETRY_DELAY_MS', 50))
+
+# Retomada de WebSocket (?since=<seq>): eventos recentes guardados por
+# conversa e TTL (s) do log; além disso a retomada recorre ao banco
+WS_REPLAY_BUFFER_SIZE = int(os.environ.get('WS_REPLAY_BUFFER_SIZE', 500))
+WS_REPLAY_TTL = int(os.environ.get('WS_REPLAY_TTL', 86400))
+
+# Fila de saída por conexão WebSocket: tamanho, política de estouro
+# ('coalesce', 'drop_oldest' ou 'disconnect') e mensagens por frame em lote
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', 256))
+WS_SEND_OVERFLOW_POLICY = os.environ.get('WS_SEND_OVERFLOW_POLICY', 'coalesce')
+WS_SEND_MAX_BATCH = int(os.environ.get('WS_SEND_MAX_BATCH', 50))
+
+# Máximo de conversas inscritas por conexão em ws/conversations/ (multiplexado)
+WS_MAX_SUBSCRIPTIONS = int(os.environ.get('WS_MAX_SUBSCRIPTIONS', 500))
+
+# Digitação: no máximo um broadcast por conversa a cada WS_TYPING_INTERVAL_MS;
+# um "digitando" vale por WS_TYPING_TTL segundos sem novo frame
+WS_TYPING_INTERVAL_MS = int(os.environ.get('WS_TYPING_INTERVAL_MS', 500))
+WS_TYPING_TTL = int(os.environ.get('WS_TYPING_TTL', 5))
+
+# Presença: heartbeat de cada conexão a cada WS_PRESENCE_HEARTBEAT segundos;
+# conexões sem heartbeat por WS_PRESENCE_TTL segundos saem da lista
+WS_PRESENCE_HEARTBEAT = int(os.environ.get('WS_PRESENCE_HEARTBEAT', 15))
+WS_PRESENCE_TTL = int(os.environ.get('WS_PRESENCE_TTL', 45))
+
+# Janela de idempotência do /webhook/ (segundos) e entradas do LRU local
+WEBHOOK_IDEMPOTENCY_TTL = int(os.environ.get('WEBHOOK_IDEMPOTENCY_TTL', 3600))
+WEBHOOK_IDEMPOTENCY_LOCAL_ENTRIES = int(os.environ.get('WEBHOOK_IDEMPOTENCY_LOCAL_ENTRIES', 10000))
+# Validade (s) da marca de "em processamento" e espera máxima (ms) de um
+# reenvio pela resposta da requisição original antes de receber 409
+WEBHOOK_IDEMPOTENCY_CLAIM_TTL = int(os.environ.get('WEBHOOK_IDEMPOTENCY_CLAIM_TTL', 30))
+WEBHOOK_IDEMPOTENCY_WAIT_MS = int(os.environ.get('WEBHOOK_IDEMPOTENCY_WAIT_MS', 2000))
+
+# Cache do estado das conversas (existência/status/participantes) usado pelo
+# /webhook/: TTL no Redis, TTL e tamanho do LRU local e TTL de "inexistente"
+CONVERSATION_STATE_TTL = int(os.environ.get('CONVERSATION_STATE_TTL', 3600))
+CONVERSATION_STATE_LOCAL_TTL = int(os.environ.get('CONVERSATION_STATE_LOCAL_TTL', 5))
+CONVERSATION_STATE_LOCAL_ENTRIES = int(os.environ.get('CONVERSATION_STATE_LOCAL_ENTRIES', 10000))
+CONVERSATION_STATE_NEGATIVE_TTL = int(os.environ.get('CONVERSATION_STATE_NEGATIVE_TTL', 5))
+
+# Número máximo de eventos aceitos por requisição em /webhook/batch/
+WEBHOOK_BATCH_MAX_EVENTS = int(os.environ.get('WEBHOOK_BATCH_MAX_EVENTS', 1000))
+# Tamanho do bloco persistido por vez na ingestão NDJSON (/webhook/stream/ e ingest_ndjson)
+WEBHOOK_STREAM_CHUNK_SIZE = int(os.environ.get('WEBHOOK_STREAM_CHUNK_SIZE', 500))
+# Micro-lotes de NEW_MESSAGE: drena ao atingir N mensagens ou após T ms
+INBOUND_BATCH_SIZE = int(os.environ.get('INBOUND_BATCH_SIZE', 200))
+INBOUND_BATCH_WINDOW_MS = int(os.environ.get('INBOUND_BATCH_WINDOW_MS', 50))
+# Lote retirado da fila e não confirmado após este tempo (s) volta para a fila;
+# após uma falha transitória, nova drenagem em INBOUND_RETRY_DELAY segundos, e
+# itens com INBOUND_MAX_ATTEMPTS falhas vão para a dead letter
+INBOUND_CLAIM_TIMEOUT = int(os.environ.get('INBOUND_CLAIM_TIMEOUT', 300))
+INBOUND_RETRY_DELAY = int(os.environ.get('INBOUND_RETRY_DELAY', 5))
+INBOUND_MAX_ATTEMPTS = int(os.environ.get('INBOUND_MAX_ATTEMPTS', 5))
+# Mensagens gravadas sem despacho confirmado há DISPATCH_OUTBOX_GRACE segundos
+# são despachadas de novo, até DISPATCH_OUTBOX_BATCH_SIZE por volta do loop
+DISPATCH_OUTBOX_GRACE = int(os.environ.get('DISPATCH_OUTBOX_GRACE', 120))
+DISPATCH_OUTBOX_INTERVAL = float(os.environ.get('DISPATCH_OUTBOX_INTERVAL', 30))
+DISPATCH_OUTBOX_BATCH_SIZE = int(os.environ.get('DISPATCH_OUTBOX_BATCH_SIZE', 500))
+
+# Agrupamento de mensagens: política ('fixed', 'max_wait' ou 'adaptive'),
+# janela de silêncio e intervalo do loop de prazos
+GROUPING_POLICY = os.environ.get('GROUPING_POLICY', 'fixed')
+GROUPING_WINDOW_SECONDS = float(os.environ.get('GROUPING_WINDOW_SECONDS', 5))
+# Tempo máximo desde a primeira mensagem do buffer (políticas max_wait e adaptive)
+GROUPING_MAX_WAIT_SECONDS = float(os.environ.get('GROUPING_MAX_WAIT_SECONDS', 15))
+# Número de mensagens que força o agrupamento imediato (0 desativa)
+GROUPING_MAX_BATCH_SIZE = int(os.environ.get('GROUPING_MAX_BATCH_SIZE', 50))
+# Limites e multiplicador do intervalo estimado na política adaptativa
+GROUPING_ADAPTIVE_MIN_WINDOW = float(os.environ.get('GROUPING_ADAPTIVE_MIN_WINDOW', 1))
+GROUPING_ADAPTIVE_MAX_WINDOW = float(os.environ.get('GROUPING_ADAPTIVE_MAX_WINDOW', 10))
+GROUPING_ADAPTIVE_FACTOR = float(os.environ.get('GROUPING_ADAPTIVE_FACTOR', 2))
+GROUPING_POLL_INTERVAL = float(os.environ.get('GROUPING_POLL_INTERVAL', 1))
+# Falhas transitórias seguidas antes de mandar as mensagens para a dead letter;
+# a n-ésima nova tentativa espera GROUPING_RETRY_BASE_DELAY * 2^(n-1) segundos,
+# até GROUPING_RETRY_MAX_DELAY
+GROUPING_MAX_ATTEMPTS = int(os.environ.get('GROUPING_MAX_ATTEMPTS', 5))
+GROUPING_RETRY_BASE_DELAY = float(os.environ.get('GROUPING_RETRY_BASE_DELAY', 2))
+GROUPING_RETRY_MAX_DELAY = float(os.environ.get('GROUPING_RETRY_MAX_DELAY', 60))
+CELERY_BEAT_SCHEDULE = {
+    'fire-due-groupings': {
+        'task': 'webhook_api.tasks.fire_due_groupings',
+        'schedule': GROUPING_POLL_INTERVAL,
+    },
+    'redispatch-pending-messages': {
+        'task': 'webhook_api.tasks.redispatch_pending_messages',
+        'schedule': DISPATCH_OUTBOX_INTERVAL,
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -150,6 +254,18 @@ REST_FRAMEWORK = {
     ),
 }
 
+# Paginação por cursor do histórico de mensagens
+MESSAGES_PAGE_SIZE = int(os.environ.get('MESSAGES_PAGE_SIZE', 50))
+MESSAGES_MAX_PAGE_SIZE = int(os.environ.get('MESSAGES_MAX_PAGE_SIZE', 200))
+
+# Paginação por cursor da lista de conversas do usuário
+CONVERSATIONS_PAGE_SIZE = int(os.environ.get('CONVERSATIONS_PAGE_SIZE', 20))
+CONVERSATIONS_MAX_PAGE_SIZE = int(os.environ.get('CONVERSATIONS_MAX_PAGE_SIZE', 100))
+
+# Cache de tokens JWT verificados (por processo)
+JWT_CACHE_MAX_ENTRIES = int(os.environ.get('JWT_CACHE_MAX_ENTRIES', 10000))
+JWT_CACHE_TTL = int(os.environ.get('JWT_CACHE_TTL', 300))
+
 # Configuração do CORS
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # URL do frontend Next.js
@@ -158,7 +274,13 @@ CORS_ALLOWED_ORIGINS = [
 ASGI_APPLICATION = 'realmate_challenge.asgi.application'
 CHANNEL_LAYERS = {
          'default': {
-           'BACKEND': 'channels_redis.core.RedisChannelLayer',
-           'CONFIG': { 'hosts': [os.environ.get('REDIS_URL','redis://redis:6379/0')] },
+           # Pool bloqueante: acima de max_connections o group_send espera uma
+           # conexão livre (até timeout) em vez de falhar com "Too many connections"
+           'BACKEND': 'webhook_api.connections.BlockingRedisChannelLayer',
+           'CONFIG': { 'hosts': [{
+               'address': os.environ.get('REDIS_URL','redis://redis:6379/0'),
+               'max_connections': CHANNEL_LAYER_MAX_CONNECTIONS,
+               'timeout': REDIS_POOL_TIMEOUT,
+           }] },
          }
        }
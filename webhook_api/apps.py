@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 class WebhookApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'webhook_api' 
\ No newline at end of file
+    name = 'webhook_api'
+
+    def ready(self):
+        # Registra os receivers de sinais (invalidação de caches)
+        from . import signals
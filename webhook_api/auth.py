@@ -1,9 +1,193 @@
+import hashlib
+import logging
+import threading
+import time
 import jwt
+import redis
+from asgiref.sync import sync_to_async
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework import authentication, exceptions
+from .connections import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+class TokenCache:
+    """
+    Cache LRU/TTL de tokens já verificados.
+
+    A chave é o SHA-256 do token; o valor guarda o payload decodificado e um
+    snapshot leve do usuário, evitando a verificação HMAC e a consulta ao
+    banco a cada requisição. Nenhuma entrada vive além do 'exp' do token.
+
+    Com um cliente Redis, cada usuário tem uma versão compartilhada entre os
+    processos ({prefix}{user_id}), incrementada a cada alteração ou exclusão.
+    A entrada guarda a versão lida antes da consulta ao banco e um acerto só
+    vale se ela ainda for a atual; se o Redis estiver fora, o token é
+    verificado por completo e não entra no cache.
+    """
+
+    USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name',
+                   'is_active', 'is_staff', 'is_superuser')
+
+    def __init__(self, max_entries=10000, ttl=300, redis_client=None, async_redis_client=None,
+                 prefix='auth:user:version:'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis = redis_client
+        # Cliente redis.asyncio usado pelo caminho assíncrono (aget)
+        self.async_redis = async_redis_client
+        self.prefix = prefix
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def version_key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    def current_version(self, user_id):
+        """Versão atual do usuário no Redis, ou None se o Redis não responder"""
+        try:
+            return self._decode_version(self.redis.get(self.version_key(user_id)))
+        except redis.RedisError:
+            return None
+
+    async def acurrent_version(self, user_id):
+        """Versão assíncrona de current_version"""
+        try:
+            return self._decode_version(await self.async_redis.get(self.version_key(user_id)))
+        except redis.RedisError:
+            return None
+
+    def get(self, token: str):
+        """Retorna (user, payload) ou None se ausente/expirado/revogado"""
+        hit = self._lookup(token)
+        if hit is None or self.redis is None:
+            return self._result(hit)
+        return self._check_version(hit, self.current_version(hit[1][1]['id']))
+
+    async def aget(self, token: str):
+        """Versão assíncrona de get: a versão é lida sem bloquear o event loop"""
+        hit = self._lookup(token)
+        if hit is None or self.async_redis is None:
+            return self._result(hit)
+        return self._check_version(hit, await self.acurrent_version(hit[1][1]['id']))
+
+    def set(self, token: str, payload: dict, user: User, version=None):
+        """
+        Guarda o token verificado. version é a versão do usuário lida antes
+        de carregá-lo do banco (current_version); sem ela nada é guardado.
+        """
+        if self.redis is not None and version is None:
+            return
+        expires_at = time.time() + self.ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, float(payload['exp']))
+        snapshot = {field: getattr(user, field) for field in self.USER_FIELDS}
+        key = self.digest(token)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (payload, snapshot, expires_at, version)
+            self._by_user.setdefault(str(user.id), set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id):
+        """
+        Remove as entradas do usuário (alteração ou exclusão) neste processo
+        e, incrementando a versão no Redis, nos demais.
+        """
+        with self._lock:
+            for key in list(self._by_user.get(str(user_id), ())):
+                self._discard(key)
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.incr(self.version_key(user_id))
+            # Sobrevive a qualquer entrada gravada com a versão anterior
+            pipe.expire(self.version_key(user_id), self.ttl * 2)
+            pipe.execute()
+        except redis.RedisError:
+            logger.error('Falha ao revogar os tokens em cache do usuário %s', user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def _lookup(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+        return key, entry
+
+    def _check_version(self, hit, version):
+        key, entry = hit
+        if version is None or version != entry[3]:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._discard(key)
+            return None
+        return self._result(hit)
+
+    def _result(self, hit):
+        if hit is None:
+            return None
+        payload, snapshot = hit[1][:2]
+        return self._build_user(snapshot), payload
+
+    @staticmethod
+    def _decode_version(value):
+        if value is None:
+            return '0'
+        return value.decode() if isinstance(value, bytes) else str(value)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        user_id = str(entry[1]['id'])
+        keys = self._by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user_id]
+
+    @staticmethod
+    def _build_user(snapshot):
+        # Instância "carregada" sem ir ao banco: serve para request.user e FKs
+        user = User(**snapshot)
+        user._state.adding = False
+        user._state.db = 'default'
+        return user
+
+
+token_cache = TokenCache(
+    max_entries=settings.JWT_CACHE_MAX_ENTRIES,
+    ttl=settings.JWT_CACHE_TTL,
+    redis_client=get_redis(),
+    async_redis_client=get_async_redis()
+)
+
+
+def can_access_conversation(user, customer_id, agent_id) -> bool:
+    """Cliente, agente atribuído ou staff podem acessar a conversa"""
+    return customer_id == user.id or agent_id == user.id or user.is_staff
+
 
 class AuthService:
     """
@@ -37,16 +221,43 @@ class AuthService:
             raise AuthenticationFailed('Token inválido.')
 
     @staticmethod
-    def decode_token(token: str) -> User:
+    def authenticate_token(token: str):
         """
-        Decodifica o JWT e retorna o objeto User.
+        Valida o JWT e retorna (user, payload), usando o cache de tokens
+        verificados antes de decodificar e consultar o banco.
         """
+        cached = token_cache.get(token)
+        if cached is not None:
+            return cached
         payload = AuthService.decode_payload(token)
+        # Lida antes da consulta: uma alteração no meio impede o cache do usuário antigo
+        version = token_cache.current_version(payload['user_id'])
         try:
             user = User.objects.get(id=payload['user_id'])
-            return user
         except User.DoesNotExist:
             raise AuthenticationFailed('Usuário não encontrado.')
+        token_cache.set(token, payload, user, version)
+        return user, payload
+
+    @staticmethod
+    async def aauthenticate_token(token: str):
+        """
+        Versão assíncrona de authenticate_token: tokens em cache são
+        resolvidos no próprio event loop; só a verificação completa (com
+        consulta ao banco) roda em thread.
+        """
+        cached = await token_cache.aget(token)
+        if cached is not None:
+            return cached
+        return await sync_to_async(AuthService.authenticate_token)(token)
+
+    @staticmethod
+    def decode_token(token: str) -> User:
+        """
+        Decodifica o JWT e retorna o objeto User.
+        """
+        user, _ = AuthService.authenticate_token(token)
+        return user
 
 class JWTAuthentication(authentication.BaseAuthentication):
     """
@@ -65,12 +276,15 @@ class JWTAuthentication(authentication.BaseAuthentication):
 
         token = auth[1].decode()
 
-        # decodifica payload e usuário
-        payload = AuthService.decode_payload(token)
-        try:
-            user = User.objects.get(id=payload['user_id'])
-        except User.DoesNotExist:
-            raise exceptions.AuthenticationFailed('Usuário não encontrado.')
+        # reaproveita o principal já autenticado pelo middleware, se houver
+        django_request = getattr(request, '_request', request)
+        principal = getattr(django_request, 'jwt_auth', None)
+        if principal is not None and principal[0] == token:
+            _, user, payload = principal
+        else:
+            # decodifica payload e usuário (com cache de tokens verificados)
+            user, payload = AuthService.authenticate_token(token)
+            django_request.jwt_auth = (token, user, payload)
 
         # guarda o id extraído do token na própria requisição
         request.token_user_id = payload['user_id']
@@ -0,0 +1,353 @@
+import json
+import time
+import uuid
+from django.db import transaction, DatabaseError, InterfaceError, OperationalError
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from .models import Conversation, Message
+from .event_handlers import EventFactory
+from .touch import touch_conversations
+from .conversation_state import invalidate_conversation_state
+from .outbox import dispatch_outbox
+from .wire import format_timestamp
+
+DUPLICATE_MESSAGE_ERROR = 'Mensagem já existe'
+
+
+def is_duplicate_message(result):
+    """Indica se o resultado de um evento é a recusa de uma mensagem já gravada"""
+    response = result['response']
+    return isinstance(response, dict) and response.get('error') == DUPLICATE_MESSAGE_ERROR
+
+
+class WebhookBatchProcessor:
+    """
+    Processa um lote de eventos de webhook em uma única passada.
+
+    Todos os eventos são validados pela EventFactory, o estado necessário
+    (conversas e mensagens já existentes) é carregado com uma consulta por
+    tabela e a persistência é feita com bulk inserts/updates em uma única
+    transação. Cada evento recebe seu próprio status no resultado.
+    """
+
+    def __init__(self, request_user, dispatch_inline=False):
+        self.request_user = request_user
+        # Dentro de um worker Celery a notificação pode rodar no próprio processo
+        self.dispatch_inline = dispatch_inline
+
+    def process(self, payloads, request_users=None):
+        """
+        Processa a lista de payloads e retorna a lista de resultados por
+        evento. request_users, se informado, traz o usuário de cada payload
+        (lotes com vários remetentes); senão todos são do request_user.
+        """
+        results = [None] * len(payloads)
+        events = []
+
+        # 1) Validação de envelope e dos dados de cada evento
+        for index, payload in enumerate(payloads):
+            user = request_users[index] if request_users is not None else self.request_user
+            try:
+                event_type, timestamp, data = EventFactory.validate_payload(payload)
+                if event_type == 'NEW_CONVERSATION':
+                    data['customer_id'] = user.id
+                event = EventFactory.create_event(event_type, data, timestamp, user)
+                events.append((index, event_type, event, self._conversation_key(event_type, data)))
+            except ValidationError as exc:
+                results[index] = self._result(index, exc.detail, status.HTTP_400_BAD_REQUEST)
+
+        # 2) Pré-carregar conversas e mensagens referenciadas pelo lote
+        conversation_ids = {key for _, _, _, key in events if key}
+        message_ids = [event.data['id'] for _, event_type, event, _ in events if event_type == 'NEW_MESSAGE']
+        conversations = self._load_conversations(conversation_ids)
+        existing_messages = {
+            str(mid) for mid in Message.objects.filter(id__in=message_ids).values_list('id', flat=True)
+        }
+
+        # 3) Aplicar os eventos em ordem sobre o estado em memória
+        state = _BatchState(conversations, existing_messages)
+        for index, event_type, event, key in events:
+            try:
+                if event_type == 'NEW_CONVERSATION':
+                    body, code = self._apply_new_conversation(state, event, key)
+                elif event_type == 'NEW_MESSAGE':
+                    body, code = self._apply_new_message(state, event, key)
+                else:
+                    body, code = self._apply_close_conversation(state, event, key)
+                results[index] = self._result(index, body, code)
+                if event_type == 'NEW_MESSAGE':
+                    state.message_results[body['message_id']] = index
+            except ValidationError as exc:
+                results[index] = self._result(index, exc.detail, status.HTTP_400_BAD_REQUEST)
+
+        # 4) Persistir tudo em uma única transação
+        self._flush(state)
+
+        # Mensagens gravadas por outra requisição entre a pré-carga e o INSERT
+        for message_id in state.conflicts:
+            index = state.message_results[message_id]
+            results[index] = self._result(index, {
+                'error': DUPLICATE_MESSAGE_ERROR,
+                'message_id': message_id
+            }, status.HTTP_400_BAD_REQUEST)
+        return results
+
+    def _load_conversations(self, conversation_ids):
+        # Sempre do banco: o status decide se a mensagem pode ser gravada e o
+        # cache de estado pode estar defasado
+        return {
+            str(conv.id): conv
+            for conv in Conversation.objects.filter(id__in=conversation_ids).only('id', 'status')
+        }
+
+    @staticmethod
+    def _conversation_key(event_type, data):
+        raw = data['conversation_id'] if event_type == 'NEW_MESSAGE' else data['id']
+        try:
+            return str(uuid.UUID(str(raw)))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _result(index, body, status_code):
+        return {
+            'index': index,
+            'status_code': status_code,
+            'response': body
+        }
+
+    def _apply_new_conversation(self, state, event, key):
+        conversation_id = event.data['id']
+        if key is None:
+            raise ValidationError({
+                'error': 'ID da conversa inválido',
+                'received': conversation_id,
+                'expected': 'UUID válido'
+            })
+        if key in state.conversations:
+            raise ValidationError({
+                'error': 'Conversa já existe',
+                'conversation_id': conversation_id
+            })
+        conversation = Conversation(id=key, customer=event.request_user)
+        state.conversations[key] = conversation
+        state.new_conversations.append(conversation)
+        return {
+            'status': 'Conversa criada com sucesso',
+            'conversation_id': key,
+            'customer_id': event.request_user.id
+        }, status.HTTP_201_CREATED
+
+    def _apply_new_message(self, state, event, key):
+        message_id = str(uuid.UUID(event.data['id']))
+        conversation_id = event.data['conversation_id']
+        if message_id in state.message_ids:
+            raise ValidationError({
+                'error': DUPLICATE_MESSAGE_ERROR,
+                'message_id': event.data['id']
+            })
+        conversation = state.conversations.get(key)
+        if conversation is None:
+            raise ValidationError({
+                'error': 'Conversa não encontrada',
+                'conversation_id': conversation_id
+            })
+        if conversation.status == Conversation.CLOSED:
+            raise ValidationError({
+                'error': 'Não é possível adicionar mensagens a uma conversa fechada',
+                'conversation_id': conversation_id,
+                'conversation_status': conversation.status
+            })
+        state.message_ids.add(message_id)
+        state.messages.append(Message(
+            id=message_id,
+            conversation=conversation,
+            direction=Message.INBOUND,
+            content=event.data['content'],
+            timestamp=event.event_time,
+            author=event.request_user
+        ))
+        state.touched.add(key)
+        return {
+            'status': 'Mensagem adicionada com sucesso',
+            'message_id': message_id,
+            'conversation_id': key
+        }, status.HTTP_201_CREATED
+
+    def _apply_close_conversation(self, state, event, key):
+        conversation_id = event.data['id']
+        conversation = state.conversations.get(key)
+        if conversation is None:
+            raise ValidationError({
+                'error': 'Conversa não encontrada',
+                'conversation_id': conversation_id
+            })
+        if conversation.status == Conversation.CLOSED:
+            raise ValidationError({
+                'error': 'Conversa já está fechada',
+                'conversation_id': conversation_id
+            })
+        conversation.status = Conversation.CLOSED
+        state.closed.add(key)
+        return {
+            'status': 'Conversa fechada com sucesso',
+            'conversation_id': key
+        }, status.HTTP_200_OK
+
+    def _flush(self, state):
+        new_ids = {str(conv.id) for conv in state.new_conversations}
+        closed = state.closed - new_ids
+        touched = state.touched - new_ids - closed
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                if state.new_conversations:
+                    Conversation.objects.bulk_create(state.new_conversations)
+                items = []
+                if state.messages:
+                    # ON CONFLICT DO NOTHING RETURNING id: reenvios concorrentes não
+                    # derrubam o lote, e só as linhas de fato inseridas são despachadas
+                    inserted = Message.objects.insert_ignoring_conflicts(state.messages)
+                    state.conflicts = [str(m.id) for m in state.messages if str(m.id) not in inserted]
+                    items = self._dispatch_items([m for m in state.messages if str(m.id) in inserted])
+                    # Registrado antes do commit: se o despacho falhar depois dele, a
+                    # reentrega periódica (redispatch_pending_messages) o refaz
+                    dispatch_outbox.record(items)
+                if closed:
+                    Conversation.objects.filter(id__in=closed).update(status=Conversation.CLOSED, updated_at=now)
+                if touched:
+                    touch_conversations({conversation_id: now for conversation_id in touched})
+                if new_ids or closed:
+                    invalidate_conversation_state(*(new_ids | closed))
+                if items:
+                    # robust: uma falha no despacho não transforma o lote já gravado em erro
+                    transaction.on_commit(lambda: self._dispatch(items), robust=True)
+        except (OperationalError, InterfaceError):
+            # Falha transitória (conexão, deadlock): quem chamou decide se tenta de novo
+            raise
+        except DatabaseError as exc:
+            raise ValidationError({
+                'error': 'Falha ao persistir lote de eventos',
+                'detail': str(exc)
+            })
+
+    def _dispatch_items(self, messages):
+        """Itens de despacho (payload de handle_persisted_messages) das mensagens"""
+        return [
+            {
+                'conversation_id': str(message.conversation_id),
+                'score': message.timestamp.timestamp(),
+                'message': {
+                    'id': str(message.id),
+                    'type': Message.INBOUND,
+                    'content': message.content,
+                    'timestamp': format_timestamp(message.timestamp),
+                    'author': message.author_id
+                }
+            }
+            for message in messages
+        ]
+
+    def _dispatch(self, items):
+        """Agenda notificação WebSocket e agrupamento das mensagens persistidas"""
+        from .tasks import handle_persisted_messages
+        if self.dispatch_inline:
+            handle_persisted_messages(items)
+        else:
+            handle_persisted_messages.delay(items)
+
+
+class _BatchState:
+    """Estado em memória de um lote durante a aplicação dos eventos"""
+
+    def __init__(self, conversations, message_ids):
+        self.conversations = conversations
+        self.message_ids = message_ids
+        self.new_conversations = []
+        self.messages = []
+        # message_id -> índice do resultado; ids que já existiam no INSERT
+        self.message_results = {}
+        self.conflicts = []
+        self.closed = set()
+        self.touched = set()
+
+
+class NdjsonIngestor:
+    """
+    Ingestão incremental de eventos em NDJSON (um evento JSON por linha).
+
+    As linhas são lidas uma a uma e acumuladas em blocos de tamanho fixo,
+    cada bloco processado pelo WebhookBatchProcessor. A memória usada é
+    limitada pelo tamanho do bloco e pelo número de erros guardados.
+    """
+
+    def __init__(self, request_user, chunk_size=500, max_errors=100, on_progress=None):
+        self.processor = WebhookBatchProcessor(request_user)
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.on_progress = on_progress
+        self.lines = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = []
+        self.started_at = None
+
+    def ingest(self, lines):
+        """Consome um iterável de linhas (bytes ou str) e retorna o resumo"""
+        self.started_at = time.monotonic()
+        chunk = []
+        for raw in lines:
+            if isinstance(raw, bytes):
+                raw = raw.decode('utf-8')
+            raw = raw.strip()
+            if not raw:
+                continue
+            self.lines += 1
+            try:
+                chunk.append((self.lines, json.loads(raw)))
+            except json.JSONDecodeError as exc:
+                self._record_error(self.lines, {
+                    'error': 'Payload JSON inválido',
+                    'detail': str(exc),
+                    'received': raw[:100] + '...' if len(raw) > 100 else raw
+                })
+            if len(chunk) >= self.chunk_size:
+                self._flush(chunk)
+                chunk = []
+        if chunk:
+            self._flush(chunk)
+        return self.summary()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            'lines': self.lines,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'elapsed_seconds': round(elapsed, 3),
+            'events_per_second': round(self.lines / elapsed, 1) if elapsed else 0.0,
+            'errors': self.errors
+        }
+
+    def _flush(self, chunk):
+        line_numbers = [line for line, _ in chunk]
+        try:
+            results = self.processor.process([payload for _, payload in chunk])
+        except ValidationError as exc:
+            # Falha na transação do bloco: nenhum evento do bloco foi persistido
+            for line in line_numbers:
+                self._record_error(line, exc.detail)
+        else:
+            for line, result in zip(line_numbers, results):
+                if result['status_code'] >= 400:
+                    self._record_error(line, result['response'])
+                else:
+                    self.succeeded += 1
+        if self.on_progress:
+            self.on_progress(self.summary())
+
+    def _record_error(self, line, detail):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'response': detail})
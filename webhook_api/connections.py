@@ -0,0 +1,204 @@
+"""
+Conexões compartilhadas com o Redis e com o channel layer.
+
+Cada processo mantém um único pool limitado para o cliente Redis síncrono,
+um cliente redis.asyncio por event loop e um event loop persistente (em uma
+thread própria) para publicar no channel layer a partir de código síncrono
+(tasks Celery), de modo que as conexões do channels_redis são reaproveitadas
+entre publicações em vez de recriadas a cada async_to_sync. Tudo é criado
+sob demanda. Após um fork (Celery prefork) o pool síncrono se recria sozinho
+no filho (o redis-py confere o pid); os clientes assíncronos e o loop
+persistente são descartados e recriados no primeiro uso.
+"""
+import asyncio
+import os
+import threading
+import weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+from channels.layers import get_channel_layer
+from channels_redis.core import RedisChannelLayer
+
+
+class PersistentEventLoop:
+    """Event loop rodando em uma thread daemon, reutilizado entre chamadas síncronas"""
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def run(self, coroutine, timeout=None):
+        """Executa a corotina no loop persistente e aguarda o resultado"""
+        loop = self._ensure_loop()
+        if threading.current_thread() is self.thread:
+            coroutine.close()
+            raise RuntimeError('run() não pode ser chamado de dentro do próprio loop persistente')
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result(timeout)
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=self.loop.run_forever, name='channel-layer-loop', daemon=True
+                )
+                self.thread.start()
+            return self.loop
+
+
+class AsyncRedisClients:
+    """
+    Cliente redis.asyncio resolvido pelo event loop em execução.
+
+    Conexões do redis.asyncio ficam presas ao loop em que foram abertas; este
+    objeto mantém um cliente (com pool limitado) por loop e delega a ele os
+    comandos, então pode ser guardado em atributos de módulo com segurança.
+    """
+
+    def __init__(self, url, max_connections, timeout):
+        self.url = url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._clients = weakref.WeakKeyDictionary()
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            pool = redis.asyncio.BlockingConnectionPool.from_url(
+                self.url, max_connections=self.max_connections, timeout=self.timeout
+            )
+            client = self._clients[loop] = redis.asyncio.Redis(connection_pool=pool)
+        return client
+
+    def pools(self):
+        return [client.connection_pool for client in list(self._clients.values())]
+
+    def __getattr__(self, name):
+        return getattr(self.client(), name)
+
+
+class BlockingRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer com BlockingConnectionPool por host.
+
+    O channels_redis cria um ConnectionPool comum, que levanta ConnectionError
+    ao passar de max_connections; aqui quem excede espera uma conexão livre
+    por até 'timeout' segundos, como os pools de AsyncRedisClients. Hosts
+    sem 'address' (Sentinel) seguem o pool padrão.
+    """
+
+    def create_pool(self, index):
+        host = dict(self.hosts[index])
+        if 'address' not in host:
+            return super().create_pool(index)
+        return redis.asyncio.BlockingConnectionPool.from_url(host.pop('address'), **host)
+
+
+class ConnectionManager:
+    """Dono das conexões do processo; recriado no filho após fork"""
+
+    def __init__(self):
+        self._redis = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # No filho o lock, as conexões assíncronas e a thread do loop herdados não são utilizáveis
+        self._lock = threading.Lock()
+        self._async_redis = None
+        self._event_loop = PersistentEventLoop()
+
+    def redis(self):
+        with self._lock:
+            if self._redis is None:
+                pool = redis.BlockingConnectionPool.from_url(
+                    settings.CELERY_BROKER_URL,
+                    max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+                    timeout=settings.REDIS_POOL_TIMEOUT
+                )
+                self._redis = redis.Redis(connection_pool=pool)
+            return self._redis
+
+    def async_redis(self):
+        with self._lock:
+            if self._async_redis is None:
+                self._async_redis = AsyncRedisClients(
+                    settings.CELERY_BROKER_URL,
+                    max_connections=settings.REDIS_POOL_MAX_CONNECTIONS,
+                    timeout=settings.REDIS_POOL_TIMEOUT
+                )
+            return self._async_redis
+
+    def event_loop(self):
+        """Loop persistente do processo (iniciado no primeiro uso)"""
+        return self._event_loop._ensure_loop()
+
+    def run(self, coroutine, timeout=None):
+        """Executa a corotina no loop persistente a partir de código síncrono"""
+        return self._event_loop.run(coroutine, timeout)
+
+    def stats(self):
+        """Utilização dos pools do processo"""
+        return {
+            'pid': os.getpid(),
+            'redis': _pool_stats(self._redis.connection_pool) if self._redis is not None else None,
+            'async_redis': [
+                _pool_stats(pool) for pool in (self._async_redis.pools() if self._async_redis else [])
+            ],
+            'channel_layer': [_pool_stats(pool) for pool in _channel_layer_pools()]
+        }
+
+
+def _channel_layer_pools():
+    """
+    Pools abertos pelo channels_redis neste processo. Lê atributos internos
+    do RedisChannelLayer (um RedisLoopLayer por event loop); se a estrutura
+    mudar em outra versão, a métrica fica vazia em vez de quebrar o endpoint.
+    """
+    try:
+        loop_layers = list(getattr(get_channel_layer(), '_layers', {}).values())
+        return [
+            connection.connection_pool
+            for layer in loop_layers for connection in list(getattr(layer, '_connections', {}).values())
+        ]
+    except (AttributeError, TypeError):
+        return []
+
+
+def _pool_stats(pool):
+    """Conexões criadas/em uso/ociosas de um ConnectionPool ou BlockingConnectionPool"""
+    try:
+        if hasattr(pool, '_in_use_connections'):
+            created = pool._created_connections
+            in_use = len(pool._in_use_connections)
+        else:
+            queue = pool.pool.queue if hasattr(pool.pool, 'queue') else pool.pool._queue
+            created = len(pool._connections)
+            in_use = created - sum(1 for connection in list(queue) if connection is not None)
+    except (AttributeError, TypeError):
+        # Atributos internos do redis-py ausentes nesta versão
+        return {'max_connections': pool.max_connections}
+    return {
+        'max_connections': pool.max_connections,
+        'created': created,
+        'in_use': in_use,
+        'idle': created - in_use,
+        'utilization': round(in_use / pool.max_connections, 4) if pool.max_connections else 0.0
+    }
+
+
+connections = ConnectionManager()
+
+
+def get_redis():
+    """Cliente Redis síncrono compartilhado do processo (pool limitado)"""
+    return connections.redis()
+
+
+def get_async_redis():
+    """Cliente redis.asyncio do processo, resolvido pelo event loop em execução"""
+    return connections.async_redis()
+
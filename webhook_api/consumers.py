@@ -1,15 +1,423 @@
+import asyncio
+import logging
+import uuid
+from urllib.parse import parse_qs
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from .auth import can_access_conversation
+from .conversation_state import get_conversation_state_cache
+from .models import Message
+from .pagination import KeysetPaginator
+from .presence import presence_store, typing_coalescer
+from .replay import event_log
+from .send_queue import OutboundQueue, QueueOverflow
+from .wire import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, format_timestamp, pack_event, unpack_event
+
+logger = logging.getLogger(__name__)
+
+def conversation_group(conversation_id):
+    return f"conversation_{conversation_id}"
+
+
+async def denied_conversations(user, conversation_ids):
+    """
+    Ids, dentre conversation_ids, que não existem ou que o usuário não pode
+    acessar (mesmas regras de ConversationDetailView). Lê o mapa
+    conversa -> (cliente, agente) do cache de estado: com o cache quente o
+    handshake não vai ao banco.
+    """
+    if not user.is_authenticated:
+        return list(conversation_ids)
+    cache = get_conversation_state_cache()
+    states = await cache.aget_many(conversation_ids)
+    denied = []
+    for conversation_id in conversation_ids:
+        state = states.get(cache.normalize(conversation_id))
+        if state is None or not can_access_conversation(user, state['customer_id'], state['agent_id']):
+            denied.append(conversation_id)
+    return denied
+
+
+class WireFormatMixin:
+    """
+    Negocia o formato dos frames no handshake: com o subprotocolo
+    MSGPACK_SUBPROTOCOL os eventos seguem em frames binários msgpack
+    (wire.py); sem ele, em JSON (JSON_SUBPROTOCOL é aceito se oferecido).
+    Frames de controle do cliente são aceitos no formato negociado.
+    """
+
+    binary = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        offered = self.scope.get('subprotocols', ())
+        if subprotocol is None and MSGPACK_SUBPROTOCOL in offered:
+            subprotocol = MSGPACK_SUBPROTOCOL
+        elif subprotocol is None and JSON_SUBPROTOCOL in offered:
+            subprotocol = JSON_SUBPROTOCOL
+        self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if self.binary and bytes_data is not None:
+            await self.receive_json(unpack_event(bytes_data), **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def send_json(self, content, close=False):
+        if self.binary:
+            await self.send(bytes_data=pack_event(content), close=close)
+        else:
+            await super().send_json(content, close=close)
+
+
+class ConversationConsumer(WireFormatMixin, AsyncJsonWebsocketConsumer):
+    """
+    WebSocket de uma conversa. Cada mensagem entregue traz 'seq', a sequência
+    da conversa; ao reconectar com ?since=<seq> o cliente recebe apenas o que
+    perdeu, a partir do log recente (replay.py). Se o intervalo já saiu do
+    log, recebe um frame 'resync' com a página mais recente do banco e o
+    cursor para paginar o restante em /conversations/<id>/messages/.
+
+    Os eventos do grupo passam por uma fila de saída limitada (send_queue.py)
+    esvaziada por uma corotina escritora; quando o cliente está atrasado
+    vários eventos seguem em um único frame {'type': 'batch', 'messages': [...]}.
+    Com a política 'disconnect', o estouro fecha a conexão com o código
+    4008 e reason 'since=<seq>' para a retomada.
+
+    O cliente pode pedir frames msgpack pelo subprotocolo
+    'realmate.msgpack.v1' (WireFormatMixin).
+
+    O handshake exige um JWT (JWTWebSocketMiddleware) de quem tem acesso à
+    conversa; caso contrário é recusado.
+
+    Digitação e presença (presence.py): o cliente envia
+        {"type": "typing", "typing": true|false}
+    e recebe, no máximo uma vez por intervalo,
+        {"type": "typing", "users": [<user_id>, ...], "expires_in": <s>}
+    Ao conectar recebe {"type": "presence", "users": [...]}, reenviado a
+    todos quando um usuário entra ou sai da conversa.
+    """
+
+    OVERFLOW_CLOSE_CODE = 4008
 
-class ConversationConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.group_name = f"conversation_{self.conversation_id}"
+        self.group_name = conversation_group(self.conversation_id)
+        # Última sequência coberta pelo replay do connect: eventos ao vivo até
+        # ela já foram enviados. Os demais seguem sem filtro, pois publicadores
+        # diferentes podem entregar sequências fora de ordem.
+        self.replay_seq = 0
+        self.outbound = OutboundQueue(settings.WS_SEND_QUEUE_SIZE, settings.WS_SEND_OVERFLOW_POLICY)
+        self.writer = None
+        self.heartbeat = None
+        if await denied_conversations(self.scope['user'], [self.conversation_id]):
+            await self.close()
+            return
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
+        since = self._since()
+        if since is not None:
+            await self.replay(since)
+        self.writer = asyncio.ensure_future(self._write_loop())
+        await self.join_presence()
 
     async def disconnect(self, close_code):
+        self.outbound.close()
+        if self.writer is not None:
+            self.writer.cancel()
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            try:
+                await self._publish_presence(*await presence_store.leave(
+                    self.group_name, self.scope['user'].id, self.channel_name
+                ))
+            except Exception:
+                # A entrada expira pelo TTL da presença
+                logger.exception('Falha ao registrar a saída de %s da presença', self.group_name)
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
+    async def receive_json(self, content, **kwargs):
+        if not isinstance(content, dict) or content.get('type') != 'typing':
+            await self._deliver({
+                'type': 'error',
+                'error': 'Tipo de frame desconhecido',
+                'received': content.get('type') if isinstance(content, dict) else None,
+                'expected': ['typing']
+            })
+            return
+        try:
+            await typing_coalescer.update(self.group_name, self.scope['user'].id, bool(content.get('typing', True)))
+        except Exception:
+            # Digitação é best-effort: o próximo frame tenta de novo
+            logger.exception('Falha ao registrar digitação em %s', self.group_name)
+
+    async def join_presence(self):
+        # O heartbeat começa mesmo se o registro inicial falhar: o primeiro que der certo anuncia a entrada
+        self.heartbeat = asyncio.ensure_future(self._heartbeat_loop())
+        try:
+            users, joined = await presence_store.heartbeat(self.group_name, self.scope['user'].id, self.channel_name)
+            if joined:
+                # O evento do grupo também chega a esta conexão
+                await self._publish_presence(users, joined)
+            else:
+                await self._deliver({'type': 'presence', 'users': users})
+        except Exception:
+            logger.exception('Falha ao registrar presença em %s', self.group_name)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(settings.WS_PRESENCE_HEARTBEAT)
+            try:
+                # Reaparecer após expirar (ex.: Redis indisponível por um tempo) também gera evento
+                await self._publish_presence(*await presence_store.heartbeat(
+                    self.group_name, self.scope['user'].id, self.channel_name
+                ))
+            except Exception:
+                # Uma falha não encerra o loop: o próximo heartbeat registra a conexão de novo
+                logger.exception('Falha no heartbeat de presença em %s', self.group_name)
+
+    async def _publish_presence(self, users, changed):
+        if changed:
+            await self.channel_layer.group_send(self.group_name, {
+                'type': 'presence', 'group': self.group_name, 'users': users
+            })
+
+    async def replay(self, since):
+        messages, last_seq, complete = await event_log.read_since(self.group_name, since)
+        if complete:
+            # Enviado antes da escritora começar, em frames de até WS_SEND_MAX_BATCH mensagens
+            batch_size = settings.WS_SEND_MAX_BATCH
+            for start in range(0, len(messages), batch_size):
+                await self._send_frames(messages[start:start + batch_size])
+            if messages:
+                self.replay_seq = self.outbound.sent_seq = messages[-1]['seq']
+            return
+        page, previous_cursor = await database_sync_to_async(self._recent_messages)()
+        self.replay_seq = last_seq
+        await self.send_json({
+            'type': 'resync',
+            'seq': last_seq,
+            'messages': page,
+            'previous': previous_cursor
+        })
+
     async def new_message(self, event):
         # Recebe evento do task/celery e envia ao cliente
-        await self.send_json(event['message'])
\ No newline at end of file
+        await self._deliver(event['message'])
+
+    async def new_messages(self, event):
+        # Lote do fanout_publisher: mensagens da conversa na ordem de publicação
+        for message in event['messages']:
+            await self._deliver(message)
+
+    async def typing(self, event):
+        await self._deliver({'type': 'typing', 'users': event['users'], 'expires_in': event['expires_in']})
+
+    async def presence(self, event):
+        await self._deliver({'type': 'presence', 'users': event['users']})
+
+    async def _deliver(self, message):
+        seq = message.get('seq')
+        if seq is not None and seq <= self.replay_seq:
+            return
+        try:
+            # Apenas enfileira: um cliente lento não segura o consumer
+            self.outbound.put(message, seq)
+        except QueueOverflow as exc:
+            self.writer.cancel()
+            await self.close(code=self.OVERFLOW_CLOSE_CODE, reason=f'since={exc.since or 0}')
+
+    async def _write_loop(self):
+        while True:
+            frames = await self.outbound.get_batch(settings.WS_SEND_MAX_BATCH)
+            await self._send_frames(frames)
+
+    async def _send_frames(self, frames):
+        if len(frames) == 1:
+            await self.send_json(frames[0])
+        else:
+            await self.send_json({'type': 'batch', 'messages': frames})
+
+    def _since(self):
+        values = parse_qs(self.scope.get('query_string', b'').decode()).get('since')
+        try:
+            return max(0, int(values[0])) if values else None
+        except ValueError:
+            return None
+
+    def _recent_messages(self):
+        """Página mais recente de mensagens (mesmo formato dos eventos) e cursor para as anteriores"""
+        paginator = KeysetPaginator(settings.MESSAGES_PAGE_SIZE, settings.MESSAGES_MAX_PAGE_SIZE)
+        try:
+            items, previous_cursor, _ = paginator.paginate(
+                Message.objects.filter(conversation_id=self.conversation_id), {}
+            )
+        except DjangoValidationError:
+            # conversation_id da URL não é um UUID
+            return [], None
+        return [
+            {
+                'id': str(message.id),
+                'type': message.direction,
+                'content': message.content,
+                'timestamp': format_timestamp(message.timestamp),
+                'author': message.author_id
+            }
+            for message in items
+        ], previous_cursor
+
+
+class MultiplexConsumer(WireFormatMixin, AsyncJsonWebsocketConsumer):
+    """
+    Um único WebSocket inscrito em várias conversas (painel de agentes).
+
+    Frames de controle enviados pelo cliente:
+        {"action": "subscribe", "conversation_ids": ["<uuid>", ...]}
+        {"action": "unsubscribe", "conversation_ids": ["<uuid>", ...]}
+    ("conversation_id" com um único id também é aceito). Cada mensagem
+    entregue vem marcada com a conversa:
+        {"type": "message", "conversation_id": "<uuid>", "message": {...}}
+    Eventos de digitação e presença das conversas inscritas chegam como
+        {"type": "typing"|"presence", "conversation_id": "<uuid>", "users": [...]}
+    O número de inscrições por conexão é limitado por WS_MAX_SUBSCRIPTIONS.
+    Só usuários autenticados conectam, e cada inscrição passa pela mesma
+    verificação de acesso de ConversationConsumer (tudo ou nada). Os
+    group_add/group_discard rodam com no máximo CHANNEL_LAYER_MAX_CONNECTIONS
+    em paralelo; se algum group_add falhar, a inscrição inteira é desfeita.
+    """
+
+    async def connect(self):
+        # group -> conversation_id das conversas inscritas nesta conexão
+        self.subscriptions = {}
+        # Grupos cujo group_discard falhou: nova tentativa no disconnect
+        self.stale_groups = set()
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self._discard(list(self.subscriptions) + list(self.stale_groups))
+
+    async def receive_json(self, content, **kwargs):
+        action = content.get('action') if isinstance(content, dict) else None
+        if action not in ('subscribe', 'unsubscribe'):
+            await self._send_error('Ação desconhecida', received=action, expected=['subscribe', 'unsubscribe'])
+            return
+        conversation_ids = self._parse_ids(content)
+        if conversation_ids is None:
+            await self._send_error(
+                'conversation_ids deve ser uma lista de UUIDs válidos',
+                received=content.get('conversation_ids', content.get('conversation_id'))
+            )
+            return
+        if action == 'subscribe':
+            await self.subscribe(conversation_ids)
+        else:
+            await self.unsubscribe(conversation_ids)
+
+    async def subscribe(self, conversation_ids):
+        groups = {
+            conversation_group(cid): cid for cid in conversation_ids
+            if conversation_group(cid) not in self.subscriptions
+        }
+        limit = settings.WS_MAX_SUBSCRIPTIONS
+        if len(self.subscriptions) + len(groups) > limit:
+            await self._send_error(
+                'Limite de inscrições por conexão atingido',
+                limit=limit, subscribed=len(self.subscriptions), requested=len(groups)
+            )
+            return
+        denied = await denied_conversations(self.scope['user'], list(groups.values()))
+        if denied:
+            await self._send_error('Acesso negado a estas conversas', conversation_ids=denied)
+            return
+        failed = await self._apply_to_groups(self.channel_layer.group_add, list(groups))
+        # Registra o que entrou antes de desfazer: se o rollback falhar, o disconnect remove
+        self.subscriptions.update({group: cid for group, cid in groups.items() if group not in failed})
+        if failed:
+            # Um group_add que falhou pode ter gravado a inscrição: remove todos
+            await self._discard(list(groups))
+            await self._send_error(
+                'Falha ao inscrever as conversas, tente novamente',
+                conversation_ids=[groups[group] for group in failed]
+            )
+            return
+        await self.send_json({'type': 'subscribed', 'conversation_ids': conversation_ids})
+
+    async def unsubscribe(self, conversation_ids):
+        groups = [conversation_group(cid) for cid in conversation_ids]
+        await self._discard([group for group in groups if group in self.subscriptions])
+        await self.send_json({'type': 'unsubscribed', 'conversation_ids': conversation_ids})
+
+    async def new_message(self, event):
+        await self._forward(event.get('group'), [event['message']])
+
+    async def new_messages(self, event):
+        await self._forward(event.get('group'), event['messages'])
+
+    async def typing(self, event):
+        conversation_id = self.subscriptions.get(event['group'])
+        if conversation_id is not None:
+            await self.send_json({
+                'type': 'typing', 'conversation_id': conversation_id,
+                'users': event['users'], 'expires_in': event['expires_in']
+            })
+
+    async def presence(self, event):
+        conversation_id = self.subscriptions.get(event['group'])
+        if conversation_id is not None:
+            await self.send_json({'type': 'presence', 'conversation_id': conversation_id, 'users': event['users']})
+
+    async def _forward(self, group, messages):
+        conversation_id = self.subscriptions.get(group)
+        if conversation_id is None:
+            # Evento em trânsito de uma conversa já desinscrita
+            return
+        for message in messages:
+            await self.send_json({'type': 'message', 'conversation_id': conversation_id, 'message': message})
+
+    async def _discard(self, groups):
+        """Sai dos grupos; os que falharem deixam de ser entregues e ficam em stale_groups"""
+        for group in groups:
+            self.subscriptions.pop(group, None)
+        failed = await self._apply_to_groups(self.channel_layer.group_discard, groups)
+        self.stale_groups.difference_update(groups)
+        self.stale_groups.update(failed)
+
+    async def _apply_to_groups(self, operation, groups):
+        """
+        Executa operation(group, channel_name) para cada grupo com concorrência
+        limitada ao pool do channel layer; retorna o conjunto dos que falharam.
+        """
+        slots = asyncio.Semaphore(settings.CHANNEL_LAYER_MAX_CONNECTIONS)
+
+        async def apply(group):
+            async with slots:
+                await operation(group, self.channel_name)
+
+        results = await asyncio.gather(*(apply(group) for group in groups), return_exceptions=True)
+        failed = {group for group, result in zip(groups, results) if isinstance(result, BaseException)}
+        if failed:
+            error = next(result for result in results if isinstance(result, BaseException))
+            logger.error('%s falhou em %s de %s grupos: %r', operation.__name__, len(failed), len(groups), error)
+        return failed
+
+    @staticmethod
+    def _parse_ids(content):
+        raw = content.get('conversation_ids')
+        if raw is None and 'conversation_id' in content:
+            raw = [content['conversation_id']]
+        if not isinstance(raw, list) or not raw:
+            return None
+        try:
+            ids = [str(uuid.UUID(str(cid))) for cid in raw]
+        except ValueError:
+            return None
+        # Remove repetidos mantendo a ordem
+        return list(dict.fromkeys(ids))
+
+    async def _send_error(self, error, **details):
+        await self.send_json({'type': 'error', 'error': error, **details})
@@ -0,0 +1,270 @@
+import json
+import logging
+import threading
+import time
+import uuid
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from .cache import LRUCache
+from .models import Conversation
+
+logger = logging.getLogger(__name__)
+
+STATE_FIELDS = ('status', 'customer_id', 'agent_id')
+
+# Marca de "conversa inexistente" (cache negativo)
+MISSING = {'exists': False}
+
+# Grava o estado só se a versão da conversa ainda for a lida antes da
+# consulta ao banco (nenhuma invalidação no meio).
+# KEYS[1] = estado, KEYS[2] = versão; ARGV = versão lida, estado, TTL (s)
+STORE_STATE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+class ConversationStateCache:
+    """
+    Cache do estado das conversas usado pelo caminho quente do webhook:
+    existência, status (OPEN/CLOSED) e ids do cliente e do agente.
+
+    Duas camadas: um LRU em memória do processo, com TTL curto, na frente de
+    um cache compartilhado no Redis (SET com TTL). Os pontos de escrita
+    (criação, fechamento e atribuição de agente) invalidam as duas camadas
+    após o commit; como o LRU de outros processos só expira pelo TTL, quem
+    precisa do estado mais recente lê com local=False. O cache serve a
+    checagens de leitura (aceite do webhook, ACL do WebSocket); escritas
+    conferem o estado no banco.
+
+    Cada invalidação também incrementa uma versão da conversa no Redis. Quem
+    carrega do banco lê a versão antes da consulta e só grava o estado se
+    ela não mudou, de modo que uma leitura anterior a um fechamento não
+    recoloca o estado antigo no cache depois da invalidação.
+
+    Se a remoção no Redis falhar mesmo após as novas tentativas, a conversa
+    fica marcada como suspeita: este processo passa a lê-la direto do banco
+    até conseguir regravar no Redis o estado atual.
+    """
+
+    def __init__(self, redis_client, ttl, local_max_entries, local_ttl, negative_ttl,
+                 prefix='conversation:state:', async_redis_client=None, invalidation_retries=3):
+        self.redis = redis_client
+        # Cliente redis.asyncio usado pelas views assíncronas (aget/aget_many)
+        self.async_redis = async_redis_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = prefix
+        self.local = LRUCache(local_max_entries, local_ttl)
+        self.invalidation_retries = invalidation_retries
+        # Conversas cuja invalidação no Redis falhou: lidas sempre do banco
+        self._suspect = set()
+        self._lock = threading.Lock()
+        self._counters = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'failed_invalidations': 0}
+
+    def key(self, conversation_id):
+        return f"{self.prefix}{conversation_id}"
+
+    def version_key(self, conversation_id):
+        return f"{self.prefix}{conversation_id}:version"
+
+    @staticmethod
+    def normalize(conversation_id):
+        """UUID canônico da conversa, ou None se o id for inválido"""
+        try:
+            return str(uuid.UUID(str(conversation_id)))
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+    def get(self, conversation_id, local=True):
+        """Estado da conversa ({'status', 'customer_id', 'agent_id'}) ou None se não existir"""
+        return self.get_many([conversation_id], local=local).get(self.normalize(conversation_id))
+
+    def get_many(self, conversation_ids, local=True):
+        """
+        Retorna {conversation_id: estado ou None} consultando o LRU, depois o
+        Redis (um MGET) e por fim o banco (uma consulta) para o que faltar.
+        """
+        ids, found, pending, suspect = self._lookup_local(conversation_ids, local)
+        missing = []
+        if pending:
+            try:
+                raw_values = self.redis.mget([self.key(cid) for cid in pending])
+            except redis.RedisError:
+                raw_values = [None] * len(pending)
+            missing = self._merge_redis(found, pending, raw_values)
+        if missing or suspect:
+            found.update(self._load(missing + suspect))
+        return self._result(ids, found, pending, missing, suspect)
+
+    async def aget(self, conversation_id, local=True):
+        """Versão assíncrona de get"""
+        states = await self.aget_many([conversation_id], local=local)
+        return states.get(self.normalize(conversation_id))
+
+    async def aget_many(self, conversation_ids, local=True):
+        """
+        Versão assíncrona de get_many: LRU e Redis no event loop; só a carga
+        do banco (cache frio) roda em thread.
+        """
+        ids, found, pending, suspect = self._lookup_local(conversation_ids, local)
+        missing = []
+        if pending:
+            try:
+                raw_values = await self.async_redis.mget([self.key(cid) for cid in pending])
+            except redis.RedisError:
+                raw_values = [None] * len(pending)
+            missing = self._merge_redis(found, pending, raw_values)
+        if missing or suspect:
+            found.update(await sync_to_async(self._load)(missing + suspect))
+        return self._result(ids, found, pending, missing, suspect)
+
+    def _lookup_local(self, conversation_ids, local):
+        """
+        Separa os ids em encontrados no LRU, pendentes (a consultar no Redis)
+        e suspeitos. Os suspeitos não passam pelo LRU nem pelo Redis: quem
+        chama os carrega do banco com _load, que também regrava o Redis.
+        """
+        ids = {self.normalize(cid) for cid in conversation_ids} - {None}
+        with self._lock:
+            suspect = ids & self._suspect
+        found = {}
+        pending = []
+        for conversation_id in ids - suspect:
+            cached = self.local.get(conversation_id) if local else None
+            if cached is not None:
+                found[conversation_id] = cached
+            else:
+                pending.append(conversation_id)
+        return ids, found, pending, list(suspect)
+
+    def _merge_redis(self, found, pending, raw_values):
+        """Guarda os valores lidos do Redis e retorna os ids ainda ausentes"""
+        missing = []
+        for conversation_id, raw in zip(pending, raw_values):
+            if raw is None:
+                missing.append(conversation_id)
+                continue
+            found[conversation_id] = json.loads(raw)
+            self.local.set(conversation_id, found[conversation_id])
+        return missing
+
+    def _result(self, ids, found, pending, missing, suspect):
+        self._count(
+            local_hits=len(ids) - len(pending) - len(suspect),
+            redis_hits=len(pending) - len(missing),
+            misses=len(missing) + len(suspect)
+        )
+        return {cid: (None if state == MISSING else state) for cid, state in found.items()}
+
+    def _load(self, conversation_ids):
+        """Carrega do banco e popula as duas camadas (inclusive as inexistentes)"""
+        try:
+            versions = self.redis.mget([self.version_key(cid) for cid in conversation_ids])
+        except redis.RedisError:
+            # Sem a versão não há como descartar uma gravação atrasada: fica só no LRU
+            versions = None
+        states = {cid: MISSING for cid in conversation_ids}
+        rows = Conversation.objects.filter(id__in=conversation_ids).values_list('id', *STATE_FIELDS)
+        for conversation_id, *values in rows:
+            states[str(conversation_id)] = dict(zip(STATE_FIELDS, values))
+        if versions is not None and self._store(conversation_ids, versions, states):
+            # O Redis voltou a ter o estado atual dessas conversas
+            with self._lock:
+                self._suspect.difference_update(states)
+        for conversation_id, state in states.items():
+            ttl = self.negative_ttl if state == MISSING else None
+            self.local.set(conversation_id, state, ttl=ttl)
+        return states
+
+    def _store(self, conversation_ids, versions, states):
+        """Grava no Redis os estados cuja versão não mudou; False se o Redis falhou"""
+        try:
+            store = self.redis.register_script(STORE_STATE_SCRIPT)
+            pipe = self.redis.pipeline(transaction=False)
+            for conversation_id, version in zip(conversation_ids, versions):
+                state = states[conversation_id]
+                ttl = self.negative_ttl if state == MISSING else self.ttl
+                store(
+                    keys=[self.key(conversation_id), self.version_key(conversation_id)],
+                    args=[version or 0, json.dumps(state), ttl],
+                    client=pipe
+                )
+            pipe.execute()
+        except redis.RedisError:
+            return False
+        return True
+
+    def invalidate(self, *conversation_ids):
+        ids = {self.normalize(cid) for cid in conversation_ids} - {None}
+        if not ids:
+            return
+        for conversation_id in ids:
+            self.local.delete(conversation_id)
+        for attempt in range(self.invalidation_retries):
+            try:
+                pipe = self.redis.pipeline(transaction=True)
+                pipe.delete(*[self.key(cid) for cid in ids])
+                for conversation_id in ids:
+                    # Descarta gravações de quem leu o banco antes desta invalidação
+                    pipe.incr(self.version_key(conversation_id))
+                    pipe.expire(self.version_key(conversation_id), self.ttl)
+                pipe.execute()
+            except redis.RedisError:
+                if attempt + 1 < self.invalidation_retries:
+                    time.sleep(0.05 * 2 ** attempt)
+                continue
+            return
+        # O Redis pode manter um estado antigo até o TTL: lê essas conversas do banco
+        with self._lock:
+            self._suspect.update(ids)
+        self._count(failed_invalidations=1)
+        logger.error('Falha ao invalidar o estado em cache das conversas %s', sorted(ids))
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            suspect = len(self._suspect)
+        lookups = counters['local_hits'] + counters['redis_hits'] + counters['misses']
+        counters['hit_ratio'] = (
+            round((counters['local_hits'] + counters['redis_hits']) / lookups, 4) if lookups else 0.0
+        )
+        counters['suspect'] = suspect
+        return counters
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self._counters[name] += value
+
+
+def _build_cache():
+    from .connections import get_redis, get_async_redis
+    return ConversationStateCache(
+        get_redis(),
+        ttl=settings.CONVERSATION_STATE_TTL,
+        local_max_entries=settings.CONVERSATION_STATE_LOCAL_ENTRIES,
+        local_ttl=settings.CONVERSATION_STATE_LOCAL_TTL,
+        negative_ttl=settings.CONVERSATION_STATE_NEGATIVE_TTL,
+        async_redis_client=get_async_redis()
+    )
+
+
+_cache = None
+
+
+def get_conversation_state_cache():
+    global _cache
+    if _cache is None:
+        _cache = _build_cache()
+    return _cache
+
+
+def invalidate_conversation_state(*conversation_ids):
+    """Invalida o estado em cache das conversas após o commit da transação atual"""
+    transaction.on_commit(lambda: get_conversation_state_cache().invalidate(*conversation_ids))
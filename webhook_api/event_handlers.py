@@ -1,5 +1,8 @@
 from datetime import datetime
 from .models import Conversation, Message
+from .touch import touch_conversation
+from .conversation_state import invalidate_conversation_state
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
 import uuid
@@ -127,6 +130,8 @@ class NewConversationEvent(WebhookEvent):
             id=conversation_id,
             customer=customer
         )
+        # Descarta o estado "inexistente" que possa estar em cache
+        invalidate_conversation_state(conversation.id)
         
         return {
             'status': 'Conversa criada com sucesso',
@@ -157,53 +162,64 @@ class NewMessageEvent(WebhookEvent):
                     'received': self.data.get(field),
                     'expected': 'UUID válido'
                 })
+        # O PostgreSQL não aceita o caractere NUL em campos de texto
+        if '\x00' in self.data['content']:
+            raise ValidationError({
+                'error': 'Campo content contém caractere nulo (\\u0000)',
+                'message_id': self.data['id']
+            })
 
     def process(self):
         message_id = self.data['id']
         content = self.data['content']
         conversation_id = self.data['conversation_id']
         
-        # Verificar se a mensagem já existe
-        if Message.objects.filter(id=message_id).exists():
-            raise ValidationError({
-                'error': 'Mensagem já existe',
-                'message_id': message_id
-            })
-        
-        # Verificar se a conversa existe
-        try:
-            conversation = Conversation.objects.get(id=conversation_id)
-        except Conversation.DoesNotExist:
-            raise ValidationError({
-                'error': 'Conversa não encontrada',
-                'conversation_id': conversation_id
-            })
+        # Inserção idempotente em um único comando, condicionada à conversa aberta
+        author = self.request_user
+        inserted = Message.objects.insert_if_conversation_open(
+            message_id=message_id,
+            conversation_id=conversation_id,
+            direction=Message.INBOUND,
+            content=content,
+            timestamp=self.event_time,
+            author_id=author.id if author and not author.is_anonymous else None
+        )
         
-        # Verificar se a conversa está aberta
-        if conversation.status == Conversation.CLOSED:
+        if not inserted:
+            # Caminho raro: descobrir por que nada foi inserido
+            if Message.objects.filter(id=message_id).exists():
+                # Reenvio do mesmo webhook: idempotente, nada a fazer
+                return {
+                    'status': 'Mensagem já registrada',
+                    'message_id': message_id,
+                    'conversation_id': conversation_id,
+                    'created': False
+                }, status.HTTP_200_OK
+            
+            # Verificar se a conversa existe
+            try:
+                conversation = Conversation.objects.get(id=conversation_id)
+            except Conversation.DoesNotExist:
+                raise ValidationError({
+                    'error': 'Conversa não encontrada',
+                    'conversation_id': conversation_id
+                })
+            
+            # A conversa existe, portanto está fechada
             raise ValidationError({
                 'error': 'Não é possível adicionar mensagens a uma conversa fechada',
                 'conversation_id': conversation_id,
                 'conversation_status': conversation.status
             })
         
-        # Criar nova mensagem INBOUND
-        message = Message.objects.create(
-            id=message_id,
-            conversation=conversation,
-            direction=Message.INBOUND,
-            content=content,
-            timestamp=self.event_time,
-            author=self.request_user
-        )
-        
-        conversation.updated_at = self.event_time
-        conversation.save()
+        # Atualiza apenas updated_at, sem reescrever status/agent
+        touch_conversation(conversation_id)
         
         return {
             'status': 'Mensagem adicionada com sucesso',
-            'message_id': str(message.id),
-            'conversation_id': str(conversation.id)
+            'message_id': message_id,
+            'conversation_id': conversation_id,
+            'created': True
         }, status.HTTP_201_CREATED
 
 
@@ -247,9 +263,15 @@ class CloseConversationEvent(WebhookEvent):
                 'conversation_id': conversation_id
             })
         
-        # Fechar a conversa
-        conversation.status = Conversation.CLOSED
-        conversation.save()
+        # Fechar a conversa apenas se ainda estiver aberta (evita corrida com outro fechamento)
+        closed = Conversation.objects.filter(id=conversation.id, status=Conversation.OPEN) \
+            .update(status=Conversation.CLOSED, updated_at=timezone.now())
+        if not closed:
+            raise ValidationError({
+                'error': 'Conversa já está fechada',
+                'conversation_id': conversation_id
+            })
+        invalidate_conversation_state(conversation.id)
         
         return {
             'status': 'Conversa fechada com sucesso',
@@ -260,6 +282,68 @@ class CloseConversationEvent(WebhookEvent):
 class EventFactory:
     """Fábrica para criar instâncias de eventos com base no tipo"""
     
+    @staticmethod
+    def validate_payload(payload):
+        """Valida o envelope do webhook e retorna (type, timestamp, data)"""
+        # Validar se o payload é um dicionário
+        if not isinstance(payload, dict):
+            raise ValidationError({
+                'error': 'Payload deve ser um objeto JSON',
+                'received_type': type(payload).__name__
+            })
+        
+        # Validar campos obrigatórios no payload
+        required_fields = ['type', 'timestamp', 'data']
+        missing_fields = []
+        for field in required_fields:
+            if field not in payload:
+                missing_fields.append(field)
+        
+        if missing_fields:
+            raise ValidationError({
+                'error': 'Campos obrigatórios ausentes',
+                'missing_fields': missing_fields,
+                'received_fields': list(payload.keys())
+            })
+        
+        # Validar tipos dos campos principais
+        type_errors = []
+        if not isinstance(payload.get('type'), str):
+            type_errors.append({
+                'field': 'type',
+                'expected_type': 'string',
+                'received_type': type(payload.get('type')).__name__,
+                'value': payload.get('type')
+            })
+        
+        if not isinstance(payload.get('timestamp'), str):
+            type_errors.append({
+                'field': 'timestamp',
+                'expected_type': 'string',
+                'received_type': type(payload.get('timestamp')).__name__,
+                'value': payload.get('timestamp')
+            })
+        
+        if not isinstance(payload.get('data'), dict):
+            type_errors.append({
+                'field': 'data',
+                'expected_type': 'object',
+                'received_type': type(payload.get('data')).__name__,
+                'value': payload.get('data')
+            })
+        
+        if type_errors:
+            raise ValidationError({
+                'error': 'Tipos de dados inválidos',
+                'type_errors': type_errors
+            })
+        
+        # Extrair dados do payload
+        event_type = payload['type']
+        timestamp = payload['timestamp']
+        data = payload['data']
+        return event_type, timestamp, data
+    
     @staticmethod
     def create_event(event_type, data, timestamp, request_user=None):
         if not isinstance(event_type, str):
@@ -0,0 +1,109 @@
+"""
+Serialização rápida para os caminhos de leitura de Message/Conversation.
+
+Trabalha sobre tuplas de .values_list() em vez de instâncias de modelo e
+ModelSerializers aninhados, evitando a introspecção de campos e o
+to_representation por objeto do DRF. O JSON produzido é idêntico ao de
+MessageSerializer/ConversationSerializer.
+"""
+from django.utils import timezone
+from .models import Message
+
+USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name')
+
+# Colunas de uma mensagem com o autor em um único JOIN
+MESSAGE_COLUMNS = ('id', 'direction', 'content', 'timestamp') + tuple(f'author__{f}' for f in USER_FIELDS)
+
+
+def format_datetime(value):
+    """Mesmo formato do DateTimeField do DRF (ISO 8601, UTC como 'Z')"""
+    if value is None:
+        return None
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    value = value.astimezone(timezone.get_current_timezone()).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def user_to_dict(user):
+    if user is None:
+        return None
+    return {field: getattr(user, field) for field in USER_FIELDS}
+
+
+def _user_from_row(row, offset):
+    if row[offset] is None:
+        return None
+    return dict(zip(USER_FIELDS, row[offset:offset + len(USER_FIELDS)]))
+
+
+def serialize_message_values(rows):
+    """
+    Serializa dicts de .values(*MESSAGE_COLUMNS) (por exemplo, uma página
+    do KeysetPaginator) no formato de MessageSerializer.
+    """
+    return [
+        {
+            'id': str(row['id']),
+            'type': row['direction'],
+            'content': row['content'],
+            'timestamp': format_datetime(row['timestamp']),
+            'author': _user_from_row([row[column] for column in MESSAGE_COLUMNS], 4),
+        }
+        for row in rows
+    ]
+
+
+def serialize_message_rows(queryset):
+    """Serializa um queryset de Message no formato de MessageSerializer"""
+    author_offset = 4
+    return [
+        {
+            'id': str(row[0]),
+            'type': row[1],
+            'content': row[2],
+            'timestamp': format_datetime(row[3]),
+            'author': _user_from_row(row, author_offset),
+        }
+        for row in queryset.values_list(*MESSAGE_COLUMNS)
+    ]
+
+
+def serialize_conversation(conversation, messages=None):
+    """
+    Serializa a conversa no formato de ConversationSerializer. Por padrão
+    inclui todas as mensagens, carregadas em uma única consulta.
+    """
+    if messages is None:
+        messages = serialize_message_rows(
+            Message.objects.filter(conversation_id=conversation.id).order_by('timestamp')
+        )
+    return {
+        'id': str(conversation.id),
+        'status': conversation.status,
+        'customer': user_to_dict(conversation.customer),
+        'agent': user_to_dict(conversation.agent),
+        'messages': messages,
+        'created_at': format_datetime(conversation.created_at),
+        'updated_at': format_datetime(conversation.updated_at),
+    }
+
+
+def serialize_messages_by_conversation(queryset, author):
+    """
+    Serializa mensagens de várias conversas em uma única consulta, agrupadas
+    por conversation_id, usando o mesmo autor já serializado para todas.
+    """
+    grouped = {}
+    rows = queryset.values_list('conversation_id', 'id', 'direction', 'content', 'timestamp')
+    for conversation_id, message_id, direction, content, timestamp in rows:
+        grouped.setdefault(conversation_id, []).append({
+            'id': str(message_id),
+            'type': direction,
+            'content': content,
+            'timestamp': format_datetime(timestamp),
+            'author': author,
+        })
+    return grouped
@@ -0,0 +1,291 @@
+import json
+from datetime import datetime
+from django.conf import settings
+
+# Sorted set com o prazo (epoch) de agrupamento pendente de cada conversa
+GROUPING_DEADLINES_KEY = 'grouping:deadlines'
+# Tentativas de agrupamento que falharam, por conversa (hash)
+GROUPING_ATTEMPTS_KEY = 'grouping:attempts'
+# Entradas drenadas cujo agrupamento foi abandonado (lista de JSON)
+GROUPING_DEAD_LETTER_KEY = 'grouping:dead_letter'
+
+
+def current_time():
+    """Instante atual na mesma base dos scores do buffer (UTC ingênuo -> epoch)"""
+    return datetime.utcnow().timestamp()
+
+
+class GroupingPolicy:
+    """
+    Política da janela de agrupamento de uma conversa.
+
+    A janela é o silêncio exigido após a última mensagem do buffer. Todas as
+    políticas aceitam um limite de tamanho do lote (max_batch_size), que força
+    o agrupamento imediato, e um tempo máximo de espera desde a primeira
+    mensagem do buffer (max_wait), para que um cliente digitando rápido não
+    adie a resposta indefinidamente.
+    """
+
+    # Indica se window_for precisa dos scores atuais do buffer
+    requires_scores = False
+
+    def __init__(self, max_batch_size=None, max_wait=None):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+    def window_for(self, scores):
+        """Método a ser implementado pelas subclasses"""
+        raise NotImplementedError("Subclasses devem implementar este método")
+
+    def is_full(self, scores):
+        return bool(self.max_batch_size) and len(scores) >= self.max_batch_size
+
+    def deadline(self, scores):
+        """Prazo absoluto para agrupar o buffer com os scores (ordenados) informados"""
+        deadline = scores[-1] + self.window_for(scores)
+        if self.max_wait is not None:
+            deadline = min(deadline, scores[0] + self.max_wait)
+        return deadline
+
+
+class FixedWindowPolicy(GroupingPolicy):
+    """Janela fixa após a última mensagem"""
+
+    def __init__(self, window, max_batch_size=None, max_wait=None):
+        super().__init__(max_batch_size=max_batch_size, max_wait=max_wait)
+        self.window = window
+
+    def window_for(self, scores):
+        return self.window
+
+
+class MaxWaitPolicy(FixedWindowPolicy):
+    """Janela fixa, limitada a max_wait segundos desde a primeira mensagem"""
+
+    def __init__(self, window, max_wait, max_batch_size=None):
+        super().__init__(window, max_batch_size=max_batch_size, max_wait=max_wait)
+
+
+class AdaptiveWindowPolicy(GroupingPolicy):
+    """
+    Janela adaptativa: estima o intervalo entre mensagens da conversa
+    (média móvel exponencial dos intervalos entre os scores do buffer) e usa
+    um múltiplo desse intervalo, limitado a [min_window, max_window].
+    """
+
+    requires_scores = True
+
+    def __init__(self, min_window, max_window, default_window, factor=2.0, alpha=0.5,
+                 max_batch_size=None, max_wait=None):
+        super().__init__(max_batch_size=max_batch_size, max_wait=max_wait)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.default_window = default_window
+        self.factor = factor
+        self.alpha = alpha
+
+    def window_for(self, scores):
+        if len(scores) < 2:
+            return self.default_window
+        estimate = None
+        for previous, current in zip(scores, scores[1:]):
+            gap = current - previous
+            estimate = gap if estimate is None else self.alpha * gap + (1 - self.alpha) * estimate
+        return min(self.max_window, max(self.min_window, estimate * self.factor))
+
+
+def get_grouping_policy():
+    """Instancia a política configurada em settings.GROUPING_POLICY"""
+    policy_map = {
+        'fixed': lambda: FixedWindowPolicy(
+            settings.GROUPING_WINDOW_SECONDS,
+            max_batch_size=settings.GROUPING_MAX_BATCH_SIZE
+        ),
+        'max_wait': lambda: MaxWaitPolicy(
+            settings.GROUPING_WINDOW_SECONDS,
+            settings.GROUPING_MAX_WAIT_SECONDS,
+            max_batch_size=settings.GROUPING_MAX_BATCH_SIZE
+        ),
+        'adaptive': lambda: AdaptiveWindowPolicy(
+            settings.GROUPING_ADAPTIVE_MIN_WINDOW,
+            settings.GROUPING_ADAPTIVE_MAX_WINDOW,
+            settings.GROUPING_WINDOW_SECONDS,
+            factor=settings.GROUPING_ADAPTIVE_FACTOR,
+            max_batch_size=settings.GROUPING_MAX_BATCH_SIZE,
+            max_wait=settings.GROUPING_MAX_WAIT_SECONDS
+        ),
+    }
+    if settings.GROUPING_POLICY not in policy_map:
+        raise ValueError(
+            f"GROUPING_POLICY desconhecida: {settings.GROUPING_POLICY} "
+            f"(esperado: {', '.join(policy_map)})"
+        )
+    return policy_map[settings.GROUPING_POLICY]()
+
+
+# Lê o buffer, verifica o prazo e drena em uma única operação atômica.
+# KEYS[1] = buffer da conversa
+# ARGV = agora (epoch), janela (s), espera máxima (s, < 0 desativa), tamanho máximo (<= 0 desativa)
+DRAIN_BUFFER_SCRIPT = """
+local entries = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+if #entries == 0 then
+    return {'empty'}
+end
+local deadline = tonumber(entries[#entries]) + tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+if max_wait >= 0 then
+    deadline = math.min(deadline, tonumber(entries[2]) + max_wait)
+end
+local max_batch = tonumber(ARGV[4])
+local full = max_batch > 0 and (#entries / 2) >= max_batch
+if not full and tonumber(ARGV[1]) < deadline then
+    return {'open', tostring(deadline)}
+end
+redis.call('DEL', KEYS[1])
+table.insert(entries, 1, 'drained')
+return entries
+"""
+
+
+class InboundBuffer:
+    """
+    Buffer de mensagens INBOUND aguardando agrupamento (sorted set
+    inbound:{conversation_id}, score = epoch do evento).
+
+    A drenagem é feita por um script Lua: leitura, verificação do prazo e
+    remoção acontecem atomicamente no servidor, em um único round-trip, e
+    nenhuma mensagem adicionada entre a leitura e a limpeza é perdida.
+    """
+
+    EMPTY = 'empty'
+    OPEN = 'open'
+    DRAINED = 'drained'
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._drain_script = redis_client.register_script(DRAIN_BUFFER_SCRIPT)
+
+    @staticmethod
+    def key(conversation_id):
+        return f"inbound:{conversation_id}"
+
+    def add(self, conversation_id, members, pipe=None):
+        """Adiciona {message_id: score} ao buffer da conversa"""
+        client = pipe if pipe is not None else self.redis
+        client.zadd(self.key(conversation_id), members)
+
+    def scores(self, conversation_ids):
+        """Retorna {conversation_id: [scores ordenados]} em um único round-trip"""
+        conversation_ids = [str(cid) for cid in conversation_ids]
+        pipe = self.redis.pipeline(transaction=False)
+        for conversation_id in conversation_ids:
+            pipe.zrange(self.key(conversation_id), 0, -1, withscores=True)
+        return {
+            conversation_id: [score for _, score in entries]
+            for conversation_id, entries in zip(conversation_ids, pipe.execute())
+        }
+
+    def drain(self, conversation_id, now, window, max_wait=None, max_batch_size=None):
+        """
+        Retorna (EMPTY, None), (OPEN, deadline) ou (DRAINED, [(message_id, score), ...]).
+        """
+        reply = self._drain_script(
+            keys=[self.key(conversation_id)],
+            args=[now, window, -1 if max_wait is None else max_wait, max_batch_size or 0]
+        )
+        state = reply[0].decode() if isinstance(reply[0], bytes) else reply[0]
+        if state == self.EMPTY:
+            return state, None
+        if state == self.OPEN:
+            return state, float(reply[1])
+        flat = reply[1:]
+        entries = [
+            (member.decode() if isinstance(member, bytes) else member, float(score))
+            for member, score in zip(flat[0::2], flat[1::2])
+        ]
+        return state, entries
+
+    def restore(self, conversation_id, entries):
+        """Devolve ao buffer entradas drenadas cujo agrupamento falhou"""
+        if entries:
+            self.add(conversation_id, dict(entries))
+
+    def record_failure(self, conversation_id):
+        """Conta uma falha de agrupamento da conversa e retorna o total de tentativas"""
+        return self.redis.hincrby(GROUPING_ATTEMPTS_KEY, str(conversation_id), 1)
+
+    def clear_failures(self, conversation_id):
+        self.redis.hdel(GROUPING_ATTEMPTS_KEY, str(conversation_id))
+
+    def dead_letter(self, conversation_id, entries, reason):
+        """Guarda as entradas drenadas de um agrupamento abandonado para inspeção"""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.rpush(GROUPING_DEAD_LETTER_KEY, json.dumps({
+            'conversation_id': str(conversation_id),
+            'entries': entries,
+            'reason': reason,
+            'failed_at': current_time()
+        }))
+        pipe.hdel(GROUPING_ATTEMPTS_KEY, str(conversation_id))
+        pipe.execute()
+
+
+class GroupingScheduler:
+    """
+    Agendador de debounce do agrupamento de mensagens.
+
+    Mantém exatamente um prazo pendente por conversa em um sorted set do
+    Redis, calculado pela política de agrupamento a partir dos scores do
+    buffer. Um único loop periódico dispara o agrupamento das conversas cujo
+    prazo expirou, de modo que o volume de tasks no broker acompanha o número
+    de conversas e não o de mensagens.
+    """
+
+    def __init__(self, redis_client, buffer, policy, key=GROUPING_DEADLINES_KEY):
+        self.redis = redis_client
+        self.buffer = buffer
+        self.policy = policy
+        self.key = key
+
+    def schedule(self, conversation_ids):
+        """Recalcula o prazo das conversas a partir do estado atual dos buffers"""
+        deadlines = {}
+        now = current_time()
+        for conversation_id, scores in self.buffer.scores(conversation_ids).items():
+            if not scores:
+                continue
+            # Lote cheio: agrupa na próxima volta do loop
+            deadlines[conversation_id] = now if self.policy.is_full(scores) else self.policy.deadline(scores)
+        if deadlines:
+            self.redis.zadd(self.key, deadlines)
+
+    def schedule_at(self, conversation_id, deadline):
+        self.redis.zadd(self.key, {str(conversation_id): deadline})
+
+    def cancel(self, conversation_id):
+        self.redis.zrem(self.key, str(conversation_id))
+
+    def drain(self, conversation_id, now):
+        """Drena o buffer da conversa se o prazo da política tiver expirado"""
+        scores = []
+        if self.policy.requires_scores:
+            scores = self.buffer.scores([conversation_id])[str(conversation_id)]
+        return self.buffer.drain(
+            conversation_id, now, self.policy.window_for(scores),
+            max_wait=self.policy.max_wait,
+            max_batch_size=self.policy.max_batch_size
+        )
+
+    def pop_due(self, now=None, limit=500):
+        """
+        Retorna as conversas com prazo expirado, removendo-as do agendamento.
+        Apenas o worker que consegue remover o membro o recebe, então vários
+        loops podem rodar em paralelo sem disparar o mesmo agrupamento duas vezes.
+        """
+        now = current_time() if now is None else now
+        members = self.redis.zrangebyscore(self.key, '-inf', now, start=0, num=limit)
+        due = []
+        for member in members:
+            if self.redis.zrem(self.key, member):
+                due.append(member.decode() if isinstance(member, bytes) else member)
+        return due
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+import redis
+from django.conf import settings
+from .cache import LRUCache
+
+# Retorna o valor atual da chave ou, se ela não existir, grava a reivindicação
+# (SET PX) e retorna nil. KEYS[1] = chave; ARGV = marcador, validade (ms)
+CLAIM_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    return value
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return false
+"""
+
+# Remove a reivindicação apenas se ainda for a desta requisição
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class IdempotencyStore:
+    """
+    Janela de deduplicação de webhooks.
+
+    Antes de processar, a requisição reivindica a chave de idempotência
+    (header Idempotency-Key ou '(type, data.id)', escopada pelo usuário
+    autenticado) com um marcador de "em processamento" no Redis. Ao terminar
+    com sucesso a resposta substitui o marcador; em caso de erro o marcador
+    é removido. Um reenvio que encontra a resposta a recebe sem tocar no
+    Postgres; um que encontra o marcador espera até claim_wait segundos pela
+    resposta e, se ela não vier, deve ser recusado (409). Um LRU em memória
+    fica na frente do Redis para as respostas já concluídas.
+    """
+
+    HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+    def __init__(self, redis_client, ttl, local_max_entries, prefix='idempotency:', async_redis_client=None,
+                 claim_ttl=30, claim_wait=2, poll_interval=0.05):
+        self.redis = redis_client
+        # Cliente redis.asyncio usado pelas views assíncronas (abegin/astore/arelease)
+        self.async_redis = async_redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+        # Validade da reivindicação (s), espera por uma requisição em andamento (s)
+        self.claim_ttl = claim_ttl
+        self.claim_wait = claim_wait
+        self.poll_interval = poll_interval
+        self.local = LRUCache(local_max_entries, ttl)
+        self._lock = threading.Lock()
+        self._counters = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'stored': 0, 'in_flight': 0}
+
+    def key_for(self, request, event_type, data):
+        """Chave da requisição, ou None se não houver como identificá-la"""
+        key = request.META.get(self.HEADER)
+        if not key:
+            event_id = data.get('id') if isinstance(data, dict) else None
+            if not isinstance(event_id, str) or not event_id:
+                return None
+            key = f"{event_type}:{event_id}"
+        return f"{self.prefix}{request.user.id}:{key}"
+
+    def begin(self, key):
+        """
+        Reivindica a chave antes de processar. Retorna (token, None) quando
+        esta requisição deve processar e depois chamar store() ou release()
+        com o token; (None, (body, status)) com a resposta original; ou
+        (None, None) se outra requisição continua processando após a espera.
+        """
+        cached = self.local.get(key)
+        if cached is not None:
+            self._count('local_hits')
+            return None, cached
+        token = self._marker()
+        deadline = time.monotonic() + self.claim_wait
+        claim = self.redis.register_script(CLAIM_SCRIPT)
+        while True:
+            try:
+                raw = claim(keys=[key], args=[token, int(self.claim_ttl * 1000)])
+            except redis.RedisError:
+                # Redis indisponível: segue sem deduplicação compartilhada
+                return token, None
+            outcome = self._outcome(key, token, raw)
+            if outcome is not None or time.monotonic() >= deadline:
+                return outcome or (None, None)
+            time.sleep(self.poll_interval)
+
+    async def abegin(self, key):
+        """Versão assíncrona de begin"""
+        cached = self.local.get(key)
+        if cached is not None:
+            self._count('local_hits')
+            return None, cached
+        token = self._marker()
+        deadline = time.monotonic() + self.claim_wait
+        claim = self.async_redis.register_script(CLAIM_SCRIPT)
+        while True:
+            try:
+                raw = await claim(keys=[key], args=[token, int(self.claim_ttl * 1000)])
+            except redis.RedisError:
+                return token, None
+            outcome = self._outcome(key, token, raw)
+            if outcome is not None or time.monotonic() >= deadline:
+                return outcome or (None, None)
+            await asyncio.sleep(self.poll_interval)
+
+    def release(self, key, token):
+        """Desiste da reivindicação (processamento falhou): um reenvio pode processar"""
+        try:
+            self.redis.register_script(RELEASE_SCRIPT)(keys=[key], args=[token])
+        except redis.RedisError:
+            pass
+
+    async def arelease(self, key, token):
+        """Versão assíncrona de release"""
+        try:
+            await self.async_redis.register_script(RELEASE_SCRIPT)(keys=[key], args=[token])
+        except redis.RedisError:
+            pass
+
+    def store(self, key, body, status_code):
+        self.local.set(key, (body, status_code))
+        try:
+            self.redis.set(key, self._encode(body, status_code), ex=self.ttl)
+        except redis.RedisError:
+            return
+        self._count('stored')
+
+    async def astore(self, key, body, status_code):
+        """Versão assíncrona de store"""
+        self.local.set(key, (body, status_code))
+        try:
+            await self.async_redis.set(key, self._encode(body, status_code), ex=self.ttl)
+        except redis.RedisError:
+            return
+        self._count('stored')
+
+    @staticmethod
+    def _encode(body, status_code):
+        return json.dumps({'body': body, 'status': status_code})
+
+    @staticmethod
+    def _marker():
+        return json.dumps({'pending': uuid.uuid4().hex})
+
+    def _outcome(self, key, token, raw):
+        """
+        Interpreta a resposta do CLAIM_SCRIPT: (token, None) se a chave foi
+        reivindicada, (None, resposta) se já concluída, None se em andamento.
+        """
+        if raw is None:
+            self._count('misses')
+            return token, None
+        data = json.loads(raw)
+        if 'pending' in data:
+            self._count('in_flight')
+            return None
+        cached = (data['body'], data['status'])
+        self.local.set(key, cached)
+        self._count('redis_hits')
+        return None, cached
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters['local_hits'] + counters['redis_hits'] + counters['misses']
+        counters['hit_ratio'] = (
+            round((counters['local_hits'] + counters['redis_hits']) / lookups, 4) if lookups else 0.0
+        )
+        return counters
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+def _build_store():
+    from .connections import get_redis, get_async_redis
+    return IdempotencyStore(
+        get_redis(),
+        ttl=settings.WEBHOOK_IDEMPOTENCY_TTL,
+        local_max_entries=settings.WEBHOOK_IDEMPOTENCY_LOCAL_ENTRIES,
+        async_redis_client=get_async_redis(),
+        claim_ttl=settings.WEBHOOK_IDEMPOTENCY_CLAIM_TTL,
+        claim_wait=settings.WEBHOOK_IDEMPOTENCY_WAIT_MS / 1000
+    )
+
+
+_store = None
+
+
+def get_idempotency_store():
+    global _store
+    if _store is None:
+        _store = _build_store()
+    return _store
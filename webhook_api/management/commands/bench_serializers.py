@@ -0,0 +1,74 @@
+import time
+import uuid
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from webhook_api.fast_serializers import serialize_conversation
+from webhook_api.models import Conversation, Message
+from webhook_api.serializers import ConversationSerializer
+
+
+class Command(BaseCommand):
+    help = ('Compara o ConversationSerializer do DRF com o serializador rápido em uma '
+            'conversa sintética (os dados são descartados ao final).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10000, help='Número de mensagens da conversa')
+        parser.add_argument('--rounds', type=int, default=5, help='Repetições de cada serializador')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            conversation = self._build_conversation(options['messages'])
+            renderer = JSONRenderer()
+
+            drf_time, drf_json = self._measure(options['rounds'], lambda: renderer.render(
+                ConversationSerializer(
+                    Conversation.objects.select_related('customer', 'agent')
+                    .prefetch_related('messages__author').get(id=conversation.id)
+                ).data
+            ))
+            fast_time, fast_json = self._measure(options['rounds'], lambda: renderer.render(
+                serialize_conversation(
+                    Conversation.objects.select_related('customer', 'agent').get(id=conversation.id)
+                )
+            ))
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{options['messages']} mensagens, {len(drf_json)} bytes de JSON")
+        self.stdout.write(f"DRF:    {drf_time * 1000:.1f} ms por resposta")
+        self.stdout.write(f"Rápido: {fast_time * 1000:.1f} ms por resposta ({drf_time / fast_time:.1f}x)")
+        if drf_json == fast_json:
+            self.stdout.write(self.style.SUCCESS('JSON idêntico'))
+        else:
+            self.stdout.write(self.style.ERROR('JSON divergente entre os serializadores'))
+
+    @staticmethod
+    def _measure(rounds, func):
+        best, output = None, None
+        for _ in range(rounds):
+            started = time.perf_counter()
+            output = func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, output
+
+    @staticmethod
+    def _build_conversation(count):
+        customer = User.objects.create_user(username=f'bench-{uuid.uuid4().hex[:12]}', email='bench@example.com')
+        agent = User.objects.create_user(username=f'bench-{uuid.uuid4().hex[:12]}', email='agent@example.com')
+        conversation = Conversation.objects.create(customer=customer, agent=agent)
+        start = timezone.now()
+        Message.objects.bulk_create([
+            Message(
+                conversation=conversation,
+                direction=Message.INBOUND if i % 2 else Message.OUTBOUND,
+                content=f'Mensagem {i}',
+                timestamp=start + timedelta(milliseconds=i),
+                author=customer if i % 2 else agent
+            )
+            for i in range(count)
+        ], batch_size=1000)
+        return conversation
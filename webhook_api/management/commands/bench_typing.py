@@ -0,0 +1,55 @@
+import asyncio
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from webhook_api.consumers import conversation_group
+from webhook_api.presence import typing_coalescer
+
+
+class Command(BaseCommand):
+    help = ('Carga de frames de digitação no TypingCoalescer para frequências '
+            'crescentes, mostrando que os broadcasts por conversa ficam limitados '
+            'a um por intervalo. Requer Redis e o channel layer configurado; usa '
+            'conversas sintéticas sem ouvintes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=20, help='Conversas simultâneas')
+        parser.add_argument('--users', type=int, default=5, help='Usuários digitando por conversa')
+        parser.add_argument('--rates', type=float, nargs='+', default=[1, 5, 20, 50],
+                            help='Frames de digitação por segundo por usuário')
+        parser.add_argument('--duration', type=float, default=5.0, help='Segundos por frequência')
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{options['conversations']} conversas x {options['users']} usuários, "
+            f"intervalo {typing_coalescer.interval * 1000:.0f} ms, {options['duration']:.1f} s por frequência"
+        )
+        for rate in options['rates']:
+            report = asyncio.run(self._run(options['conversations'], options['users'], rate, options['duration']))
+            self.stdout.write(
+                f"{rate:>6.1f} frames/s/usuário  frames {report['frames']:>8.0f}/s  "
+                f"broadcasts {report['broadcasts']:>7.1f}/s  "
+                f"por conversa {report['broadcasts'] / options['conversations']:.2f}/s"
+            )
+
+    async def _run(self, conversations, users, rate, duration):
+        groups = [conversation_group(uuid.uuid4()) for _ in range(conversations)]
+        before = typing_coalescer.stats()
+        deadline = time.perf_counter() + duration
+
+        async def user(group, user_id):
+            while time.perf_counter() < deadline:
+                await typing_coalescer.update(group, user_id)
+                await asyncio.sleep(1 / rate)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(group, user_id) for group in groups for user_id in range(1, users + 1)))
+        elapsed = time.perf_counter() - started
+        # Aguarda os broadcasts agendados do último intervalo
+        while typing_coalescer.stats()['pending']:
+            await asyncio.sleep(typing_coalescer.interval / 10)
+        after = typing_coalescer.stats()
+        return {
+            'frames': (after['frames'] - before['frames']) / elapsed,
+            'broadcasts': (after['broadcasts'] - before['broadcasts']) / elapsed
+        }
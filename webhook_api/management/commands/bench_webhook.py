@@ -0,0 +1,98 @@
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient
+from django.urls import reverse
+from webhook_api.auth import AuthService
+from webhook_api.models import Conversation
+
+
+class Command(BaseCommand):
+    help = ('Carga de NEW_MESSAGE em /webhook/ (view síncrona) e /webhook/async/ '
+            '(view assíncrona) pela aplicação ASGI, no próprio processo. Requer '
+            'Postgres e Redis; as mensagens são enfileiradas normalmente e o '
+            'usuário/conversa sintéticos (bench-*) permanecem no banco.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Requisições por view')
+        parser.add_argument('--concurrency', type=int, default=200, help='Requisições simultâneas')
+        parser.add_argument('--only', choices=['sync', 'async'], help='Mede apenas uma das views')
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(username=f'bench-{uuid.uuid4().hex[:12]}', email='bench@example.com')
+        conversation = Conversation.objects.create(customer=user)
+        token = AuthService.generate_token(user)
+        targets = [('sync', reverse('webhook')), ('async', reverse('webhook-async'))]
+        if options['only']:
+            targets = [target for target in targets if target[0] == options['only']]
+
+        results = asyncio.run(self._run(targets, token, conversation.id, options['requests'], options['concurrency']))
+
+        self.stdout.write(f"{options['requests']} requisições por view, concorrência {options['concurrency']}")
+        for name, report in results:
+            self.stdout.write(
+                f"{name:<6} {report['rps']:>8.1f} req/s  "
+                f"p50 {report['p50']:.1f} ms  p95 {report['p95']:.1f} ms  p99 {report['p99']:.1f} ms  "
+                f"status {report['statuses']}"
+            )
+        if len(results) == 2 and results[0][1]['rps']:
+            self.stdout.write(f"async/sync: {results[1][1]['rps'] / results[0][1]['rps']:.2f}x")
+
+    async def _run(self, targets, token, conversation_id, total, concurrency):
+        client = AsyncClient()
+        headers = {'Authorization': f'Bearer {token}'}
+        results = []
+        for name, path in targets:
+            # Aquecimento: caches de token e de estado da conversa
+            await self._send(client, path, headers, conversation_id)
+            results.append((name, await self._load(client, path, headers, conversation_id, total, concurrency)))
+        return results
+
+    async def _load(self, client, path, headers, conversation_id, total, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        statuses = {}
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                status_code = await self._send(client, path, headers, conversation_id)
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses[status_code] = statuses.get(status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return {
+            'rps': total / elapsed if elapsed else 0.0,
+            'p50': self._percentile(latencies, 50),
+            'p95': self._percentile(latencies, 95),
+            'p99': self._percentile(latencies, 99),
+            'statuses': statuses
+        }
+
+    @staticmethod
+    async def _send(client, path, headers, conversation_id):
+        payload = {
+            'type': 'NEW_MESSAGE',
+            'timestamp': datetime.utcnow().isoformat(),
+            'data': {
+                'id': str(uuid.uuid4()),
+                'content': 'bench',
+                'conversation_id': str(conversation_id)
+            }
+        }
+        response = await client.post(path, json.dumps(payload), content_type='application/json', headers=headers)
+        return response.status_code
+
+    @staticmethod
+    def _percentile(values, percentile):
+        if not values:
+            return 0.0
+        index = min(len(values) - 1, int(len(values) * percentile / 100))
+        return values[index]
@@ -0,0 +1,62 @@
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from django.core.management.base import BaseCommand
+from webhook_api.wire import pack_event, unpack_event
+
+
+class Command(BaseCommand):
+    help = ('Compara JSON e msgpack (subprotocolo realmate.msgpack.v1) nos frames '
+            'WebSocket: custo de codificação/decodificação e bytes por frame, para '
+            'mensagens isoladas e frames em lote. Não usa banco nem Redis.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=20000, help='Frames codificados por formato')
+        parser.add_argument('--batch', type=int, default=50, help='Mensagens por frame no cenário em lote')
+        parser.add_argument('--content-size', type=int, default=80, help='Tamanho do texto de cada mensagem')
+
+    def handle(self, *args, **options):
+        content = 'x' * options['content_size']
+        single = self._message(content, 0)
+        batch = {'type': 'batch', 'messages': [self._message(content, i) for i in range(options['batch'])]}
+        multiplexed = {'type': 'message', 'conversation_id': str(uuid.uuid4()), 'message': single}
+
+        self.stdout.write(f"{options['frames']} frames por formato, texto de {options['content_size']} caracteres")
+        for name, frame in (('single', single), ('mux', multiplexed), (f"batch{options['batch']}", batch)):
+            json_report = self._measure(frame, options['frames'], json.dumps, json.loads)
+            msgpack_report = self._measure(frame, options['frames'], pack_event, unpack_event)
+            for format_name, report in (('json', json_report), ('msgpack', msgpack_report)):
+                self.stdout.write(
+                    f"{name:<8} {format_name:<8} {report['bytes']:>7} bytes  "
+                    f"encode {report['encode_us']:>8.2f} us  decode {report['decode_us']:>8.2f} us"
+                )
+            self.stdout.write(f"{name:<8} msgpack/json: {msgpack_report['bytes'] / json_report['bytes']:.2f}x bytes")
+
+    @staticmethod
+    def _message(content, offset):
+        timestamp = datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=offset)
+        return {
+            'id': str(uuid.uuid4()),
+            'type': 'INBOUND',
+            'content': content,
+            'timestamp': timestamp.isoformat(),
+            'author': 1,
+            'seq': offset + 1
+        }
+
+    @staticmethod
+    def _measure(frame, count, encode, decode):
+        started = time.perf_counter()
+        for _ in range(count):
+            data = encode(frame)
+        encode_elapsed = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(count):
+            decode(data)
+        decode_elapsed = time.perf_counter() - started
+        return {
+            'bytes': len(data.encode() if isinstance(data, str) else data),
+            'encode_us': encode_elapsed / count * 1e6,
+            'decode_us': decode_elapsed / count * 1e6
+        }
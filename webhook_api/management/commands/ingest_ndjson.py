@@ -0,0 +1,46 @@
+import json
+import sys
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from webhook_api.batch import NdjsonIngestor
+
+
+class Command(BaseCommand):
+    help = 'Ingere eventos de webhook a partir de um arquivo NDJSON (um evento por linha).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Caminho do arquivo NDJSON ('-' para stdin)")
+        parser.add_argument('--user', required=True, help='Username do usuário autor dos eventos')
+        parser.add_argument('--chunk-size', type=int, default=settings.WEBHOOK_STREAM_CHUNK_SIZE,
+                            help='Número de eventos persistidos por bloco')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"Usuário '{options['user']}' não encontrado.")
+
+        ingestor = NdjsonIngestor(user, chunk_size=options['chunk_size'], on_progress=self._report)
+        if options['path'] == '-':
+            summary = ingestor.ingest(sys.stdin.buffer)
+        else:
+            try:
+                with open(options['path'], 'rb') as stream:
+                    summary = ingestor.ingest(stream)
+            except OSError as exc:
+                raise CommandError(str(exc))
+
+        for error in summary['errors']:
+            self.stderr.write(f"linha {error['line']}: {json.dumps(error['response'], ensure_ascii=False)}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Concluído: {summary['lines']} linhas, {summary['succeeded']} ok, "
+            f"{summary['failed']} erros em {summary['elapsed_seconds']}s "
+            f"({summary['events_per_second']} eventos/s)"
+        ))
+
+    def _report(self, summary):
+        self.stdout.write(
+            f"{summary['lines']} linhas, {summary['failed']} erros, "
+            f"{summary['events_per_second']} eventos/s"
+        )
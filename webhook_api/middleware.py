@@ -1,32 +1,134 @@
+from urllib.parse import parse_qsl, urlencode
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.deprecation import MiddlewareMixin
 from django.http import JsonResponse
 from rest_framework.exceptions import AuthenticationFailed
 from .auth import AuthService
-from django.urls import resolve
+from django.urls import NoReverseMatch, reverse
+
+# Subprotocolo que carrega o JWT no handshake WebSocket ('bearer.<jwt>')
+AUTH_SUBPROTOCOL_PREFIX = 'bearer.'
 
 class JWTAuthenticationMiddleware(MiddlewareMixin):
     """
     Middleware que extrai o token do header Authorization e seta request.user.
     Rotas que não precisam de auth podem ser filtradas por nome/URL.
+    O principal autenticado fica em request.jwt_auth e é reaproveitado pelo
+    JWTAuthentication do DRF, evitando autenticar a mesma requisição duas vezes.
     """
 
     EXEMPT_URL_NAMES = [
-        'register', 'login', 'webhook'
+        'register', 'login', 'webhook', 'webhook-async', 'webhook-batch', 'webhook-stream'
     ]
 
+    # Caminhos exatos das rotas isentas, resolvidos uma única vez: só essas
+    # rotas são isentas, nunca outras que apenas comecem com o mesmo caminho
+    _exempt_paths = None
+
+    @classmethod
+    def exempt_paths(cls):
+        if cls._exempt_paths is None:
+            try:
+                cls._exempt_paths = frozenset(reverse(name) for name in cls.EXEMPT_URL_NAMES)
+            except NoReverseMatch as exc:
+                raise ImproperlyConfigured(
+                    f'EXEMPT_URL_NAMES só aceita rotas sem parâmetros: {exc}'
+                ) from exc
+        return cls._exempt_paths
+
     def process_request(self, request):
+        token, response = self._extract_token(request)
+        if token is None:
+            return response
+        try:
+            user, payload = AuthService.authenticate_token(token)
+        except AuthenticationFailed as exc:
+            return JsonResponse({'error': str(exc)}, status=401)
+        self._set_principal(request, token, user, payload)
+
+    async def __acall__(self, request):
+        # Sob ASGI autentica no próprio event loop, sem o sync_to_async do MiddlewareMixin
+        token, response = self._extract_token(request)
+        if token is not None:
+            try:
+                user, payload = await AuthService.aauthenticate_token(token)
+            except AuthenticationFailed as exc:
+                return JsonResponse({'error': str(exc)}, status=401)
+            self._set_principal(request, token, user, payload)
+        return response or await self.get_response(request)
+
+    def _extract_token(self, request):
+        """Retorna (token, None), (None, resposta de erro) ou (None, None) para rotas isentas"""
         # Se a URL atual estiver na lista de isenções, não valida token
-        resolver_match = resolve(request.path_info)
-        if resolver_match.url_name in self.EXEMPT_URL_NAMES:
-            return None
+        if request.path_info in self.exempt_paths():
+            return None, None
 
         auth_header = request.META.get('HTTP_AUTHORIZATION', '')
         if not auth_header.startswith('Bearer '):
-            return JsonResponse({'error': 'Token não fornecido.'}, status=401)
+            return None, JsonResponse({'error': 'Token não fornecido.'}, status=401)
+        return auth_header.split(' ')[1], None
 
-        token = auth_header.split(' ')[1]
-        try:
-            user = AuthService.decode_token(token)
-            request.user = user
-        except AuthenticationFailed as exc:
-            return JsonResponse({'error': str(exc)}, status=401) 
\ No newline at end of file
+    @staticmethod
+    def _set_principal(request, token, user, payload):
+        request.user = user
+        request.jwt_auth = (token, user, payload)
+
+
+class JWTWebSocketMiddleware(BaseMiddleware):
+    """
+    Autenticação JWT do handshake WebSocket (Channels), no lugar do
+    AuthMiddlewareStack baseado em sessão.
+
+    O token vem, em ordem de preferência, no header 'Authorization: Bearer
+    <token>' (clientes nativos), no subprotocolo 'bearer.<token>' (navegadores
+    não enviam headers próprios no WebSocket:
+    new WebSocket(url, ['realmate.json.v1', 'bearer.' + token])) ou em
+    ?token=<jwt>. Este último é mantido por compatibilidade, mas a URL com o
+    token costuma ir parar nos logs de acesso de proxies e servidores; por
+    isso o token é removido do query string e dos subprotocolos antes do
+    roteamento e nunca chega aos consumers nem aos logs da aplicação.
+
+    Usa o cache de tokens verificados, então reconexões com um token já
+    visto não consultam o banco. scope['user'] recebe o usuário ou
+    AnonymousUser; a autorização por conversa fica nos consumers.
+    """
+
+    async def __call__(self, scope, receive, send):
+        token, scope = self._extract_token(scope)
+        scope['user'] = AnonymousUser()
+        if token:
+            try:
+                user, payload = await AuthService.aauthenticate_token(token)
+            except AuthenticationFailed:
+                pass
+            else:
+                scope['user'] = user
+                scope['jwt_auth'] = (token, user, payload)
+        return await super().__call__(scope, receive, send)
+
+    @staticmethod
+    def _extract_token(scope):
+        """Retorna (token ou None, cópia do scope sem o token)"""
+        scope = dict(scope)
+        token = None
+        for name, value in scope.get('headers', ()):
+            if name == b'authorization' and value.startswith(b'Bearer '):
+                token = value[len(b'Bearer '):].decode()
+                break
+
+        subprotocols = []
+        for subprotocol in scope.get('subprotocols', ()):
+            if subprotocol.startswith(AUTH_SUBPROTOCOL_PREFIX):
+                token = token or subprotocol[len(AUTH_SUBPROTOCOL_PREFIX):]
+            else:
+                subprotocols.append(subprotocol)
+        scope['subprotocols'] = subprotocols
+
+        params = parse_qsl(scope.get('query_string', b'').decode(), keep_blank_values=True)
+        query_tokens = [value for name, value in params if name == 'token']
+        if query_tokens:
+            token = token or query_tokens[0]
+            scope['query_string'] = urlencode([(name, value) for name, value in params if name != 'token']).encode()
+        return token, scope
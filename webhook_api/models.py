@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, connection
+from django.utils import timezone
 import uuid
 from django.contrib.auth.models import User
 
@@ -25,13 +26,106 @@ class Conversation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
-    # Relacionamentos com usuários
-    customer = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='customer_conversations')
-    agent = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='agent_conversations')
+    # Relacionamentos com usuários (indexados pelos índices compostos abaixo)
+    customer = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='customer_conversations', db_index=False)
+    agent = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='agent_conversations', db_index=False)
+    
+    class Meta:
+        indexes = [
+            # Conversas do cliente por updated_at (paginação por cursor)
+            models.Index(fields=['customer', 'updated_at', 'id'], name='conv_customer_updated_idx'),
+            # Caixa de entrada do agente por status
+            models.Index(fields=['agent', 'status', 'updated_at'], name='conv_agent_status_idx'),
+            # Apenas conversas abertas (fração pequena da tabela)
+            models.Index(
+                fields=['updated_at'], name='conv_open_updated_idx',
+                condition=models.Q(status='OPEN')
+            ),
+        ]
     
     def __str__(self):
         return f"Conversa {self.id} - {self.status}"
 
+class MessageManager(models.Manager):
+    # Linhas por INSERT em insert_ignoring_conflicts (7 parâmetros por linha,
+    # abaixo do limite de variáveis do SQLite)
+    INSERT_CHUNK_SIZE = 500
+
+    def insert_ignoring_conflicts(self, messages):
+        """
+        Insere as mensagens com INSERT ... ON CONFLICT (id) DO NOTHING
+        RETURNING id e retorna o conjunto (str) dos ids de fato inseridos;
+        as demais já existiam (reenvio concorrente).
+        """
+        meta = self.model._meta
+        fields = [meta.get_field(name) for name in (
+            'id', 'conversation', 'author', 'direction', 'content', 'timestamp', 'created_at'
+        )]
+        id_field = meta.get_field('id')
+        now = timezone.now()
+        for message in messages:
+            if message.created_at is None:
+                message.created_at = now
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        row = '(' + ', '.join(['%s'] * len(fields)) + ')'
+        inserted = set()
+        with connection.cursor() as cursor:
+            for start in range(0, len(messages), self.INSERT_CHUNK_SIZE):
+                chunk = messages[start:start + self.INSERT_CHUNK_SIZE]
+                sql = (
+                    f"INSERT INTO {connection.ops.quote_name(meta.db_table)} ({columns}) "
+                    f"VALUES {', '.join([row] * len(chunk))} "
+                    f"ON CONFLICT ({connection.ops.quote_name(id_field.column)}) DO NOTHING "
+                    f"RETURNING {connection.ops.quote_name(id_field.column)}"
+                )
+                params = [
+                    field.get_db_prep_save(getattr(message, field.attname), connection)
+                    for message in chunk
+                    for field in fields
+                ]
+                cursor.execute(sql, params)
+                inserted.update(str(id_field.to_python(value)) for value, in cursor.fetchall())
+        return inserted
+
+    def insert_if_conversation_open(self, message_id, conversation_id, direction, content, timestamp, author_id):
+        """
+        Insere a mensagem em um único comando (INSERT ... SELECT ... ON CONFLICT
+        DO NOTHING), apenas se a conversa existir e estiver aberta.
+        Retorna True se a mensagem foi inserida; False se ela já existia ou se
+        a conversa não existe/está fechada.
+        """
+        conversation_table = Conversation._meta.db_table
+        meta = self.model._meta
+
+        def column(name):
+            return connection.ops.quote_name(meta.get_field(name).column)
+
+        def prep(name, value):
+            return meta.get_field(name).get_db_prep_save(value, connection)
+
+        sql = (
+            f"INSERT INTO {connection.ops.quote_name(meta.db_table)} "
+            f"({column('id')}, {column('conversation')}, {column('author')}, {column('direction')}, "
+            f"{column('content')}, {column('timestamp')}, {column('created_at')}) "
+            f"SELECT %s, c.id, %s, %s, %s, %s, %s FROM {connection.ops.quote_name(conversation_table)} c "
+            f"WHERE c.id = %s AND c.status = %s "
+            f"ON CONFLICT ({column('id')}) DO NOTHING"
+        )
+        params = [
+            prep('id', message_id),
+            author_id,
+            direction,
+            content,
+            prep('timestamp', timestamp),
+            prep('created_at', timezone.now()),
+            Conversation._meta.get_field('id').get_db_prep_save(conversation_id, connection),
+            Conversation.OPEN,
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount == 1
+
+
 class Message(models.Model):
     # Tipos de mensagem: INBOUND (recebida pelo webhook) e OUTBOUND (gerada internamente)
     INBOUND = 'INBOUND'
@@ -42,7 +136,8 @@ class Message(models.Model):
     ]
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
+    # Indexada pelo índice composto (conversation, timestamp, id)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages', db_index=False)
     # Autor da mensagem: cliente ou agente
     author = models.ForeignKey(
         'auth.User', on_delete=models.SET_NULL, null=True, blank=True, related_name='messages'
@@ -52,8 +147,14 @@ class Message(models.Model):
     timestamp = models.DateTimeField()
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = MessageManager()
+    
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Paginação por cursor do histórico: faixa por (conversa, timestamp, id)
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conv_ts_id_idx'),
+        ]
 
     def __str__(self):
         return f"Mensagem {self.id} - {self.direction}" 
\ No newline at end of file
@@ -0,0 +1,55 @@
+import json
+import time
+from .connections import get_redis
+
+# Hash message_id -> JSON {item, recorded_at} das mensagens persistidas cujo
+# despacho (notificação WebSocket + buffer de agrupamento) não foi confirmado
+DISPATCH_OUTBOX_KEY = 'dispatch:outbox'
+
+
+class DispatchOutbox:
+    """
+    Registro no Redis das mensagens que ainda precisam ser despachadas.
+
+    Os itens são gravados antes do commit do lote e removidos quando o
+    despacho termina. Se o despacho falhar depois do commit (worker morto,
+    Redis ou broker fora), a reentrega periódica encontra os itens pendentes
+    e despacha de novo as mensagens que de fato foram gravadas; a entrega é
+    pelo menos uma vez.
+    """
+
+    def __init__(self, redis_client, key=DISPATCH_OUTBOX_KEY):
+        self.redis = redis_client
+        self.key = key
+
+    def record(self, items):
+        """Registra itens de despacho (payload de handle_persisted_messages)"""
+        if not items:
+            return
+        now = time.time()
+        self.redis.hset(self.key, mapping={
+            item['message']['id']: json.dumps({'item': item, 'recorded_at': now})
+            for item in items
+        })
+
+    def ack(self, message_ids):
+        """Remove itens já despachados (ou descartados)"""
+        if message_ids:
+            self.redis.hdel(self.key, *message_ids)
+
+    def pending(self, older_than, limit=None):
+        """Retorna {message_id: item} dos itens registrados há mais de older_than segundos"""
+        cutoff = time.time() - older_than
+        pending = {}
+        for message_id, raw in self.redis.hscan_iter(self.key):
+            entry = json.loads(raw)
+            if entry['recorded_at'] > cutoff:
+                continue
+            pending[message_id.decode() if isinstance(message_id, bytes) else message_id] = entry['item']
+            if limit and len(pending) >= limit:
+                break
+        return pending
+
+
+# Outbox compartilhado do processo
+dispatch_outbox = DispatchOutbox(get_redis())
@@ -0,0 +1,94 @@
+import base64
+import json
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+
+class KeysetPaginator:
+    """
+    Paginação por cursor (keyset) sobre uma chave composta (timestamp, id).
+
+    Cada página é uma leitura por faixa do índice: o cursor guarda a chave do
+    último (ou primeiro) item visto e a próxima consulta filtra a partir dela,
+    sem OFFSET. Os itens de cada página são sempre retornados em ordem
+    crescente; 'previous' aponta para itens mais antigos e 'next' para itens
+    mais novos. Aceita querysets de instâncias ou de .values() (dicts).
+    """
+
+    def __init__(self, page_size, max_page_size, time_field='timestamp', id_field='id'):
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.time_field = time_field
+        self.id_field = id_field
+
+    @staticmethod
+    def encode_cursor(timestamp, pk):
+        raw = json.dumps({'t': timestamp.isoformat(), 'id': str(pk)})
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.fromisoformat(data['t']), data['id']
+        except (ValueError, KeyError, TypeError):
+            raise ValidationError({
+                'error': 'Cursor inválido',
+                'received': cursor
+            })
+
+    def get_page_size(self, query_params):
+        raw = query_params.get('page_size')
+        if raw is None:
+            return self.page_size
+        try:
+            size = int(raw)
+        except ValueError:
+            raise ValidationError({
+                'error': 'page_size deve ser um inteiro',
+                'received': raw
+            })
+        return max(1, min(size, self.max_page_size))
+
+    def paginate(self, queryset, query_params):
+        """
+        Retorna (itens, previous_cursor, next_cursor).
+        Sem cursor retorna a página mais recente; ?before=<cursor> pagina para
+        trás e ?after=<cursor> para frente.
+        """
+        page_size = self.get_page_size(query_params)
+        before = query_params.get('before')
+        after = query_params.get('after')
+        if before and after:
+            raise ValidationError({'error': 'Use apenas um dos parâmetros before ou after'})
+
+        t, pk = self.time_field, self.id_field
+        if after:
+            timestamp, key = self.decode_cursor(after)
+            queryset = queryset.filter(Q(**{f'{t}__gt': timestamp}) | Q(**{t: timestamp, f'{pk}__gt': key}))
+            rows = list(queryset.order_by(t, pk)[:page_size + 1])
+            has_more = len(rows) > page_size
+            items = rows[:page_size]
+            has_newer, has_older = has_more, True
+        else:
+            if before:
+                timestamp, key = self.decode_cursor(before)
+                queryset = queryset.filter(Q(**{f'{t}__lt': timestamp}) | Q(**{t: timestamp, f'{pk}__lt': key}))
+            rows = list(queryset.order_by(f'-{t}', f'-{pk}')[:page_size + 1])
+            has_more = len(rows) > page_size
+            items = list(reversed(rows[:page_size]))
+            has_newer, has_older = bool(before), has_more
+
+        previous_cursor = next_cursor = None
+        if items:
+            first, last = items[0], items[-1]
+            if has_older:
+                previous_cursor = self.encode_cursor(self._field(first, t), self._field(first, pk))
+            if has_newer:
+                next_cursor = self.encode_cursor(self._field(last, t), self._field(last, pk))
+        return items, previous_cursor, next_cursor
+
+    @staticmethod
+    def _field(item, name):
+        return item[name] if isinstance(item, dict) else getattr(item, name)
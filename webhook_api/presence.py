@@ -0,0 +1,155 @@
+"""
+Indicadores de digitação e presença dos WebSockets de conversa.
+
+Nenhum dos dois faz um group_send por frame do cliente:
+
+- digitação: cada frame só grava o prazo do usuário em um hash do Redis; a
+  primeira atualização de um intervalo adquire uma trava (SET NX PX) e o
+  processo que a obteve publica, ao fim do intervalo, um único evento com
+  quem está digitando. São no máximo um broadcast por conversa por
+  intervalo, em todo o cluster, qualquer que seja a frequência de digitação;
+- presença: hash por conversa com um campo por conexão e o instante do
+  último heartbeat; campos sem heartbeat dentro do TTL são ignorados (e
+  removidos) nas leituras. Só entradas e saídas de usuários geram evento.
+"""
+import asyncio
+import logging
+import threading
+import time
+from django.conf import settings
+from channels.layers import get_channel_layer
+from .connections import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+class TypingCoalescer:
+    """Agrupa os frames de digitação em no máximo um broadcast por grupo por intervalo"""
+
+    def __init__(self, redis_client, interval, ttl, prefix='typing:'):
+        self.redis = redis_client
+        # Intervalo entre broadcasts de um grupo (s) e validade de um "digitando" (s)
+        self.interval = interval
+        self.ttl = ttl
+        self.prefix = prefix
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._counters = {'frames': 0, 'broadcasts': 0}
+
+    def key(self, group):
+        return f"{self.prefix}{group}"
+
+    def gate_key(self, group):
+        return f"{self.prefix}{group}:gate"
+
+    async def update(self, group, user_id, typing=True):
+        """Registra que o usuário está (ou deixou de estar) digitando no grupo"""
+        key = self.key(group)
+        pipe = self.redis.pipeline(transaction=False)
+        if typing:
+            pipe.hset(key, str(user_id), time.time() + self.ttl)
+        else:
+            pipe.hdel(key, str(user_id))
+        pipe.expire(key, int(self.ttl + self.interval) + 1)
+        pipe.set(self.gate_key(group), 1, nx=True, px=int(self.interval * 1000))
+        acquired = (await pipe.execute())[-1]
+        self._count(frames=1)
+        if acquired:
+            task = asyncio.ensure_future(self._flush_later(group))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def typing_users(self, group):
+        """Ids dos usuários digitando no grupo (remove os vencidos)"""
+        entries = await self.redis.hgetall(self.key(group))
+        now = time.time()
+        expired = [user_id for user_id, deadline in entries.items() if float(deadline) <= now]
+        if expired:
+            await self.redis.hdel(self.key(group), *expired)
+        return sorted(int(user_id) for user_id, deadline in entries.items() if float(deadline) > now)
+
+    async def _flush_later(self, group):
+        await asyncio.sleep(self.interval)
+        try:
+            users = await self.typing_users(group)
+            await get_channel_layer().group_send(group, {
+                'type': 'typing',
+                'group': group,
+                'users': users,
+                'expires_in': self.ttl
+            })
+        except Exception:
+            # O próximo frame de digitação após o intervalo agenda outro broadcast
+            logger.exception('Falha ao publicar digitação em %s', group)
+            return
+        self._count(broadcasts=1)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters['pending'] = len(self._tasks)
+        return counters
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                self._counters[name] += value
+
+
+class PresenceStore:
+    """Presença por grupo em um hash do Redis renovado por heartbeats"""
+
+    def __init__(self, redis_client, ttl, prefix='presence:'):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def key(self, group):
+        return f"{self.prefix}{group}"
+
+    @staticmethod
+    def field(user_id, connection):
+        return f"{user_id}:{connection}"
+
+    async def heartbeat(self, group, user_id, connection):
+        """
+        Marca a conexão como ativa. Retorna (usuários online, entrou), onde
+        'entrou' indica que o usuário não tinha outra conexão ativa no grupo.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hgetall(self.key(group))
+        pipe.hset(self.key(group), self.field(user_id, connection), time.time())
+        pipe.expire(self.key(group), self.ttl)
+        entries = (await pipe.execute())[0]
+        before = await self._online(group, entries)
+        return sorted(before | {user_id}), user_id not in before
+
+    async def leave(self, group, user_id, connection):
+        """Remove a conexão. Retorna (usuários online, saiu)"""
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hdel(self.key(group), self.field(user_id, connection))
+        pipe.hgetall(self.key(group))
+        entries = (await pipe.execute())[1]
+        after = await self._online(group, entries)
+        return sorted(after), user_id not in after
+
+    async def online(self, group):
+        return sorted(await self._online(group, await self.redis.hgetall(self.key(group))))
+
+    async def _online(self, group, entries):
+        """Usuários com heartbeat dentro do TTL (remove os campos vencidos)"""
+        cutoff = time.time() - self.ttl
+        expired = [field for field, seen in entries.items() if float(seen) <= cutoff]
+        if expired:
+            await self.redis.hdel(self.key(group), *expired)
+        return {
+            int(field.split(b':', 1)[0]) for field, seen in entries.items() if float(seen) > cutoff
+        }
+
+
+typing_coalescer = TypingCoalescer(
+    get_async_redis(),
+    interval=settings.WS_TYPING_INTERVAL_MS / 1000,
+    ttl=settings.WS_TYPING_TTL
+)
+
+presence_store = PresenceStore(get_async_redis(), ttl=settings.WS_PRESENCE_TTL)
@@ -0,0 +1,197 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from django.conf import settings
+from channels.layers import get_channel_layer
+from .connections import connections
+from .replay import event_log
+
+logger = logging.getLogger(__name__)
+
+
+class FanoutPublisher:
+    """
+    Publicador de eventos new_message em lotes, um por processo.
+
+    publish() apenas enfileira em memória e retorna; o envio acontece no
+    loop persistente de connections.py ao completar max_batch eventos ou
+    após max_delay segundos desde o primeiro pendente. Cada descarga agrupa
+    os eventos por grupo e envia um único evento new_messages por conversa
+    (uma ida ao Redis por conversa, com as conversas em paralelo), depois de
+    numerar os eventos no event_log (replay.py). As descargas são
+    serializadas, o que preserva a ordem dentro de cada conversa. Acima de
+    max_pending eventos o publish() espera a descarga.
+
+    No máximo max_concurrency group_send ficam em voo ao mesmo tempo (o
+    tamanho do pool do channel layer). Um grupo que falha é tentado de novo
+    até max_attempts vezes; se ainda assim falhar, seus eventos (já
+    numerados) voltam para a frente da próxima descarga em vez de serem
+    descartados.
+    """
+
+    def __init__(self, max_batch, max_delay, max_pending, max_concurrency, max_attempts, retry_delay):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        # Eventos já numerados cuja entrega falhou: {grupo: [mensagem, ...]}
+        self._retry = {}
+        self._timer_armed = False
+        # Descarga agendada por max_delay (só tocado dentro do loop persistente)
+        self._timer = None
+        # Criados dentro do loop persistente na primeira descarga
+        self._flush_lock = None
+        self._send_slots = None
+        self._counters = {
+            'messages': 0, 'flushes': 0, 'group_sends': 0, 'retries': 0,
+            'failures': 0, 'requeued': 0, 'dropped': 0
+        }
+
+    def publish(self, group, message):
+        """Enfileira o evento para o grupo; a ordem entre chamadas é preservada"""
+        with self._lock:
+            self._pending.append((group, message))
+            size = len(self._pending)
+            # A descarga em linha já leva tudo: não agenda a descarga por tempo
+            arm_timer = size < self.max_pending and not self._timer_armed
+            if arm_timer:
+                self._timer_armed = True
+        if size >= self.max_pending:
+            # Contrapressão: não acumula sem limite se o Redis estiver lento
+            self.flush()
+            return
+        loop = connections.event_loop()
+        if size >= self.max_batch:
+            loop.call_soon_threadsafe(self._start_flush)
+        elif arm_timer:
+            loop.call_soon_threadsafe(self._arm_timer)
+
+    def flush(self, timeout=None):
+        """Envia tudo o que está pendente e aguarda a entrega (uso síncrono)"""
+        connections.run(self._flush(), timeout=settings.CHANNEL_LAYER_PUBLISH_TIMEOUT if timeout is None else timeout)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters['pending'] = len(self._pending) + sum(len(messages) for messages in self._retry.values())
+        return counters
+
+    def _arm_timer(self):
+        with self._lock:
+            if not self._timer_armed:
+                # Uma descarga já levou os eventos antes do agendamento
+                return
+        self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._start_flush)
+
+    def _start_flush(self):
+        asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+            self._send_slots = asyncio.Semaphore(self.max_concurrency)
+        async with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                retry, self._retry = self._retry, {}
+                self._timer_armed = False
+            if self._timer is not None:
+                # Os pendentes saem nesta descarga: a descarga por tempo fica sem objeto
+                self._timer.cancel()
+                self._timer = None
+            if not batch and not retry:
+                return
+            by_group = {}
+            for group, message in batch:
+                by_group.setdefault(group, []).append(message)
+            if by_group:
+                try:
+                    # Sequência por conversa e log recente para retomada de conexões
+                    await event_log.append(by_group)
+                except Exception:
+                    logger.exception('Falha ao registrar %s eventos no log de retomada', len(batch))
+            # Eventos da descarga anterior que falharam vão antes dos novos do mesmo grupo
+            for group, messages in retry.items():
+                by_group[group] = messages + by_group.get(group, [])
+            channel_layer = get_channel_layer()
+            results = await asyncio.gather(*(
+                self._send(channel_layer, group, messages) for group, messages in by_group.items()
+            ))
+            failed = {}
+            for (group, messages), error in zip(by_group.items(), results):
+                if error is not None:
+                    logger.error('Falha ao publicar %s eventos no grupo %s: %s', len(messages), group, error)
+                    failed[group] = messages
+            self._requeue(failed)
+            with self._lock:
+                self._counters['messages'] += len(batch)
+                self._counters['flushes'] += 1
+                self._counters['group_sends'] += len(by_group)
+                self._counters['failures'] += len(failed)
+
+    async def _send(self, channel_layer, group, messages):
+        """Envia o evento do grupo com novas tentativas; retorna o último erro ou None"""
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                with self._lock:
+                    self._counters['retries'] += 1
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                async with self._send_slots:
+                    await channel_layer.group_send(group, {'type': 'new_messages', 'group': group, 'messages': messages})
+                return None
+            except Exception as exc:
+                error = exc
+        return error
+
+    def _requeue(self, failed):
+        """Devolve os grupos que falharam para a próxima descarga (até max_pending eventos)"""
+        if not failed:
+            return
+        requeued = dropped = 0
+        with self._lock:
+            backlog = sum(len(messages) for messages in self._retry.values())
+            for group, messages in failed.items():
+                if backlog + len(messages) > self.max_pending:
+                    # Redis indisponível por muito tempo: os clientes recuperam pelo since=
+                    dropped += len(messages)
+                    continue
+                self._retry[group] = messages
+                backlog += len(messages)
+                requeued += len(messages)
+            self._counters['requeued'] += requeued
+            self._counters['dropped'] += dropped
+        if dropped:
+            logger.error('Descartando %s eventos após falhas repetidas de publicação', dropped)
+        if requeued:
+            asyncio.get_running_loop().call_later(self.retry_delay, self._start_flush)
+
+
+fanout_publisher = FanoutPublisher(
+    max_batch=settings.WS_PUBLISH_MAX_BATCH,
+    max_delay=settings.WS_PUBLISH_MAX_DELAY_MS / 1000,
+    max_pending=settings.WS_PUBLISH_MAX_PENDING,
+    max_concurrency=settings.CHANNEL_LAYER_MAX_CONNECTIONS,
+    max_attempts=settings.WS_PUBLISH_MAX_ATTEMPTS,
+    retry_delay=settings.WS_PUBLISH_RETRY_DELAY_MS / 1000
+)
+
+
+@atexit.register
+def _flush_on_exit():
+    if fanout_publisher.stats()['pending']:
+        try:
+            fanout_publisher.flush()
+        except Exception:
+            logger.exception('Falha ao descarregar eventos pendentes na saída')
@@ -0,0 +1,95 @@
+import json
+from django.conf import settings
+from .connections import get_async_redis
+
+# Numera e grava no stream do grupo, atomicamente, um lote de eventos.
+# KEYS[1] = contador de sequência, KEYS[2] = stream do grupo
+# ARGV = tamanho máximo do stream, TTL (s), payloads JSON...
+APPEND_EVENTS_SCRIPT = """
+local count = #ARGV - 2
+local first = redis.call('INCRBY', KEYS[1], count) - count + 1
+for i = 0, count - 1 do
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], (first + i) .. '-0', 'm', ARGV[i + 3])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return first
+"""
+
+
+class EventLog:
+    """
+    Log recente de eventos por grupo WebSocket, para retomar conexões.
+
+    Cada evento publicado recebe um número de sequência crescente por grupo
+    (INCRBY) e é gravado em um stream do Redis limitado a max_len entradas,
+    cujo id é a própria sequência. Um cliente que reconecta informando a
+    última sequência vista recebe só o que perdeu; se o trecho já saiu do
+    stream, read_since informa que o histórico está incompleto.
+    """
+
+    def __init__(self, redis_client, max_len, ttl, prefix='events:'):
+        self.redis = redis_client
+        self.max_len = max_len
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def seq_key(self, group):
+        return f"{self.prefix}{group}:seq"
+
+    def stream_key(self, group):
+        return f"{self.prefix}{group}"
+
+    async def append(self, messages_by_group):
+        """
+        Numera {group: [message, ...]} em um único round-trip, gravando a
+        sequência em message['seq'] na ordem de cada lista.
+        """
+        script = self.redis.register_script(APPEND_EVENTS_SCRIPT)
+        pipe = self.redis.pipeline(transaction=False)
+        groups = list(messages_by_group)
+        for group in groups:
+            payloads = [json.dumps(message) for message in messages_by_group[group]]
+            await script(
+                keys=[self.seq_key(group), self.stream_key(group)],
+                args=[self.max_len, self.ttl, *payloads],
+                client=pipe
+            )
+        for group, first in zip(groups, await pipe.execute()):
+            for offset, message in enumerate(messages_by_group[group]):
+                message['seq'] = int(first) + offset
+
+    async def last_seq(self, group):
+        value = await self.redis.get(self.seq_key(group))
+        return int(value) if value is not None else 0
+
+    async def read_since(self, group, since):
+        """
+        Retorna (mensagens com seq > since, última sequência, completo).
+        'completo' é falso quando parte do intervalo já foi descartada do
+        stream ou quando since não pertence à numeração atual.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get(self.seq_key(group))
+        pipe.xrange(self.stream_key(group), min=f"{since + 1}-0", max='+', count=self.max_len)
+        raw_last, entries = await pipe.execute()
+        last = int(raw_last) if raw_last is not None else 0
+        if since >= last:
+            return [], last, since == last
+        messages = []
+        for entry_id, fields in entries:
+            message = json.loads(fields[b'm'])
+            message['seq'] = int(entry_id.split(b'-')[0])
+            messages.append(message)
+        complete = (
+            len(messages) == last - since
+            and messages[0]['seq'] == since + 1
+        )
+        return messages, last, complete
+
+
+event_log = EventLog(
+    get_async_redis(),
+    max_len=settings.WS_REPLAY_BUFFER_SIZE,
+    ttl=settings.WS_REPLAY_TTL
+)
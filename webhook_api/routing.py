@@ -1,6 +1,7 @@
 from django.urls import re_path
-from .consumers import ConversationConsumer
+from .consumers import ConversationConsumer, MultiplexConsumer
 
 websocket_urlpatterns = [
+    re_path(r'ws/conversations/$', MultiplexConsumer.as_asgi()),
     re_path(r'ws/conversations/(?P<conversation_id>[^/]+)/$', ConversationConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import weakref
+from collections import deque
+
+# Filas ativas do processo e contadores acumulados, para /webhook-stats/
+_active_queues = weakref.WeakSet()
+_totals_lock = threading.Lock()
+_totals = {'dropped': 0, 'coalesced': 0, 'disconnected': 0, 'max_depth_seen': 0}
+
+
+class QueueOverflow(Exception):
+    """Fila cheia com a política 'disconnect'; since é a última sequência entregue"""
+
+    def __init__(self, since):
+        super().__init__(since)
+        self.since = since
+
+
+class OutboundQueue:
+    """
+    Fila de saída limitada de uma conexão WebSocket.
+
+    Os handlers do consumer só enfileiram (sem aguardar o cliente) e uma
+    corotina escritora dedicada esvazia a fila, de modo que um cliente lento
+    não bloqueia o recebimento de eventos do channel layer. Com a fila cheia:
+
+    - coalesce: descarta o acumulado e o substitui por um único frame
+      {'type': 'gap', 'since': <seq>} indicando de onde o cliente deve
+      retomar (?since=<seq>);
+    - drop_oldest: descarta o frame mais antigo;
+    - disconnect: levanta QueueOverflow com a sequência para retomada.
+    """
+
+    COALESCE = 'coalesce'
+    DROP_OLDEST = 'drop_oldest'
+    DISCONNECT = 'disconnect'
+    POLICIES = (COALESCE, DROP_OLDEST, DISCONNECT)
+
+    def __init__(self, max_size, policy):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Política de estouro desconhecida: {policy} (esperado: {', '.join(self.POLICIES)})")
+        self.max_size = max_size
+        self.policy = policy
+        # (frame, seq) na ordem de envio
+        self._frames = deque()
+        self._ready = asyncio.Event()
+        # Menor sequência pendente de retomada após um coalesce
+        self._gap_since = None
+        # Última sequência entregue ao cliente
+        self.sent_seq = None
+        self.max_depth = 0
+        self.closed = False
+        _active_queues.add(self)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, seq=None):
+        """Enfileira o frame (seq = sequência da mensagem, se houver)"""
+        if self.closed:
+            return
+        if len(self._frames) >= self.max_size:
+            self._overflow()
+        self._frames.append((frame, seq))
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._ready.set()
+
+    def _overflow(self):
+        if self.policy == self.DISCONNECT:
+            self.close()
+            _count('disconnected', 1)
+            raise QueueOverflow(self._resume_from())
+        if self.policy == self.DROP_OLDEST:
+            self._frames.popleft()
+            _count('dropped', 1)
+            return
+        since = self._resume_from()
+        if self._gap_since is None or (since is not None and since < self._gap_since):
+            self._gap_since = since
+        _count('coalesced', len(self._frames))
+        self._frames.clear()
+
+    def _resume_from(self):
+        """Sequência a partir da qual o cliente deve retomar"""
+        if self._gap_since is not None:
+            return self._gap_since
+        # Eventos ao vivo podem chegar fora de ordem: retoma antes do menor pendente
+        pending = [seq for _, seq in self._frames if seq is not None]
+        if pending:
+            return min(pending) - 1
+        return self.sent_seq
+
+    def close(self):
+        """Descarta os frames pendentes e ignora os próximos"""
+        if self.closed:
+            return
+        self.closed = True
+        self._frames.clear()
+        _active_queues.discard(self)
+        with _totals_lock:
+            _totals['max_depth_seen'] = max(_totals['max_depth_seen'], self.max_depth)
+
+    async def get_batch(self, max_batch):
+        """Aguarda e retira até max_batch frames (com o aviso de lacuna, se houver)"""
+        while not self._frames and self._gap_since is None:
+            self._ready.clear()
+            await self._ready.wait()
+        frames = []
+        if self._gap_since is not None:
+            frames.append({'type': 'gap', 'since': self._gap_since})
+            self._gap_since = None
+        while self._frames and len(frames) < max_batch:
+            frame, seq = self._frames.popleft()
+            frames.append(frame)
+            if seq is not None:
+                self.sent_seq = seq if self.sent_seq is None else max(self.sent_seq, seq)
+        return frames
+
+
+def _count(name, value):
+    with _totals_lock:
+        _totals[name] += value
+
+
+def send_queue_stats():
+    """Profundidade das filas de saída ativas e descartes acumulados do processo"""
+    queues = list(_active_queues)
+    depths = [len(queue) for queue in queues]
+    with _totals_lock:
+        totals = dict(_totals)
+    return {
+        'connections': len(queues),
+        'queued': sum(depths),
+        'max_depth': max(depths, default=0),
+        **totals,
+        'max_depth_seen': max([totals['max_depth_seen'], *(queue.max_depth for queue in queues)])
+    }
@@ -28,4 +28,13 @@ class ConversationSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
-        fields = ['id', 'status', 'customer', 'agent', 'messages', 'created_at', 'updated_at'] 
\ No newline at end of file
+        fields = ['id', 'status', 'customer', 'agent', 'messages', 'created_at', 'updated_at']
+
+class ConversationHeaderSerializer(serializers.ModelSerializer):
+    """Cabeçalho da conversa, sem o histórico de mensagens"""
+    customer = UserSerializer(read_only=True)
+    agent = UserSerializer(read_only=True)
+    
+    class Meta:
+        model = Conversation
+        fields = ['id', 'status', 'customer', 'agent', 'created_at', 'updated_at']
@@ -0,0 +1,22 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .auth import token_cache
+from .conversation_state import invalidate_conversation_state
+from .models import Conversation
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_tokens(sender, instance, **kwargs):
+    """Descarta tokens em cache do usuário alterado ou removido, em todos os processos"""
+    user_id = instance.id
+    # Após o commit: quem recarregar o usuário já vê a alteração
+    transaction.on_commit(lambda: token_cache.invalidate_user(user_id))
+
+
+@receiver(post_delete, sender=Conversation)
+def invalidate_deleted_conversation(sender, instance, **kwargs):
+    """Remove do cache o estado de conversas apagadas (admin, cascata)"""
+    invalidate_conversation_state(instance.id)
@@ -1,16 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
 import uuid
 from datetime import datetime
-from celery import shared_task
 import redis
+from celery import shared_task
+from celery.signals import worker_process_shutdown
 from django.conf import settings
+from django.db import InterfaceError, OperationalError
 from .event_handlers import NewMessageEvent
 from .models import Message, Conversation
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
+from .touch import touch_conversation, coalesce_touches
+from .connections import get_redis, get_async_redis
+from .publisher import fanout_publisher
+from .outbox import dispatch_outbox
+from .consumers import conversation_group
+from .grouping import GroupingScheduler, InboundBuffer, current_time, get_grouping_policy
+from .wire import format_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Cliente Redis compartilhado do processo (pool limitado, ver connections.py)
+redis_client = get_redis()
+
+# Fila de NEW_MESSAGE pendentes de persistência e flag de drenagem agendada
+INBOUND_QUEUE_KEY = 'inbound:queue'
+INBOUND_DRAIN_SCHEDULED_KEY = 'inbound:queue:scheduled'
+# Lotes retirados da fila e ainda não confirmados: uma lista por lote
+# (inbound:processing:<id>) e um sorted set id -> instante da retirada
+INBOUND_PROCESSING_PREFIX = 'inbound:processing:'
+INBOUND_CLAIMS_KEY = 'inbound:processing'
+# Itens abandonados (inválidos, rejeitados ou após INBOUND_MAX_ATTEMPTS falhas
+# transitórias) e tentativas por item (campo = sha1 do item cru)
+INBOUND_DEAD_LETTER_KEY = 'inbound:dead_letter'
+INBOUND_ATTEMPTS_KEY = 'inbound:attempts'
+
+# Move até N itens do início da fila para a lista de processamento do lote.
+# KEYS[1] = fila, KEYS[2] = lista do lote, KEYS[3] = lotes em processamento
+# ARGV = N, agora (epoch), id do lote
+CLAIM_INBOUND_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+    return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+redis.call('RPUSH', KEYS[2], unpack(items))
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[3])
+return items
+"""
+
+# Devolve os itens de um lote ao início da fila, na ordem original.
+# KEYS[1] = fila, KEYS[2] = lista do lote, KEYS[3] = lotes em processamento
+# ARGV = id do lote
+REQUEUE_INBOUND_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[1], items[i])
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return #items
+"""
+
+# Falhas que justificam nova tentativa; as demais (conversa removida, dados
+# inválidos) mandam as entradas direto para a dead letter
+TRANSIENT_GROUPING_ERRORS = (OperationalError, InterfaceError, redis.RedisError)
+TRANSIENT_INBOUND_ERRORS = TRANSIENT_GROUPING_ERRORS
+
+# Buffer de mensagens INBOUND aguardando agrupamento
+inbound_buffer = InboundBuffer(redis_client)
+# Prazos de agrupamento (debounce) por conversa, conforme a política configurada
+grouping_scheduler = GroupingScheduler(redis_client, inbound_buffer, get_grouping_policy())
+
+def publish_message(conversation_id, message):
+    """
+    Enfileira a mensagem para o grupo WebSocket da conversa. O envio é feito
+    em lotes pelo fanout_publisher, sem bloquear o worker.
+    """
+    fanout_publisher.publish(conversation_group(conversation_id), message)
 
-# Conexão com Redis usando broker URL
-redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+@worker_process_shutdown.connect
+def flush_pending_publications(**kwargs):
+    """Entrega os eventos ainda pendentes antes do processo do worker encerrar"""
+    fanout_publisher.flush()
 
 @shared_task
 def handle_new_message_event(data, timestamp, user_id):
@@ -19,79 +96,322 @@ def handle_new_message_event(data, timestamp, user_id):
     user = User.objects.get(id=user_id)
     event = NewMessageEvent(data, timestamp)
     event.request_user = user
-    # Chama process para validar e criar mensagem
-    event.process()
+    # Chama process para validar e criar mensagem (reenvios não geram efeitos)
+    response, _ = event.process()
+    if not response['created']:
+        return
     # Notificar frontend via WebSocket que a mensagem INBOUND foi processada
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        f"conversation_{data['conversation_id']}",
-        {
-            'type': 'new_message',
-            'message': {
-                'id': data['id'],
-                'type': Message.INBOUND,
-                'content': data['content'],
-                'timestamp': event.event_time.isoformat(),
-                'author': user.id
-            }
-        }
-    )
+    publish_message(data['conversation_id'], {
+        'id': data['id'],
+        'type': Message.INBOUND,
+        'content': data['content'],
+        'timestamp': format_timestamp(event.event_time),
+        'author': user.id
+    })
     # 2. Adicionar ao buffer em Redis
     conversation_id = data['conversation_id']
     message_id = data['id']
     event_time = event.event_time
-    key = f"inbound:{conversation_id}"
-    redis_client.zadd(key, {message_id: event_time.timestamp()})
-    # 3. Agendar task de agrupamento após 5 segundos
-    schedule_grouping_task.apply_async(args=[conversation_id], countdown=5)
+    inbound_buffer.add(conversation_id, {message_id: event_time.timestamp()})
+    # 3. Recalcular o prazo de agrupamento da conversa
+    grouping_scheduler.schedule([conversation_id])
+
+def enqueue_inbound_message(data, timestamp, user_id):
+    """
+    Enfileira um NEW_MESSAGE para persistência em micro-lotes.
+    A drenagem ocorre ao completar INBOUND_BATCH_SIZE mensagens ou após
+    INBOUND_BATCH_WINDOW_MS, o que vier primeiro.
+    """
+    item = json.dumps({'data': data, 'timestamp': timestamp, 'user_id': user_id})
+    size = redis_client.rpush(INBOUND_QUEUE_KEY, item)
+    window_ms = settings.INBOUND_BATCH_WINDOW_MS
+    if size % settings.INBOUND_BATCH_SIZE == 0:
+        # Lote completo: drena imediatamente
+        drain_inbound_queue.delay()
+    elif redis_client.set(INBOUND_DRAIN_SCHEDULED_KEY, 1, nx=True, px=window_ms * 10):
+        # Primeira mensagem da janela: agenda uma única drenagem
+        drain_inbound_queue.apply_async(countdown=window_ms / 1000)
+
+async def aenqueue_inbound_message(data, timestamp, user_id):
+    """
+    Versão assíncrona de enqueue_inbound_message: o push na fila é feito
+    pelo cliente redis.asyncio e a publicação no broker (uma por janela ou
+    lote) roda fora do event loop.
+    """
+    item = json.dumps({'data': data, 'timestamp': timestamp, 'user_id': user_id})
+    async_redis_client = get_async_redis()
+    size = await async_redis_client.rpush(INBOUND_QUEUE_KEY, item)
+    window_ms = settings.INBOUND_BATCH_WINDOW_MS
+    if size % settings.INBOUND_BATCH_SIZE == 0:
+        await sync_to_async(drain_inbound_queue.delay, thread_sensitive=False)()
+    elif await async_redis_client.set(INBOUND_DRAIN_SCHEDULED_KEY, 1, nx=True, px=window_ms * 10):
+        await sync_to_async(drain_inbound_queue.apply_async, thread_sensitive=False)(countdown=window_ms / 1000)
 
 @shared_task
-def schedule_grouping_task(conversation_id):
-    """Verifica buffer e processa agrupamento de mensagens"""
-    key = f"inbound:{conversation_id}"
-    entries = redis_client.zrange(key, 0, -1, withscores=True)
+def drain_inbound_queue():
+    """
+    Drena a fila de NEW_MESSAGE em lotes de até INBOUND_BATCH_SIZE.
+
+    Cada lote é movido atomicamente para uma lista de processamento e só é
+    apagado após o commit. Itens inválidos ou rejeitados vão para a dead
+    letter sem afetar o resto do lote. Em uma falha transitória (banco ou
+    Redis) o lote volta ao início da fila e uma nova drenagem é agendada;
+    itens que já falharam INBOUND_MAX_ATTEMPTS vezes vão para a dead letter.
+    Lotes de um worker que morreu são devolvidos à fila após
+    INBOUND_CLAIM_TIMEOUT. Reprocessar um lote é seguro: mensagens já
+    gravadas são ignoradas pelo insert idempotente.
+    """
+    # Libera o agendamento antes de ler: itens novos agendam outra drenagem
+    redis_client.delete(INBOUND_DRAIN_SCHEDULED_KEY)
+    requeue_stale_inbound_claims()
+    claim_prefix = f"{socket.gethostname()}:{os.getpid()}:"
+    while True:
+        claim_id = f"{claim_prefix}{uuid.uuid4().hex}"
+        keys = [INBOUND_QUEUE_KEY, INBOUND_PROCESSING_PREFIX + claim_id, INBOUND_CLAIMS_KEY]
+        raw_items = redis_client.register_script(CLAIM_INBOUND_SCRIPT)(
+            keys=keys, args=[settings.INBOUND_BATCH_SIZE, time.time(), claim_id]
+        )
+        if not raw_items:
+            break
+        try:
+            process_inbound_claim(keys[1], raw_items)
+        except TRANSIENT_INBOUND_ERRORS as exc:
+            retry_inbound_claim(keys, claim_id, raw_items, exc)
+            drain_inbound_queue.apply_async(countdown=settings.INBOUND_RETRY_DELAY)
+            raise
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(keys[1])
+        pipe.zrem(INBOUND_CLAIMS_KEY, claim_id)
+        pipe.hdel(INBOUND_ATTEMPTS_KEY, *[_item_digest(raw) for raw in raw_items])
+        pipe.execute()
+
+def process_inbound_claim(processing_key, raw_items):
+    """
+    Persiste os itens de um lote. Um item que impede a persistência do lote
+    (payload ilegível, erro de dados no banco) não derruba os demais: o lote
+    é refeito item a item e só os que falham vão para a dead letter. Falhas
+    transitórias são propagadas para a drenagem tentar o lote de novo.
+    """
+    items = []
+    dead = []
+    for raw in raw_items:
+        try:
+            item = json.loads(raw)
+            if not isinstance(item, dict) or not isinstance(item.get('data'), dict):
+                raise ValueError('item sem data')
+        except ValueError as exc:
+            dead.append((raw, f'Item ilegível: {exc}'))
+            continue
+        items.append((raw, item))
+    try:
+        rejected = persist_inbound_batch([item for _, item in items])
+    except TRANSIENT_INBOUND_ERRORS:
+        _dead_letter_inbound(processing_key, dead)
+        raise
+    except Exception as exc:
+        logger.warning('Lote de %s mensagens falhou (%r): persistindo item a item', len(items), exc)
+        rejected = []
+        for raw, item in items:
+            try:
+                rejected += persist_inbound_batch([item])
+            except TRANSIENT_INBOUND_ERRORS:
+                _dead_letter_inbound(processing_key, dead)
+                raise
+            except Exception as item_exc:
+                rejected.append((item, repr(item_exc)))
+    raw_by_item = {id(item): raw for raw, item in items}
+    dead += [(raw_by_item[id(item)], reason) for item, reason in rejected]
+    _dead_letter_inbound(processing_key, dead)
+
+def retry_inbound_claim(keys, claim_id, raw_items, exc):
+    """Devolve o lote à fila, exceto os itens que esgotaram INBOUND_MAX_ATTEMPTS"""
+    pipe = redis_client.pipeline(transaction=False)
+    for raw in raw_items:
+        pipe.hincrby(INBOUND_ATTEMPTS_KEY, _item_digest(raw), 1)
+    exhausted = [
+        (raw, f'Falha após {attempts} tentativas: {exc!r}')
+        for raw, attempts in zip(raw_items, pipe.execute())
+        if attempts >= settings.INBOUND_MAX_ATTEMPTS
+    ]
+    _dead_letter_inbound(keys[1], exhausted)
+    redis_client.register_script(REQUEUE_INBOUND_SCRIPT)(keys=keys, args=[claim_id])
+
+def _dead_letter_inbound(processing_key, entries):
+    """Move itens (cru, motivo) da lista de processamento para a dead letter"""
     if not entries:
         return
-    # Encontrar timestamp máximo
-    max_score = max(score for _, score in entries)
-    now = datetime.utcnow().timestamp()
-    window_end = max_score + 5
-    # Se ainda estiver dentro da janela, reagenda
-    if now < window_end:
-        delay = window_end - now
-        schedule_grouping_task.apply_async(args=[conversation_id], countdown=delay)
+    pipe = redis_client.pipeline(transaction=True)
+    for raw, reason in entries:
+        pipe.lrem(processing_key, 1, raw)
+        pipe.rpush(INBOUND_DEAD_LETTER_KEY, json.dumps({
+            'item': raw.decode() if isinstance(raw, bytes) else raw,
+            'reason': reason,
+            'failed_at': time.time()
+        }))
+        pipe.hdel(INBOUND_ATTEMPTS_KEY, _item_digest(raw))
+    pipe.execute()
+    logger.error('%s mensagens do micro-lote enviadas para a dead letter', len(entries))
+
+def _item_digest(raw):
+    return hashlib.sha1(raw if isinstance(raw, bytes) else raw.encode()).hexdigest()
+
+def requeue_stale_inbound_claims():
+    """Devolve à fila os lotes retirados há mais de INBOUND_CLAIM_TIMEOUT segundos"""
+    cutoff = time.time() - settings.INBOUND_CLAIM_TIMEOUT
+    requeue = redis_client.register_script(REQUEUE_INBOUND_SCRIPT)
+    for raw_claim in redis_client.zrangebyscore(INBOUND_CLAIMS_KEY, '-inf', cutoff):
+        claim_id = raw_claim.decode()
+        restored = requeue(
+            keys=[INBOUND_QUEUE_KEY, INBOUND_PROCESSING_PREFIX + claim_id, INBOUND_CLAIMS_KEY],
+            args=[claim_id]
+        )
+        if restored:
+            logger.warning('Lote %s abandonado: %s mensagens devolvidas à fila', claim_id, restored)
+
+def persist_inbound_batch(items):
+    """
+    Persiste um micro-lote de NEW_MESSAGE: usuários carregados em uma
+    consulta e todas as mensagens, de qualquer remetente, persistidas por
+    uma única passada do WebhookBatchProcessor. Retorna [(item, motivo)] dos
+    itens rejeitados (usuário inexistente, conversa fechada, dados inválidos);
+    reenvios de mensagens já gravadas não contam como rejeição.
+    """
+    # Toques em updated_at de todo o micro-lote gravados em um único UPDATE
+    with coalesce_touches():
+        return _persist_inbound_batch(items)
+
+def _persist_inbound_batch(items):
+    from .batch import WebhookBatchProcessor, is_duplicate_message
+    users = User.objects.in_bulk({item.get('user_id') for item in items})
+    accepted = []
+    rejected = []
+    request_users = []
+    for item in items:
+        user = users.get(item.get('user_id'))
+        if user is None:
+            rejected.append((item, f"Usuário {item.get('user_id')} não encontrado"))
+            continue
+        accepted.append(item)
+        request_users.append(user)
+    if not accepted:
+        return rejected
+    payloads = [
+        {'type': 'NEW_MESSAGE', 'timestamp': item.get('timestamp'), 'data': item['data']}
+        for item in accepted
+    ]
+    processor = WebhookBatchProcessor(None, dispatch_inline=True)
+    for item, result in zip(accepted, processor.process(payloads, request_users=request_users)):
+        if result['status_code'] >= 400 and not is_duplicate_message(result):
+            rejected.append((item, json.dumps(result['response'], default=str)))
+    return rejected
+
+@shared_task
+def handle_persisted_messages(messages):
+    """
+    Notifica e bufferiza mensagens INBOUND já persistidas em lote.
+    Cada item traz conversation_id, score (epoch) e o payload WebSocket.
+    Ao final, confirma o despacho no outbox.
+    """
+    by_conversation = {}
+    for item in messages:
+        by_conversation.setdefault(item['conversation_id'], []).append(item)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for conversation_id, items in by_conversation.items():
+        for item in items:
+            publish_message(conversation_id, item['message'])
+        inbound_buffer.add(conversation_id, {item['message']['id']: item['score'] for item in items}, pipe=pipe)
+    pipe.execute()
+
+    # Um único prazo de agrupamento por conversa do lote
+    grouping_scheduler.schedule(by_conversation.keys())
+    dispatch_outbox.ack([item['message']['id'] for item in messages])
+
+@shared_task
+def redispatch_pending_messages():
+    """
+    Loop periódico (beat): despacha de novo as mensagens gravadas cujo
+    despacho não foi confirmado em DISPATCH_OUTBOX_GRACE segundos. Itens sem
+    linha no banco são de lotes que não chegaram ao commit e são descartados.
+    """
+    pending = dispatch_outbox.pending(settings.DISPATCH_OUTBOX_GRACE, limit=settings.DISPATCH_OUTBOX_BATCH_SIZE)
+    if not pending:
         return
-    # Fora da janela, processar agrupamento
-    message_ids = [mid.decode() if isinstance(mid, bytes) else mid for mid, _ in entries]
-    content = "Mensagens recebidas:\n" + "\n".join(message_ids)
-    # Criar mensagem OUTBOUND com author garantido (agente ou cliente)
-    conversation = Conversation.objects.get(id=conversation_id)
-    author = conversation.agent or conversation.customer
-    outbound_message = Message.objects.create(
-        id=uuid.uuid4(),
-        conversation=conversation,
-        direction=Message.OUTBOUND,
-        content=content,
-        timestamp=datetime.utcnow(),
-        author=author
-    )
-    conversation.updated_at = outbound_message.timestamp
-    conversation.save()
-    # Limpar buffer
-    redis_client.delete(key)
-
-    channel_layer = get_channel_layer()
+    persisted = {
+        str(message_id)
+        for message_id in Message.objects.filter(id__in=list(pending)).values_list('id', flat=True)
+    }
+    dispatch_outbox.ack([message_id for message_id in pending if message_id not in persisted])
+    if persisted:
+        logger.warning('Despachando de novo %s mensagens sem confirmação de despacho', len(persisted))
+        handle_persisted_messages([pending[message_id] for message_id in persisted])
+
+@shared_task
+def schedule_grouping_task(conversation_id):
+    """
+    Mantido para tasks já enfileiradas: apenas registra o prazo no
+    agendador de debounce em vez de reagendar a si mesma.
+    """
+    grouping_scheduler.schedule([conversation_id])
+
+@shared_task
+def fire_due_groupings():
+    """Loop periódico (beat): agrupa as conversas cujo prazo expirou"""
+    for conversation_id in grouping_scheduler.pop_due():
+        try:
+            group_conversation_messages(conversation_id)
+        except Exception:
+            logger.exception('Falha ao agrupar mensagens da conversa %s', conversation_id)
+
+def group_conversation_messages(conversation_id):
+    """Gera a mensagem OUTBOUND com as mensagens do buffer da conversa"""
+    state, result = grouping_scheduler.drain(conversation_id, current_time())
+    if state == InboundBuffer.EMPTY:
+        return
+    # Prazo ainda não expirou (nova mensagem chegou): reagenda para o prazo atual
+    if state == InboundBuffer.OPEN:
+        grouping_scheduler.schedule_at(conversation_id, result)
+        return
+    entries = result
+    try:
+        message_ids = [mid for mid, _ in entries]
+        content = "Mensagens recebidas:\n" + "\n".join(message_ids)
+        # Criar mensagem OUTBOUND com author garantido (agente ou cliente)
+        conversation = Conversation.objects.filter(id=conversation_id).values('agent_id', 'customer_id').first()
+        if conversation is None:
+            raise Conversation.DoesNotExist(f"Conversa {conversation_id} não encontrada")
+        author_id = conversation['agent_id'] or conversation['customer_id']
+        outbound_message = Message.objects.create(
+            id=uuid.uuid4(),
+            conversation_id=conversation_id,
+            direction=Message.OUTBOUND,
+            content=content,
+            timestamp=datetime.utcnow(),
+            author_id=author_id
+        )
+        touch_conversation(conversation_id)
+    except TRANSIENT_GROUPING_ERRORS as exc:
+        # Devolve as mensagens drenadas para uma nova tentativa com backoff
+        # exponencial, até GROUPING_MAX_ATTEMPTS
+        attempts = inbound_buffer.record_failure(conversation_id)
+        if attempts >= settings.GROUPING_MAX_ATTEMPTS:
+            inbound_buffer.dead_letter(conversation_id, entries, repr(exc))
+        else:
+            inbound_buffer.restore(conversation_id, entries)
+            delay = min(settings.GROUPING_RETRY_BASE_DELAY * 2 ** (attempts - 1), settings.GROUPING_RETRY_MAX_DELAY)
+            grouping_scheduler.schedule_at(conversation_id, current_time() + delay)
+        raise
+    except Exception as exc:
+        # Falha permanente: repetir não adianta
+        inbound_buffer.dead_letter(conversation_id, entries, repr(exc))
+        raise
+    inbound_buffer.clear_failures(conversation_id)
+
     # Enviar evento WebSocket com payload incluindo author se disponível
-    async_to_sync(channel_layer.group_send)(
-        f"conversation_{conversation_id}",
-        {
-            'type': 'new_message',
-            'message': {
-                'id': str(outbound_message.id),
-                'type': outbound_message.direction,  # 'INBOUND' ou 'OUTBOUND'
-                'content': outbound_message.content,
-                'timestamp': outbound_message.timestamp.isoformat(),
-                'author': author.id
-            }
-        }
-    ) 
\ No newline at end of file
+    publish_message(conversation_id, {
+        'id': str(outbound_message.id),
+        'type': outbound_message.direction,  # 'INBOUND' ou 'OUTBOUND'
+        'content': outbound_message.content,
+        'timestamp': format_timestamp(outbound_message.timestamp),
+        'author': author_id
+    })
@@ -0,0 +1,1633 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
+import fakeredis
+import redis
+from asgiref.sync import sync_to_async
+from fakeredis.aioredis import FakeConnection
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import DataError, OperationalError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import re_path, reverse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from webhook_api import consumers, conversation_state, publisher, routing, tasks
+from webhook_api.auth import AuthService, TokenCache, token_cache
+from webhook_api.batch import NdjsonIngestor, WebhookBatchProcessor
+from webhook_api.connections import BlockingRedisChannelLayer, _pool_stats, connections
+from webhook_api.consumers import MultiplexConsumer
+from webhook_api.conversation_state import ConversationStateCache
+from webhook_api.idempotency import IdempotencyStore
+from webhook_api.grouping import (
+    GROUPING_ATTEMPTS_KEY, GROUPING_DEAD_LETTER_KEY, AdaptiveWindowPolicy, FixedWindowPolicy, GroupingScheduler,
+    InboundBuffer, MaxWaitPolicy, get_grouping_policy
+)
+from webhook_api.middleware import AUTH_SUBPROTOCOL_PREFIX, JWTWebSocketMiddleware
+from webhook_api.models import Conversation, Message
+from webhook_api.outbox import DISPATCH_OUTBOX_KEY, dispatch_outbox
+from webhook_api.presence import PresenceStore
+from webhook_api.publisher import FanoutPublisher
+from webhook_api.replay import EventLog
+from webhook_api.fast_serializers import serialize_conversation, serialize_message_rows
+from webhook_api.serializers import ConversationSerializer, MessageSerializer
+from webhook_api.touch import coalesce_touches, touch_conversation, touch_conversations
+from webhook_api.wire import JSON_SUBPROTOCOL, MSGPACK_SUBPROTOCOL, format_timestamp, unpack_event
+
+
+class FakeRedisMixin:
+    """Troca os clientes Redis dos módulos por um fakeredis isolado por teste"""
+
+    def setUp(self):
+        super().setUp()
+        self.fake_server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=self.fake_server)
+
+    def patch_object(self, target, attribute, value=None):
+        """Substitui target.attribute (por padrão pelo fakeredis) até o fim do teste"""
+        patcher = mock.patch.object(target, attribute, self.redis if value is None else value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class DrainInboundQueueTests(FakeRedisMixin, TestCase):
+    """Drenagem da fila de NEW_MESSAGE sem perda de lotes"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(tasks, 'redis_client')
+        self.patch_object(dispatch_outbox, 'redis')
+        self.user = User.objects.create_user(username='drain-customer')
+        self.conversation = Conversation.objects.create(customer=self.user)
+
+    def enqueue(self, count, content='m{i}'):
+        items = [
+            json.dumps({
+                'data': {
+                    'id': str(uuid.uuid4()),
+                    'content': content.format(i=i),
+                    'conversation_id': str(self.conversation.id)
+                },
+                'timestamp': datetime.utcnow().isoformat(),
+                'user_id': self.user.id
+            })
+            for i in range(count)
+        ]
+        self.redis.rpush(tasks.INBOUND_QUEUE_KEY, *items)
+        return [item.encode() for item in items]
+
+    def dead_letters(self):
+        return [json.loads(raw) for raw in self.redis.lrange(tasks.INBOUND_DEAD_LETTER_KEY, 0, -1)]
+
+    def test_failed_batch_returns_to_queue_in_order(self):
+        items = self.enqueue(3)
+        with mock.patch.object(tasks, 'persist_inbound_batch', side_effect=OperationalError('db fora')), \
+                mock.patch.object(tasks.drain_inbound_queue, 'apply_async') as retry:
+            with self.assertRaises(OperationalError):
+                tasks.drain_inbound_queue()
+        self.assertEqual(self.redis.lrange(tasks.INBOUND_QUEUE_KEY, 0, -1), items)
+        self.assertEqual(self.redis.zcard(tasks.INBOUND_CLAIMS_KEY), 0)
+        self.assertEqual(self.redis.keys(f'{tasks.INBOUND_PROCESSING_PREFIX}*'), [])
+        retry.assert_called_once()
+
+    @override_settings(INBOUND_MAX_ATTEMPTS=2)
+    def test_items_are_dead_lettered_after_max_transient_failures(self):
+        items = self.enqueue(3)
+        with mock.patch.object(tasks, 'persist_inbound_batch', side_effect=OperationalError('db fora')), \
+                mock.patch.object(tasks.drain_inbound_queue, 'apply_async'):
+            for _ in range(2):
+                with self.assertRaises(OperationalError):
+                    tasks.drain_inbound_queue()
+        self.assertEqual(self.redis.llen(tasks.INBOUND_QUEUE_KEY), 0)
+        self.assertEqual([entry['item'].encode() for entry in self.dead_letters()], items)
+        self.assertEqual(self.redis.hlen(tasks.INBOUND_ATTEMPTS_KEY), 0)
+
+    def test_malformed_items_do_not_block_the_batch(self):
+        self.enqueue(2)
+        self.redis.rpush(tasks.INBOUND_QUEUE_KEY, 'não é json')
+        nul = self.enqueue(1, content='com \x00 nulo')
+        rejected_by_db = self.enqueue(1, content='quebra')
+        self.enqueue(2, content='depois {i}')
+        insert = Message.objects.insert_ignoring_conflicts
+
+        def rejecting_insert(messages):
+            # Simula o driver recusando um valor (DataError) no INSERT do lote
+            if any(message.content == 'quebra' for message in messages):
+                raise DataError('valor inválido')
+            return insert(messages)
+
+        with mock.patch.object(Message.objects, 'insert_ignoring_conflicts', side_effect=rejecting_insert), \
+                mock.patch.object(tasks, 'handle_persisted_messages'), \
+                self.captureOnCommitCallbacks(execute=True):
+            tasks.drain_inbound_queue()
+        self.assertEqual(
+            sorted(Message.objects.filter(conversation=self.conversation).values_list('content', flat=True)),
+            ['depois 0', 'depois 1', 'm0', 'm1']
+        )
+        dead = [entry['item'] for entry in self.dead_letters()]
+        self.assertEqual(dead, ['não é json', nul[0].decode(), rejected_by_db[0].decode()])
+        self.assertEqual(self.redis.llen(tasks.INBOUND_QUEUE_KEY), 0)
+        self.assertEqual(self.redis.keys(f'{tasks.INBOUND_PROCESSING_PREFIX}*'), [])
+
+    def test_stale_claim_is_requeued(self):
+        items = self.enqueue(2)
+        claim_id = 'worker-morto:1:abc'
+        keys = [tasks.INBOUND_QUEUE_KEY, tasks.INBOUND_PROCESSING_PREFIX + claim_id, tasks.INBOUND_CLAIMS_KEY]
+        self.redis.register_script(tasks.CLAIM_INBOUND_SCRIPT)(keys=keys, args=[10, time.time() - 3600, claim_id])
+        self.assertEqual(self.redis.llen(tasks.INBOUND_QUEUE_KEY), 0)
+        tasks.requeue_stale_inbound_claims()
+        self.assertEqual(self.redis.lrange(tasks.INBOUND_QUEUE_KEY, 0, -1), items)
+        self.assertEqual(self.redis.zcard(tasks.INBOUND_CLAIMS_KEY), 0)
+
+    def test_batch_with_several_users_is_persisted_and_acknowledged(self):
+        other = User.objects.create_user(username='drain-other')
+        other_conversation = Conversation.objects.create(customer=other)
+        self.enqueue(2)
+        self.redis.rpush(tasks.INBOUND_QUEUE_KEY, json.dumps({
+            'data': {'id': str(uuid.uuid4()), 'content': 'outro', 'conversation_id': str(other_conversation.id)},
+            'timestamp': datetime.utcnow().isoformat(),
+            'user_id': other.id
+        }))
+        with mock.patch.object(tasks, 'handle_persisted_messages') as dispatch, \
+                self.captureOnCommitCallbacks(execute=True):
+            tasks.drain_inbound_queue()
+        self.assertEqual(Message.objects.filter(conversation=self.conversation, author=self.user).count(), 2)
+        self.assertEqual(Message.objects.filter(conversation=other_conversation, author=other).count(), 1)
+        dispatch.assert_called_once()
+        self.assertEqual(self.redis.llen(tasks.INBOUND_QUEUE_KEY), 0)
+        self.assertEqual(self.redis.zcard(tasks.INBOUND_CLAIMS_KEY), 0)
+
+
+class WebhookBatchProcessorTests(FakeRedisMixin, TestCase):
+    """Persistência de lotes com reenvios concorrentes"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(dispatch_outbox, 'redis')
+        self.user = User.objects.create_user(username='batch-customer')
+        self.conversation = Conversation.objects.create(customer=self.user)
+
+    def message_payload(self, content):
+        return {
+            'type': 'NEW_MESSAGE',
+            'timestamp': datetime.utcnow().isoformat(),
+            'data': {'id': str(uuid.uuid4()), 'content': content, 'conversation_id': str(self.conversation.id)}
+        }
+
+    def test_rows_inserted_concurrently_are_reported_as_duplicates_and_not_dispatched(self):
+        payloads = [self.message_payload('a'), self.message_payload('b')]
+        raced_id = payloads[1]['data']['id']
+        processor = WebhookBatchProcessor(self.user)
+        flush = processor._flush
+
+        def flush_after_concurrent_insert(state):
+            # Outra requisição grava a mesma mensagem depois da pré-carga do lote
+            Message.objects.create(
+                id=raced_id, conversation=self.conversation, direction=Message.INBOUND,
+                content='b', timestamp=datetime.utcnow(), author=self.user
+            )
+            flush(state)
+
+        with mock.patch.object(processor, '_flush', side_effect=flush_after_concurrent_insert), \
+                mock.patch.object(tasks, 'handle_persisted_messages') as dispatch, \
+                self.captureOnCommitCallbacks(execute=True):
+            results = processor.process(payloads)
+
+        self.assertEqual([result['status_code'] for result in results], [201, 400])
+        self.assertEqual(results[1]['response'], {'error': 'Mensagem já existe', 'message_id': raced_id})
+        (items,), _ = dispatch.delay.call_args
+        self.assertEqual([item['message']['id'] for item in items], [payloads[0]['data']['id']])
+        self.assertEqual(self.redis.hkeys(DISPATCH_OUTBOX_KEY), [payloads[0]['data']['id'].encode()])
+
+    def test_insert_returns_only_new_ids(self):
+        existing = Message.objects.create(
+            conversation=self.conversation, direction=Message.INBOUND, content='x',
+            timestamp=datetime.utcnow(), author=self.user
+        )
+        fresh = Message(
+            id=uuid.uuid4(), conversation=self.conversation, direction=Message.INBOUND,
+            content='y', timestamp=datetime.utcnow(), author=self.user
+        )
+        duplicate = Message(
+            id=existing.id, conversation=self.conversation, direction=Message.INBOUND,
+            content='z', timestamp=datetime.utcnow(), author=self.user
+        )
+        self.assertEqual(Message.objects.insert_ignoring_conflicts([fresh, duplicate]), {str(fresh.id)})
+        self.assertEqual(Message.objects.get(id=existing.id).content, 'x')
+
+
+class WebhookBatchViewTests(FakeRedisMixin, TestCase):
+    """Status individual de cada evento do /webhook/batch/"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(dispatch_outbox, 'redis')
+        self.patch_object(tasks, 'handle_persisted_messages', mock.Mock())
+        self.user = User.objects.create_user(username='batch-view-customer')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AuthService.generate_token(self.user)}'}
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+
+    def post(self, payload):
+        return self.client.post(reverse('webhook-batch'), payload, content_type='application/json', **self.headers)
+
+    @staticmethod
+    def event(event_type, **data):
+        return {'type': event_type, 'timestamp': datetime.utcnow().isoformat(), 'data': data}
+
+    def test_valid_batch_returns_200(self):
+        conversation_id = str(uuid.uuid4())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post({'events': [
+                self.event('NEW_CONVERSATION', id=conversation_id),
+                self.event('NEW_MESSAGE', id=str(uuid.uuid4()), content='oi', conversation_id=conversation_id),
+            ]})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body['processed'], body['succeeded'], body['failed']), (2, 2, 0))
+        self.assertEqual(Message.objects.filter(conversation_id=conversation_id).count(), 1)
+        tasks.handle_persisted_messages.delay.assert_called_once()
+
+    def test_mixed_batch_returns_207_with_per_event_status(self):
+        conversation_id = str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        response = self.post([
+            self.event('NEW_CONVERSATION', id=conversation_id),
+            self.event('NEW_MESSAGE', id=message_id, content='primeira', conversation_id=conversation_id),
+            self.event('NEW_MESSAGE', id=message_id, content='repetida', conversation_id=conversation_id),
+            self.event('EVENTO_DESCONHECIDO', id=str(uuid.uuid4())),
+            self.event('NEW_MESSAGE', id=str(uuid.uuid4()), content='x', conversation_id=str(uuid.uuid4())),
+            self.event('NEW_MESSAGE', id='nao-e-uuid', content='x', conversation_id=conversation_id),
+            self.event('CLOSE_CONVERSATION', id=conversation_id),
+            self.event('NEW_MESSAGE', id=str(uuid.uuid4()), content='tarde', conversation_id=conversation_id),
+        ])
+        self.assertEqual(response.status_code, 207)
+        body = response.json()
+        self.assertEqual((body['processed'], body['succeeded'], body['failed']), (8, 3, 5))
+        self.assertEqual([result['index'] for result in body['results']], list(range(8)))
+        self.assertEqual(
+            [result['status_code'] for result in body['results']],
+            [201, 201, 400, 400, 400, 400, 200, 400]
+        )
+        self.assertEqual(body['results'][2]['response']['error'], 'Mensagem já existe')
+        # Só os eventos aceitos foram persistidos
+        self.assertEqual(Conversation.objects.get(id=conversation_id).status, Conversation.CLOSED)
+        self.assertEqual(
+            list(Message.objects.filter(conversation_id=conversation_id).values_list('content', flat=True)),
+            ['primeira']
+        )
+
+    def test_payload_must_be_a_list(self):
+        response = self.post({'type': 'NEW_CONVERSATION'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['received_type'], 'dict')
+
+    @override_settings(WEBHOOK_BATCH_MAX_EVENTS=2)
+    def test_batch_over_the_limit_is_rejected(self):
+        response = self.post([self.event('NEW_CONVERSATION', id=str(uuid.uuid4())) for _ in range(3)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['max_events'], '2')
+        self.assertEqual(Conversation.objects.count(), 0)
+
+
+class NdjsonIngestionTests(FakeRedisMixin, TestCase):
+    """Ingestão NDJSON pelo /webhook/stream/ e pelo comando ingest_ndjson"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(dispatch_outbox, 'redis')
+        self.patch_object(tasks, 'handle_persisted_messages', mock.Mock())
+        self.user = User.objects.create_user(username='ndjson-customer')
+        self.conversation_id = str(uuid.uuid4())
+
+    def ndjson(self):
+        """5 linhas (uma inválida no meio, uma em branco), a última sem quebra de linha"""
+        def line(event_type, **data):
+            return json.dumps({'type': event_type, 'timestamp': datetime.utcnow().isoformat(), 'data': data})
+        lines = [
+            line('NEW_CONVERSATION', id=self.conversation_id),
+            line('NEW_MESSAGE', id=str(uuid.uuid4()), content='um', conversation_id=self.conversation_id),
+            '{"type": "NEW_MESSAGE", "data": ',
+            '',
+            line('NEW_MESSAGE', id=str(uuid.uuid4()), content='dois', conversation_id=self.conversation_id),
+            line('NEW_MESSAGE', id=str(uuid.uuid4()), content='três', conversation_id=self.conversation_id),
+        ]
+        return '\n'.join(lines)
+
+    def assert_ingested(self):
+        self.assertEqual(
+            list(Message.objects.filter(conversation_id=self.conversation_id).values_list('content', flat=True)),
+            ['um', 'dois', 'três']
+        )
+
+    @override_settings(WEBHOOK_STREAM_CHUNK_SIZE=2)
+    def test_stream_view_persists_in_chunks_and_reports_bad_lines(self):
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('webhook-stream'), self.ndjson(), content_type='application/x-ndjson',
+                HTTP_AUTHORIZATION=f'Bearer {AuthService.generate_token(self.user)}'
+            )
+        self.assertEqual(response.status_code, 207)
+        body = response.json()
+        self.assertEqual((body['lines'], body['succeeded'], body['failed']), (5, 4, 1))
+        self.assertEqual(body['errors'][0]['line'], 3)
+        self.assertEqual(body['errors'][0]['response']['error'], 'Payload JSON inválido')
+        self.assert_ingested()
+        # Blocos de 2 eventos válidos: um despacho por bloco com mensagens
+        self.assertEqual(tasks.handle_persisted_messages.delay.call_count, 2)
+
+    def test_lines_split_across_reads_are_reassembled(self):
+        payload = self.ndjson().encode()
+        # Corpo chegando em pedaços que cortam as linhas no meio
+        pieces = (payload[i:i + 7] for i in range(0, len(payload), 7))
+
+        def lines():
+            buffer = b''
+            for piece in pieces:
+                buffer += piece
+                *complete, buffer = buffer.split(b'\n')
+                yield from (line + b'\n' for line in complete)
+            if buffer:
+                yield buffer
+
+        summary = NdjsonIngestor(self.user, chunk_size=2).ingest(lines())
+        self.assertEqual((summary['lines'], summary['succeeded'], summary['failed']), (5, 4, 1))
+        self.assert_ingested()
+
+    def test_ingest_command_reads_the_file_and_reports_errors(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False, encoding='utf-8') as stream:
+            stream.write(self.ndjson())
+        self.addCleanup(os.remove, stream.name)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('ingest_ndjson', stream.name, user=self.user.username, chunk_size=2, stdout=stdout, stderr=stderr)
+        self.assertIn('5 linhas, 4 ok, 1 erros', stdout.getvalue())
+        self.assertIn('linha 3: {"error": "Payload JSON inválido"', stderr.getvalue())
+        self.assert_ingested()
+
+    def test_ingest_command_requires_an_existing_user(self):
+        with self.assertRaises(CommandError):
+            call_command('ingest_ndjson', '-', user='ninguem')
+
+
+class DispatchOutboxTests(FakeRedisMixin, TestCase):
+    """Despacho das mensagens persistidas não se perde quando falha após o commit"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(dispatch_outbox, 'redis')
+        self.user = User.objects.create_user(username='outbox-customer')
+        self.conversation = Conversation.objects.create(customer=self.user)
+
+    def persist(self, count):
+        payloads = [
+            {
+                'type': 'NEW_MESSAGE',
+                'timestamp': datetime.utcnow().isoformat(),
+                'data': {'id': str(uuid.uuid4()), 'content': f'm{i}', 'conversation_id': str(self.conversation.id)}
+            }
+            for i in range(count)
+        ]
+        processor = WebhookBatchProcessor(self.user, dispatch_inline=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            results = processor.process(payloads)
+        self.assertTrue(all(result['status_code'] == 201 for result in results))
+        return [payload['data']['id'] for payload in payloads]
+
+    def test_successful_dispatch_clears_the_outbox(self):
+        with mock.patch.object(tasks, 'redis_client', self.redis), \
+                mock.patch.object(tasks, 'publish_message'), \
+                mock.patch.object(tasks, 'grouping_scheduler'):
+            self.persist(2)
+        self.assertEqual(self.redis.hlen(DISPATCH_OUTBOX_KEY), 0)
+
+    @override_settings(DISPATCH_OUTBOX_GRACE=0)
+    def test_dispatch_failing_after_commit_is_redispatched(self):
+        with mock.patch.object(tasks, 'handle_persisted_messages', side_effect=redis.ConnectionError('fora')):
+            message_ids = self.persist(2)
+        self.assertEqual(Message.objects.filter(id__in=message_ids).count(), 2)
+        self.assertEqual(self.redis.hlen(DISPATCH_OUTBOX_KEY), 2)
+
+        with mock.patch.object(tasks, 'handle_persisted_messages') as dispatch:
+            tasks.redispatch_pending_messages()
+        (items,), _ = dispatch.call_args
+        self.assertEqual(sorted(item['message']['id'] for item in items), sorted(message_ids))
+        self.assertTrue(all(item['conversation_id'] == str(self.conversation.id) for item in items))
+
+    @override_settings(DISPATCH_OUTBOX_GRACE=0)
+    def test_entries_of_rolled_back_batches_are_discarded(self):
+        dispatch_outbox.record([{
+            'conversation_id': str(self.conversation.id),
+            'score': time.time(),
+            'message': {'id': str(uuid.uuid4()), 'type': Message.INBOUND, 'content': 'x'}
+        }])
+        with mock.patch.object(tasks, 'handle_persisted_messages') as dispatch:
+            tasks.redispatch_pending_messages()
+        dispatch.assert_not_called()
+        self.assertEqual(self.redis.hlen(DISPATCH_OUTBOX_KEY), 0)
+
+    def test_recent_entries_wait_for_the_grace_period(self):
+        with mock.patch.object(tasks, 'handle_persisted_messages'):
+            self.persist(1)
+        with mock.patch.object(tasks, 'handle_persisted_messages') as dispatch:
+            tasks.redispatch_pending_messages()
+        dispatch.assert_not_called()
+        self.assertEqual(self.redis.hlen(DISPATCH_OUTBOX_KEY), 1)
+
+
+class InboundBufferConcurrencyTests(FakeRedisMixin, TestCase):
+    """Drenagem atômica do buffer com produtores concorrentes"""
+
+    def test_each_member_is_drained_exactly_once(self):
+        conversation_id = str(uuid.uuid4())
+        producers, per_producer = 4, 250
+        done = threading.Event()
+        drained = []
+
+        def produce(producer):
+            buffer = InboundBuffer(fakeredis.FakeRedis(server=self.fake_server))
+            for i in range(per_producer):
+                buffer.add(conversation_id, {f'{producer}-{i}': time.time()})
+
+        def consume():
+            buffer = InboundBuffer(fakeredis.FakeRedis(server=self.fake_server))
+            while True:
+                finished = done.is_set()
+                state, entries = buffer.drain(conversation_id, now=time.time() + 60, window=0)
+                if state == InboundBuffer.DRAINED:
+                    drained.extend(member for member, _ in entries)
+                elif finished:
+                    return
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        threads = [threading.Thread(target=produce, args=(p,)) for p in range(producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        consumer.join()
+        self.assertEqual(len(drained), producers * per_producer)
+        self.assertEqual(len(set(drained)), producers * per_producer)
+
+
+@override_settings(GROUPING_MAX_ATTEMPTS=3)
+class GroupConversationMessagesTests(FakeRedisMixin, TestCase):
+    """Falhas do agrupamento: nova tentativa só para erros transitórios"""
+
+    def setUp(self):
+        super().setUp()
+        buffer = InboundBuffer(self.redis)
+        self.patch_object(tasks, 'inbound_buffer', buffer)
+        self.patch_object(tasks, 'grouping_scheduler', GroupingScheduler(self.redis, buffer, FixedWindowPolicy(0)))
+        self.buffer = buffer
+        self.user = User.objects.create_user(username='grouping-customer')
+        self.conversation_id = str(Conversation.objects.create(customer=self.user).id)
+        self.buffer.add(self.conversation_id, {'m1': time.time() - 10, 'm2': time.time() - 5})
+
+    def dead_letters(self):
+        return [json.loads(raw) for raw in self.redis.lrange(GROUPING_DEAD_LETTER_KEY, 0, -1)]
+
+    def test_missing_conversation_is_dead_lettered_without_retry(self):
+        Conversation.objects.filter(id=self.conversation_id).delete()
+        with self.assertRaises(Conversation.DoesNotExist):
+            tasks.group_conversation_messages(self.conversation_id)
+        self.assertEqual(self.redis.zcard(InboundBuffer.key(self.conversation_id)), 0)
+        self.assertEqual(self.redis.zcard(tasks.grouping_scheduler.key), 0)
+        [letter] = self.dead_letters()
+        self.assertEqual(letter['conversation_id'], self.conversation_id)
+        self.assertEqual([member for member, _ in letter['entries']], ['m1', 'm2'])
+
+    @override_settings(GROUPING_RETRY_BASE_DELAY=2, GROUPING_RETRY_MAX_DELAY=3)
+    def test_transient_failure_is_retried_until_the_cap(self):
+        now = time.time()
+        with mock.patch.object(Message.objects, 'create', side_effect=OperationalError('conexão perdida')), \
+                mock.patch.object(tasks, 'current_time', return_value=now):
+            # Backoff exponencial (2s, 4s), limitado a GROUPING_RETRY_MAX_DELAY
+            for attempt, delay in ((1, 2), (2, 3)):
+                with self.assertRaises(OperationalError):
+                    tasks.group_conversation_messages(self.conversation_id)
+                self.assertEqual(self.redis.zcard(InboundBuffer.key(self.conversation_id)), 2)
+                self.assertEqual(int(self.redis.hget(GROUPING_ATTEMPTS_KEY, self.conversation_id)), attempt)
+                self.assertEqual(self.redis.zscore(tasks.grouping_scheduler.key, self.conversation_id), now + delay)
+            with self.assertRaises(OperationalError):
+                tasks.group_conversation_messages(self.conversation_id)
+        self.assertEqual(self.redis.zcard(InboundBuffer.key(self.conversation_id)), 0)
+        self.assertIsNone(self.redis.hget(GROUPING_ATTEMPTS_KEY, self.conversation_id))
+        self.assertEqual(len(self.dead_letters()), 1)
+
+    def test_success_clears_previous_failures(self):
+        self.redis.hset(GROUPING_ATTEMPTS_KEY, self.conversation_id, 2)
+        with mock.patch.object(tasks, 'publish_message') as publish:
+            tasks.group_conversation_messages(self.conversation_id)
+        publish.assert_called_once()
+        self.assertTrue(Message.objects.filter(conversation_id=self.conversation_id, direction=Message.OUTBOUND).exists())
+        self.assertIsNone(self.redis.hget(GROUPING_ATTEMPTS_KEY, self.conversation_id))
+
+
+class GroupingPolicyTests(SimpleTestCase):
+    """Prazo de agrupamento calculado por cada política"""
+
+    def test_fixed_window_counts_from_the_last_message(self):
+        policy = FixedWindowPolicy(5, max_batch_size=3)
+        self.assertEqual(policy.deadline([100.0, 102.0]), 107.0)
+        self.assertFalse(policy.is_full([100.0, 102.0]))
+        self.assertTrue(policy.is_full([100.0, 101.0, 102.0]))
+
+    def test_max_wait_caps_the_deadline_from_the_first_message(self):
+        policy = MaxWaitPolicy(5, 8)
+        self.assertEqual(policy.deadline([100.0, 101.0]), 106.0)
+        self.assertEqual(policy.deadline([100.0, 104.0, 106.0]), 108.0)
+
+    def test_adaptive_window_follows_the_message_gaps(self):
+        policy = AdaptiveWindowPolicy(1, 10, 4, factor=2, alpha=0.5)
+        self.assertEqual(policy.window_for([100.0]), 4)
+        # Média móvel dos intervalos 1 e 2 = 1.5, vezes o fator 2
+        self.assertEqual(policy.window_for([100.0, 101.0, 103.0]), 3.0)
+        self.assertEqual(policy.deadline([100.0, 101.0, 103.0]), 106.0)
+        self.assertEqual(policy.window_for([100.0, 100.1]), 1)
+        self.assertEqual(policy.window_for([100.0, 200.0]), 10)
+
+    def test_adaptive_window_respects_max_wait(self):
+        policy = AdaptiveWindowPolicy(1, 10, 4, max_wait=5)
+        self.assertEqual(policy.deadline([100.0, 104.0]), 105.0)
+
+    def test_policy_is_chosen_by_settings(self):
+        for name, cls in (('fixed', FixedWindowPolicy), ('max_wait', MaxWaitPolicy), ('adaptive', AdaptiveWindowPolicy)):
+            with self.subTest(name=name), override_settings(GROUPING_POLICY=name):
+                self.assertIs(type(get_grouping_policy()), cls)
+        with override_settings(GROUPING_POLICY='outra'):
+            with self.assertRaises(ValueError):
+                get_grouping_policy()
+
+
+class GroupingSchedulerTests(FakeRedisMixin, TestCase):
+    """Debounce pelo sorted set de prazos e disparo pelo loop periódico"""
+
+    def setUp(self):
+        super().setUp()
+        self.buffer = InboundBuffer(self.redis)
+        self.scheduler = GroupingScheduler(self.redis, self.buffer, FixedWindowPolicy(5, max_batch_size=10))
+        self.patch_object(tasks, 'inbound_buffer', self.buffer)
+        self.patch_object(tasks, 'grouping_scheduler', self.scheduler)
+        self.patch_object(tasks, 'publish_message', mock.Mock())
+        self.user = User.objects.create_user(username='scheduler-customer')
+        self.conversation_id = str(Conversation.objects.create(customer=self.user).id)
+
+    @contextlib.contextmanager
+    def at(self, now):
+        """Fixa o relógio do agendador e do agrupamento em now"""
+        with mock.patch('webhook_api.grouping.current_time', return_value=now), \
+                mock.patch.object(tasks, 'current_time', return_value=now):
+            yield
+
+    def receive(self, message_id, score):
+        self.buffer.add(self.conversation_id, {message_id: score})
+        self.scheduler.schedule([self.conversation_id])
+
+    def deadline(self):
+        return self.redis.zscore(self.scheduler.key, self.conversation_id)
+
+    def outbound(self):
+        return Message.objects.filter(conversation_id=self.conversation_id, direction=Message.OUTBOUND)
+
+    def test_new_message_extends_the_deadline(self):
+        self.receive('m1', 1000.0)
+        self.assertEqual(self.deadline(), 1005.0)
+        self.receive('m2', 1003.0)
+        self.assertEqual(self.deadline(), 1008.0)
+        self.assertEqual(self.redis.zcard(self.scheduler.key), 1)
+
+    def test_due_conversations_are_popped_once(self):
+        self.receive('m1', 1000.0)
+        self.assertEqual(self.scheduler.pop_due(now=1004.9), [])
+        self.assertEqual(self.scheduler.pop_due(now=1005.0), [self.conversation_id])
+        self.assertEqual(self.scheduler.pop_due(now=1006.0), [])
+
+    def test_full_buffer_is_due_immediately(self):
+        self.buffer.add(self.conversation_id, {f'm{i}': 1000.0 + i for i in range(10)})
+        with self.at(1001.0):
+            self.scheduler.schedule([self.conversation_id])
+        self.assertEqual(self.deadline(), 1001.0)
+
+    def test_fire_due_groupings_waits_for_the_extended_deadline(self):
+        self.receive('m1', 1000.0)
+        self.receive('m2', 1002.0)
+        with self.at(1006.0):
+            tasks.fire_due_groupings()
+        self.assertFalse(self.outbound().exists())
+
+        self.receive('m3', 1005.0)
+        # O prazo antigo (1007) já não dispara
+        with self.at(1008.0):
+            tasks.fire_due_groupings()
+        self.assertFalse(self.outbound().exists())
+
+        with self.at(1010.0):
+            tasks.fire_due_groupings()
+        [message] = self.outbound()
+        self.assertEqual(message.content, 'Mensagens recebidas:\nm1\nm2\nm3')
+        self.assertEqual(self.redis.zcard(InboundBuffer.key(self.conversation_id)), 0)
+        self.assertEqual(self.redis.zcard(self.scheduler.key), 0)
+        tasks.publish_message.assert_called_once()
+
+    def test_stale_deadline_is_rescheduled_to_the_buffer_deadline(self):
+        self.receive('m1', 1000.0)
+        # Mensagem bufferizada sem recalcular o prazo (agendamento ainda em 1005)
+        self.buffer.add(self.conversation_id, {'m2': 1004.0})
+        with self.at(1005.0):
+            tasks.fire_due_groupings()
+        self.assertFalse(self.outbound().exists())
+        self.assertEqual(self.deadline(), 1009.0)
+
+
+class ConversationStateCacheTests(FakeRedisMixin, TestCase):
+    """Falha na invalidação não deixa um estado antigo decidir escritas"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache = ConversationStateCache(
+            self.redis, ttl=3600, local_max_entries=100, local_ttl=60, negative_ttl=5
+        )
+        self.patch_object(conversation_state, '_cache', self.cache)
+        self.user = User.objects.create_user(username='state-customer')
+        self.conversation = Conversation.objects.create(customer=self.user)
+        self.conversation_id = str(self.conversation.id)
+        self.assertEqual(self.cache.get(self.conversation_id, local=False)['status'], Conversation.OPEN)
+        Conversation.objects.filter(id=self.conversation_id).update(status=Conversation.CLOSED)
+
+    @contextlib.contextmanager
+    def redis_down(self):
+        failing = mock.Mock(**{'pipeline.side_effect': redis.ConnectionError('fora')})
+        with mock.patch.object(self.cache, 'redis', failing), mock.patch.object(conversation_state.time, 'sleep'):
+            yield
+
+    def test_load_racing_an_invalidation_does_not_cache_stale_state(self):
+        self.cache.invalidate(self.conversation_id)
+        stale_rows = [(self.conversation.id, Conversation.OPEN, self.user.id, None)]
+
+        def read_before_close(**kwargs):
+            # A leitura do banco (ainda OPEN) terminou antes do fechamento, que invalida o cache
+            self.cache.invalidate(self.conversation_id)
+            return mock.Mock(values_list=mock.Mock(return_value=stale_rows))
+
+        with mock.patch.object(conversation_state.Conversation.objects, 'filter', side_effect=read_before_close):
+            self.assertEqual(self.cache.get(self.conversation_id, local=False)['status'], Conversation.OPEN)
+        self.assertIsNone(self.redis.get(self.cache.key(self.conversation_id)))
+        self.cache.local.clear()
+        self.assertEqual(self.cache.get(self.conversation_id, local=False)['status'], Conversation.CLOSED)
+
+    def test_failed_invalidation_falls_back_to_the_database(self):
+        with self.redis_down():
+            self.cache.invalidate(self.conversation_id)
+        self.assertEqual(self.cache.stats()['suspect'], 1)
+        self.assertEqual(self.cache.get(self.conversation_id)['status'], Conversation.CLOSED)
+        # A leitura do banco regravou o Redis: a conversa volta ao caminho normal
+        self.assertEqual(self.cache.stats()['suspect'], 0)
+        self.assertEqual(self.cache.get(self.conversation_id, local=False)['status'], Conversation.CLOSED)
+
+    async def test_suspect_ids_are_loaded_off_the_event_loop(self):
+        self.cache.async_redis = fakeredis.FakeAsyncRedis(server=self.fake_server)
+        with self.redis_down():
+            await sync_to_async(self.cache.invalidate)(self.conversation_id)
+        # O ORM síncrono dentro do loop levantaria SynchronousOnlyOperation
+        states = await self.cache.aget_many([self.conversation_id])
+        self.assertEqual(states[self.conversation_id]['status'], Conversation.CLOSED)
+        self.assertEqual(self.cache.stats()['suspect'], 0)
+
+    def test_message_to_closed_conversation_is_rejected_despite_stale_cache(self):
+        processor = WebhookBatchProcessor(None, dispatch_inline=True)
+        [result] = processor.process(
+            [{
+                'type': 'NEW_MESSAGE',
+                'timestamp': datetime.utcnow().isoformat(),
+                'data': {'id': str(uuid.uuid4()), 'content': 'oi', 'conversation_id': self.conversation_id}
+            }],
+            request_users=[self.user]
+        )
+        self.assertEqual(result['status_code'], 400)
+        self.assertFalse(Message.objects.filter(conversation=self.conversation).exists())
+
+
+class BlockingChannelLayerTests(TestCase):
+    """Acima de max_connections o channel layer espera uma conexão em vez de falhar"""
+
+    async def test_more_groups_than_connections(self):
+        layer = BlockingRedisChannelLayer(hosts=[{
+            'address': 'redis://localhost:6379/0',
+            'max_connections': 2,
+            'timeout': 5,
+            'connection_class': FakeConnection,
+            'server': fakeredis.FakeServer()
+        }])
+        groups = [f'grupo-{i}' for i in range(40)]
+        await asyncio.gather(*(layer.group_add(group, f'canal-{group}') for group in groups))
+        await asyncio.gather(*(layer.group_send(group, {'type': 'ping'}) for group in groups))
+        stats = _pool_stats(layer.connection(0).connection_pool)
+        self.assertEqual(stats['max_connections'], 2)
+        self.assertLessEqual(stats['created'], 2)
+        await layer.flush()
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class FanoutPublisherTests(FakeRedisMixin, TestCase):
+    """Publicação em lote no channel layer em memória"""
+
+    def setUp(self):
+        super().setUp()
+        self.publisher = FanoutPublisher(
+            max_batch=1000, max_delay=60, max_pending=1000, max_concurrency=2, max_attempts=2, retry_delay=0.001
+        )
+        log = EventLog(fakeredis.FakeAsyncRedis(server=self.fake_server), max_len=100, ttl=60)
+        self.patch_object(publisher, 'event_log', log)
+        self.layer = get_channel_layer()
+
+    def subscribe(self, group):
+        channel = connections.run(self.layer.new_channel())
+        connections.run(self.layer.group_add(group, channel))
+        return channel
+
+    def receive(self, channel):
+        return connections.run(asyncio.wait_for(self.layer.receive(channel), 1))
+
+    def test_events_are_batched_per_group_in_order(self):
+        channels = {group: self.subscribe(group) for group in ('conversa-a', 'conversa-b')}
+        for i in range(3):
+            self.publisher.publish('conversa-a', {'id': f'a{i}'})
+            self.publisher.publish('conversa-b', {'id': f'b{i}'})
+        self.publisher.flush()
+        for group, channel in channels.items():
+            event = self.receive(channel)
+            self.assertEqual(event['type'], 'new_messages')
+            self.assertEqual([m['id'] for m in event['messages']], [f'{group[-1]}{i}' for i in range(3)])
+            self.assertEqual([m['seq'] for m in event['messages']], [1, 2, 3])
+        self.assertEqual(self.publisher.stats()['group_sends'], 2)
+
+    def test_concurrent_group_sends_are_bounded(self):
+        in_flight = peak = 0
+        group_send = self.layer.group_send
+
+        async def slow_group_send(group, message):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            await group_send(group, message)
+
+        with mock.patch.object(self.layer, 'group_send', slow_group_send):
+            for i in range(10):
+                self.publisher.publish(f'conversa-{i}', {'id': str(i)})
+            self.publisher.flush()
+        self.assertEqual(peak, 2)
+        self.assertEqual(self.publisher.stats()['group_sends'], 10)
+
+    def test_inline_flush_cancels_the_timed_flush(self):
+        channel = self.subscribe('conversa-a')
+        self.publisher.max_pending = 3
+        self.publisher.max_delay = 0.05
+        with mock.patch.object(self.publisher, '_start_flush', wraps=self.publisher._start_flush) as start_flush:
+            for i in range(3):
+                self.publisher.publish('conversa-a', {'id': f'a{i}'})
+            # A terceira publicação descarregou em linha: nada fica agendado
+            connections.run(asyncio.sleep(0.15))
+        start_flush.assert_not_called()
+        event = self.receive(channel)
+        self.assertEqual([m['id'] for m in event['messages']], ['a0', 'a1', 'a2'])
+        self.assertEqual(self.publisher.stats()['flushes'], 1)
+
+    def test_failed_group_is_retried_without_renumbering(self):
+        channel = self.subscribe('conversa-a')
+        group_send = self.layer.group_send
+        outage = {'calls': 0}
+
+        async def flaky_group_send(group, message):
+            outage['calls'] += 1
+            if outage['calls'] <= 2:
+                raise ConnectionError('Too many connections')
+            await group_send(group, message)
+
+        # Adia a descarga automática de reenvio para a segunda descarga ser a explícita
+        self.publisher.retry_delay = 0.2
+        with mock.patch.object(self.layer, 'group_send', flaky_group_send):
+            self.publisher.publish('conversa-a', {'id': 'a0'})
+            self.publisher.flush()
+            # As duas tentativas falharam: o evento volta para a próxima descarga
+            self.assertEqual(self.publisher.stats()['requeued'], 1)
+            self.publisher.publish('conversa-a', {'id': 'a1'})
+            self.publisher.flush()
+        event = self.receive(channel)
+        self.assertEqual([(m['id'], m['seq']) for m in event['messages']], [('a0', 1), ('a1', 2)])
+        stats = self.publisher.stats()
+        self.assertEqual((stats['retries'], stats['dropped'], stats['pending']), (1, 0, 0))
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHANNEL_LAYER_MAX_CONNECTIONS=3
+)
+class MultiplexSubscriptionTests(TestCase):
+    """Falhas parciais de group_add/group_discard não deixam inscrições órfãs"""
+
+    def setUp(self):
+        self.layer = get_channel_layer()
+        self.conversation_ids = [str(uuid.uuid4()) for _ in range(10)]
+        patcher = mock.patch.object(consumers, 'denied_conversations', mock.AsyncMock(return_value=[]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(MultiplexConsumer.as_asgi(), '/ws/conversations/')
+        communicator.scope['user'] = User(username='mux-agent')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def members(self):
+        return {group: set(channels) for group, channels in self.layer.groups.items() if channels}
+
+    def failing(self, method, failing_group):
+        original = getattr(self.layer, method)
+
+        async def operation(group, channel):
+            if group == failing_group:
+                raise ConnectionError('Too many connections')
+            await original(group, channel)
+        operation.__name__ = method
+        return mock.patch.object(self.layer, method, operation)
+
+    async def test_partial_group_add_failure_rolls_back(self):
+        communicator = await self.connect()
+        with self.failing('group_add', consumers.conversation_group(self.conversation_ids[3])):
+            await communicator.send_json_to({'action': 'subscribe', 'conversation_ids': self.conversation_ids})
+            response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        self.assertEqual(response['conversation_ids'], [self.conversation_ids[3]])
+        self.assertEqual(self.members(), {})
+        await communicator.send_json_to({'action': 'subscribe', 'conversation_ids': self.conversation_ids})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'subscribed')
+        self.assertEqual(len(self.members()), 10)
+        await communicator.disconnect()
+        self.assertEqual(self.members(), {})
+
+    async def test_failed_discard_is_retried_on_disconnect(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'action': 'subscribe', 'conversation_ids': self.conversation_ids})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'subscribed')
+        group = consumers.conversation_group(self.conversation_ids[0])
+        with self.failing('group_discard', group):
+            await communicator.send_json_to({'action': 'unsubscribe', 'conversation_ids': self.conversation_ids})
+            self.assertEqual((await communicator.receive_json_from())['type'], 'unsubscribed')
+        self.assertEqual(list(self.members()), [group])
+        await communicator.disconnect()
+        self.assertEqual(self.members(), {})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class WebSocketHandshakeTests(FakeRedisMixin, TestCase):
+    """Handshake real: JWTWebSocketMiddleware + roteamento + ACL das conversas"""
+
+    def setUp(self):
+        super().setUp()
+        async_redis = fakeredis.FakeAsyncRedis(server=self.fake_server)
+        self.patch_object(token_cache, 'redis')
+        self.patch_object(token_cache, 'async_redis', async_redis)
+        self.patch_object(conversation_state, '_cache', ConversationStateCache(
+            self.redis, ttl=3600, local_max_entries=100, local_ttl=60, negative_ttl=5,
+            async_redis_client=async_redis
+        ))
+        self.patch_object(consumers, 'event_log', EventLog(async_redis, max_len=100, ttl=60))
+        self.patch_object(consumers, 'presence_store', PresenceStore(async_redis, ttl=60))
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        self.customer = User.objects.create_user(username='ws-customer')
+        self.stranger = User.objects.create_user(username='ws-stranger')
+        self.conversation = Conversation.objects.create(customer=self.customer)
+        self.application = JWTWebSocketMiddleware(URLRouter(routing.websocket_urlpatterns))
+
+    def token(self, user):
+        return AuthService.generate_token(user)
+
+    async def handshake(self, path=None, query='', **kwargs):
+        path = path or f'/ws/conversations/{self.conversation.id}/'
+        communicator = WebsocketCommunicator(self.application, path + query, **kwargs)
+        connected, subprotocol = await communicator.connect()
+        if connected:
+            await communicator.disconnect()
+        return connected, subprotocol
+
+    async def test_missing_token_is_refused(self):
+        self.assertFalse((await self.handshake())[0])
+        self.assertFalse((await self.handshake('/ws/conversations/'))[0])
+
+    async def test_bad_token_is_refused(self):
+        self.assertFalse((await self.handshake(query='?token=nao.e.jwt'))[0])
+        self.assertFalse((await self.handshake(headers=[(b'authorization', b'Bearer nao.e.jwt')]))[0])
+
+    async def test_foreign_token_is_refused(self):
+        token = self.token(self.stranger)
+        self.assertFalse((await self.handshake(query=f'?token={token}'))[0])
+        # O multiplex aceita o usuário, mas recusa a inscrição na conversa alheia
+        communicator = WebsocketCommunicator(self.application, f'/ws/conversations/?token={token}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'action': 'subscribe', 'conversation_ids': [str(self.conversation.id)]})
+        reply = await communicator.receive_json_from()
+        self.assertEqual(reply['conversation_ids'], [str(self.conversation.id)])
+        self.assertEqual(reply['error'], 'Acesso negado a estas conversas')
+        await communicator.disconnect()
+
+    async def test_owner_connects_with_each_token_source(self):
+        token = self.token(self.customer)
+        self.assertEqual(await self.handshake(headers=[(b'authorization', f'Bearer {token}'.encode())]), (True, None))
+        self.assertEqual(
+            await self.handshake(subprotocols=[JSON_SUBPROTOCOL, f'{AUTH_SUBPROTOCOL_PREFIX}{token}']),
+            (True, JSON_SUBPROTOCOL)
+        )
+        self.assertEqual(await self.handshake(query=f'?token={token}'), (True, None))
+
+    async def test_token_is_stripped_from_the_scope(self):
+        token = self.token(self.customer)
+        seen = {}
+
+        async def inner(scope, receive, send):
+            seen.update(scope)
+
+        await JWTWebSocketMiddleware(inner)({
+            'type': 'websocket', 'path': '/ws/conversations/',
+            'query_string': f'since=3&token={token}'.encode(),
+            'headers': [], 'subprotocols': [MSGPACK_SUBPROTOCOL, f'{AUTH_SUBPROTOCOL_PREFIX}{token}'],
+        }, None, None)
+        self.assertEqual(seen['user'].id, self.customer.id)
+        self.assertEqual(seen['query_string'], b'since=3')
+        self.assertEqual(seen['subprotocols'], [MSGPACK_SUBPROTOCOL])
+        self.assertNotIn(token, repr({key: value for key, value in seen.items() if key != 'jwt_auth'}))
+
+
+class ConversationConsumerTests(FakeRedisMixin, TestCase):
+    """Retomada com ?since= e presença/digitação best-effort no WebSocket de conversa"""
+
+    def setUp(self):
+        super().setUp()
+        async_redis = fakeredis.FakeAsyncRedis(server=self.fake_server)
+        self.log = EventLog(async_redis, max_len=100, ttl=60)
+        self.patch_object(consumers, 'event_log', self.log)
+        self.presence = PresenceStore(async_redis, ttl=60)
+        self.patch_object(consumers, 'presence_store', self.presence)
+        self.patch_object(consumers, 'denied_conversations', mock.AsyncMock(return_value=[]))
+        self.conversation_id = str(uuid.uuid4())
+        self.group = consumers.conversation_group(self.conversation_id)
+
+    async def connect(self, since=None, subprotocols=None):
+        application = URLRouter([
+            re_path(r'ws/conversations/(?P<conversation_id>[^/]+)/$', consumers.ConversationConsumer.as_asgi())
+        ])
+        query = '' if since is None else f'?since={since}'
+        communicator = WebsocketCommunicator(
+            application, f'/ws/conversations/{self.conversation_id}/{query}', subprotocols=subprotocols
+        )
+        communicator.scope['user'] = User(id=1, username='resume-customer')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_messages(self, communicator, count):
+        messages = []
+        while len(messages) < count:
+            frame = await communicator.receive_json_from()
+            if frame.get('type') == 'batch':
+                messages.extend(frame['messages'])
+            elif frame.get('type') != 'presence':
+                messages.append(frame)
+        return messages
+
+    async def test_msgpack_client_gets_binary_frames_with_the_json_payload(self):
+        json_client = await self.connect()
+        msgpack_client = await self.connect(subprotocols=[MSGPACK_SUBPROTOCOL])
+        # Frames de presença do connect: binários para o cliente msgpack
+        while not await msgpack_client.receive_nothing():
+            frame = await msgpack_client.receive_output()
+            self.assertIsNone(frame.get('text'))
+            self.assertEqual(unpack_event(frame['bytes'])['type'], 'presence')
+        while not await json_client.receive_nothing():
+            await json_client.receive_json_from()
+
+        message = {
+            'id': str(uuid.uuid4()), 'type': Message.INBOUND, 'content': 'olá',
+            'timestamp': format_timestamp(timezone.now()), 'author': 1, 'seq': 1
+        }
+        await get_channel_layer().group_send(self.group, {
+            'type': 'new_messages', 'group': self.group, 'messages': [message]
+        })
+        as_json = await json_client.receive_json_from()
+        frame = await msgpack_client.receive_output()
+        self.assertIsInstance(frame.get('bytes'), bytes)
+        self.assertIsNone(frame.get('text'))
+        self.assertEqual(unpack_event(frame['bytes']), as_json)
+        self.assertEqual(as_json['id'], message['id'])
+        await json_client.disconnect()
+        await msgpack_client.disconnect()
+
+    async def test_out_of_order_live_events_are_delivered(self):
+        await self.log.append({self.group: [{'id': f'm{i}'} for i in range(1, 5)]})
+        communicator = await self.connect(since=2)
+        replayed = await self.receive_messages(communicator, 2)
+        self.assertEqual([m['seq'] for m in replayed], [3, 4])
+        layer = get_channel_layer()
+        # Evento ao vivo já coberto pelo replay e dois eventos de publicadores diferentes fora de ordem
+        for seq in (4, 6, 5):
+            await layer.group_send(self.group, {
+                'type': 'new_messages', 'group': self.group, 'messages': [{'id': f'm{seq}', 'seq': seq}]
+            })
+        live = await self.receive_messages(communicator, 2)
+        self.assertEqual([m['seq'] for m in live], [6, 5])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_presence_and_typing_failures_keep_the_socket_open(self):
+        heartbeat = self.presence.heartbeat
+        calls = {'heartbeat': 0}
+
+        async def flaky_heartbeat(*args):
+            calls['heartbeat'] += 1
+            if calls['heartbeat'] <= 2:
+                raise redis.ConnectionError('Redis fora')
+            return await heartbeat(*args)
+
+        with self.settings(WS_PRESENCE_HEARTBEAT=0.01), \
+                mock.patch.object(self.presence, 'heartbeat', flaky_heartbeat), \
+                mock.patch.object(self.presence, 'leave', side_effect=redis.ConnectionError('Redis fora')), \
+                mock.patch.object(consumers.typing_coalescer, 'update', side_effect=redis.ConnectionError('Redis fora')):
+            communicator = await self.connect()
+            await communicator.send_json_to({'type': 'typing', 'typing': True})
+            # O registro inicial e o primeiro heartbeat falharam; o seguinte anuncia a entrada
+            frame = await communicator.receive_json_from(timeout=2)
+            self.assertEqual(frame, {'type': 'presence', 'users': [1]})
+            await get_channel_layer().group_send(self.group, {
+                'type': 'new_messages', 'group': self.group, 'messages': [{'id': 'm1', 'seq': 1}]
+            })
+            messages = await self.receive_messages(communicator, 1)
+            self.assertEqual(messages[0]['id'], 'm1')
+            await communicator.disconnect()
+        self.assertFalse(get_channel_layer().groups.get(self.group))
+
+
+class AuthenticatedRequestTests(FakeRedisMixin, TestCase):
+    """Autenticação única por requisição e rotas isentas por caminho exato"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(token_cache, 'redis')
+        self.user = User.objects.create_user(username='auth-customer')
+        self.conversation = Conversation.objects.create(customer=self.user)
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AuthService.generate_token(self.user)}'}
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+
+    def test_queries_per_authenticated_request(self):
+        url = reverse('conversation-header', args=[self.conversation.id])
+        # Token frio: usuário (uma vez, no middleware) e conversa
+        with self.assertNumQueries(2):
+            response = self.client.get(url, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        # Token em cache: só a conversa
+        with self.assertNumQueries(1):
+            response = self.client.get(url, **self.headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_only_exact_exempt_paths_skip_authentication(self):
+        response = self.client.get('/webhook/nova-rota/')
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(reverse('login'))
+        self.assertNotEqual(response.status_code, 401)
+
+
+class ConversationMessagesViewTests(FakeRedisMixin, TestCase):
+    """Histórico paginado por cursor e serializado pelo caminho rápido"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(token_cache, 'redis')
+        self.user = User.objects.create_user(username='history-customer', email='c@example.com')
+        self.conversation = Conversation.objects.create(customer=self.user)
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AuthService.generate_token(self.user)}'}
+        base = timezone.now() - timedelta(hours=1)
+        # Vários empates no timestamp: a ordem é desempatada pelo id
+        for offset in (0, 1, 1, 1, 2, 3, 3):
+            Message.objects.create(
+                conversation=self.conversation, direction=Message.INBOUND, content=f't+{offset}',
+                timestamp=base + timedelta(seconds=offset), author=self.user if offset % 2 else None
+            )
+        self.expected = list(
+            Message.objects.filter(conversation=self.conversation).order_by('timestamp', 'id').select_related('author')
+        )
+
+    def get(self, **params):
+        url = reverse('conversation-messages', args=[self.conversation.id])
+        response = self.client.get(url, params, **self.headers)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def ids(self, page):
+        return [message['id'] for message in page['results']]
+
+    def test_pages_backwards_and_forwards_without_gaps_or_repeats(self):
+        expected_ids = [str(message.id) for message in self.expected]
+        page = self.get(page_size=3)
+        self.assertIsNone(page['next'])
+        pages = [self.ids(page)]
+        while page['previous']:
+            page = self.get(page_size=3, before=page['previous'])
+            pages.insert(0, self.ids(page))
+        self.assertEqual([len(ids) for ids in pages], [1, 3, 3])
+        self.assertEqual(sum(pages, []), expected_ids)
+
+        # Do início (página mais antiga) para frente com after
+        collected = self.ids(page)
+        while page['next']:
+            page = self.get(page_size=3, after=page['next'])
+            collected += self.ids(page)
+        self.assertEqual(collected, expected_ids)
+        self.assertIsNotNone(page['previous'])
+
+    @override_settings(MESSAGES_MAX_PAGE_SIZE=4)
+    def test_page_size_is_capped(self):
+        page = self.get(page_size=100)
+        self.assertEqual(self.ids(page), [str(message.id) for message in self.expected[-4:]])
+
+    def test_output_matches_the_drf_serializer(self):
+        page = self.get()
+        drf = json.loads(JSONRenderer().render(MessageSerializer(self.expected, many=True).data))
+        self.assertEqual(page['results'], drf)
+
+    def test_invalid_cursor_is_rejected(self):
+        url = reverse('conversation-messages', args=[self.conversation.id])
+        response = self.client.get(url, {'before': 'nao-e-cursor'}, **self.headers)
+        self.assertEqual(response.status_code, 400)
+
+
+class UserConversationsViewTests(FakeRedisMixin, TestCase):
+    """Caixa de conversas com número constante de consultas e links de cursor"""
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(token_cache, 'redis')
+        self.user = User.objects.create_user(username='inbox-customer')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AuthService.generate_token(self.user)}'}
+        self.url = reverse('user-conversations')
+
+    def create_conversations(self, count):
+        base = timezone.now() - timedelta(hours=1)
+        conversations = []
+        for i in range(count):
+            conversation = Conversation.objects.create(customer=self.user)
+            for direction in (Message.INBOUND, Message.OUTBOUND):
+                Message.objects.create(
+                    conversation=conversation, direction=direction, content=direction,
+                    timestamp=base, author=self.user
+                )
+            Conversation.objects.filter(id=conversation.id).update(updated_at=base + timedelta(minutes=i))
+            conversations.append(str(conversation.id))
+        return conversations
+
+    def get(self, url=None, **params):
+        response = self.client.get(url or self.url, params, **self.headers)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def assert_constant_queries(self, count):
+        self.create_conversations(count)
+        # Aquece o cache de tokens: sobram a página de conversas e as mensagens
+        self.get()
+        with self.assertNumQueries(2):
+            page = self.get()
+        self.assertEqual(len(page['results']), count)
+        for conversation in page['results']:
+            self.assertEqual([message['type'] for message in conversation['messages']], [Message.INBOUND])
+
+    def test_queries_with_one_conversation(self):
+        self.assert_constant_queries(1)
+
+    def test_queries_with_several_conversations(self):
+        self.assert_constant_queries(6)
+
+    def test_next_and_previous_urls_walk_the_inbox(self):
+        newest_first = list(reversed(self.create_conversations(5)))
+        page = self.get(page_size=2)
+        self.assertIsNone(page['previous'])
+        seen = [conversation['id'] for conversation in page['results']]
+        while page['next']:
+            self.assertIn('before=', page['next'])
+            self.assertIn('page_size=2', page['next'])
+            page = self.get(page['next'])
+            self.assertIn('after=', page['previous'])
+            self.assertNotIn('before=', page['previous'])
+            seen += [conversation['id'] for conversation in page['results']]
+        self.assertEqual(seen, newest_first)
+
+        # 'previous' da última página volta para a anterior
+        back = self.get(page['previous'])
+        self.assertEqual([conversation['id'] for conversation in back['results']], newest_first[2:4])
+
+
+class FastSerializerTests(TestCase):
+    """O caminho rápido produz o mesmo JSON que os serializers DRF"""
+
+    def setUp(self):
+        self.customer = User.objects.create_user(username='fast-customer', email='c@example.com', first_name='Cli')
+        self.agent = User.objects.create_user(username='fast-agent', last_name='Agente')
+        self.conversation = Conversation.objects.create(customer=self.customer, agent=self.agent)
+        now = timezone.now()
+        Message.objects.create(
+            conversation=self.conversation, direction=Message.INBOUND, content='oi',
+            timestamp=now - timedelta(seconds=2), author=self.customer
+        )
+        Message.objects.create(
+            conversation=self.conversation, direction=Message.OUTBOUND, content='olá',
+            timestamp=now - timedelta(seconds=1), author=None
+        )
+
+    @staticmethod
+    def rendered(data):
+        return json.loads(JSONRenderer().render(data))
+
+    def test_conversation_matches_conversation_serializer(self):
+        conversation = Conversation.objects.select_related('customer', 'agent').get(id=self.conversation.id)
+        self.assertEqual(
+            self.rendered(serialize_conversation(conversation)),
+            self.rendered(ConversationSerializer(conversation).data)
+        )
+
+    def test_conversation_without_participants_matches(self):
+        conversation = Conversation.objects.create()
+        self.assertEqual(
+            self.rendered(serialize_conversation(conversation)),
+            self.rendered(ConversationSerializer(conversation).data)
+        )
+
+    def test_message_rows_match_message_serializer(self):
+        queryset = Message.objects.filter(conversation=self.conversation).order_by('timestamp')
+        self.assertEqual(
+            self.rendered(serialize_message_rows(queryset)),
+            self.rendered(MessageSerializer(queryset.select_related('author'), many=True).data)
+        )
+
+
+class TouchConversationTests(TestCase):
+    """O toque em updated_at é monotônico (GREATEST) e não reescreve outras colunas"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='touch-customer')
+        self.now = timezone.now()
+        self.first = Conversation.objects.create(customer=self.user)
+        self.second = Conversation.objects.create(customer=self.user)
+        Conversation.objects.filter(id__in=[self.first.id, self.second.id]).update(updated_at=self.now)
+
+    def updated_at(self, conversation):
+        return Conversation.objects.values_list('updated_at', flat=True).get(id=conversation.id)
+
+    def test_older_touch_does_not_move_updated_at_backwards(self):
+        touch_conversation(self.first.id, self.now - timedelta(minutes=5))
+        self.assertEqual(self.updated_at(self.first), self.now)
+        touch_conversation(self.first.id, self.now + timedelta(minutes=5))
+        self.assertEqual(self.updated_at(self.first), self.now + timedelta(minutes=5))
+
+    def test_batch_touch_applies_each_instant_monotonically(self):
+        touch_conversations({
+            self.first.id: self.now - timedelta(minutes=1),
+            self.second.id: self.now + timedelta(minutes=1),
+        })
+        self.assertEqual(self.updated_at(self.first), self.now)
+        self.assertEqual(self.updated_at(self.second), self.now + timedelta(minutes=1))
+
+    def test_coalesced_touches_keep_the_latest_instant(self):
+        with self.assertNumQueries(1), coalesce_touches():
+            touch_conversation(self.first.id, self.now + timedelta(minutes=2))
+            touch_conversation(self.first.id, self.now + timedelta(minutes=1))
+            touch_conversation(self.second.id, self.now - timedelta(minutes=1))
+        self.assertEqual(self.updated_at(self.first), self.now + timedelta(minutes=2))
+        self.assertEqual(self.updated_at(self.second), self.now)
+
+    def test_touch_does_not_overwrite_status(self):
+        stale = Conversation.objects.get(id=self.first.id)
+        Conversation.objects.filter(id=self.first.id).update(status=Conversation.CLOSED)
+        touch_conversation(stale.id, self.now + timedelta(minutes=1))
+        self.assertEqual(Conversation.objects.get(id=self.first.id).status, Conversation.CLOSED)
+
+
+class InsertIfConversationOpenTests(TestCase):
+    """Insert de um único comando: só em conversa aberta e sem duplicar"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='insert-customer')
+        self.conversation = Conversation.objects.create(customer=self.user)
+
+    def insert(self, message_id=None, conversation_id=None, content='oi'):
+        return Message.objects.insert_if_conversation_open(
+            message_id or uuid.uuid4(), conversation_id or self.conversation.id,
+            Message.INBOUND, content, timezone.now(), self.user.id
+        )
+
+    def test_inserts_into_open_conversation(self):
+        message_id = uuid.uuid4()
+        with self.assertNumQueries(1):
+            self.assertTrue(self.insert(message_id))
+        message = Message.objects.get(id=message_id)
+        self.assertEqual((message.conversation_id, message.author_id, message.content), (
+            self.conversation.id, self.user.id, 'oi'
+        ))
+        self.assertIsNotNone(message.created_at)
+
+    def test_duplicate_is_ignored(self):
+        message_id = uuid.uuid4()
+        self.assertTrue(self.insert(message_id))
+        self.assertFalse(self.insert(message_id, content='reenvio'))
+        self.assertEqual(Message.objects.get(id=message_id).content, 'oi')
+
+    def test_closed_conversation_is_refused(self):
+        Conversation.objects.filter(id=self.conversation.id).update(status=Conversation.CLOSED)
+        self.assertFalse(self.insert())
+        self.assertFalse(Message.objects.exists())
+
+    def test_missing_conversation_is_refused(self):
+        self.assertFalse(self.insert(conversation_id=uuid.uuid4()))
+        self.assertFalse(Message.objects.exists())
+
+
+class TokenCacheTests(FakeRedisMixin, TestCase):
+    """Expiração das entradas e revogação entre processos pela versão do usuário"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='token-customer')
+        self.token = AuthService.generate_token(self.user)
+        self.payload = AuthService.decode_payload(self.token)
+
+    def cache(self, ttl=300):
+        return TokenCache(max_entries=100, ttl=ttl, redis_client=self.redis)
+
+    def remember(self, cache, payload=None):
+        cache.set(self.token, payload or self.payload, self.user, cache.current_version(self.user.id))
+
+    def test_entry_never_outlives_the_token_exp(self):
+        now = time.time()
+        cache = self.cache(ttl=300)
+        self.remember(cache, dict(self.payload, exp=now + 10))
+        self.assertIsNotNone(cache.get(self.token))
+        with mock.patch('webhook_api.auth.time.time', return_value=now + 11):
+            self.assertIsNone(cache.get(self.token))
+
+    def test_entry_is_capped_by_the_cache_ttl(self):
+        now = time.time()
+        cache = self.cache(ttl=300)
+        self.remember(cache)
+        with mock.patch('webhook_api.auth.time.time', return_value=now + 299):
+            self.assertIsNotNone(cache.get(self.token))
+        with mock.patch('webhook_api.auth.time.time', return_value=now + 301):
+            self.assertIsNone(cache.get(self.token))
+
+    def test_invalidation_reaches_other_processes(self):
+        this_process, other_process = self.cache(), self.cache()
+        self.remember(this_process)
+        self.remember(other_process)
+        this_process.invalidate_user(self.user.id)
+        self.assertIsNone(this_process.get(self.token))
+        self.assertIsNone(other_process.get(self.token))
+        # Recarregado após a invalidação: volta a ser servido do cache
+        self.remember(other_process)
+        self.assertIsNotNone(other_process.get(self.token))
+
+    def test_load_racing_an_invalidation_is_not_served(self):
+        cache = self.cache()
+        version = cache.current_version(self.user.id)
+        cache.invalidate_user(self.user.id)
+        cache.set(self.token, self.payload, self.user, version)
+        self.assertIsNone(cache.get(self.token))
+
+    def test_user_change_revokes_cached_tokens_after_commit(self):
+        other_process = self.cache()
+        self.remember(other_process)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patch_object(token_cache, 'redis')
+            self.user.is_active = False
+            self.user.save()
+        self.assertIsNone(other_process.get(self.token))
+
+    async def test_async_lookup_checks_the_version(self):
+        async_redis = fakeredis.FakeAsyncRedis(server=self.fake_server)
+        cache = TokenCache(max_entries=100, ttl=300, redis_client=self.redis, async_redis_client=async_redis)
+        self.remember(cache)
+        self.assertIsNotNone(await cache.aget(self.token))
+        self.redis.incr(cache.version_key(self.user.id))
+        self.assertIsNone(await cache.aget(self.token))
+
+    def test_token_is_not_cached_while_redis_is_down(self):
+        broken = mock.Mock(get=mock.Mock(side_effect=redis.ConnectionError('fora')))
+        cache = TokenCache(max_entries=100, ttl=300, redis_client=broken)
+        self.remember(cache)
+        self.assertIsNone(cache.get(self.token))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Planos de consulta verificados apenas no PostgreSQL')
+class QueryPlanTests(TestCase):
+    """As consultas quentes usam os índices compostos e parcial da migração 0006"""
+
+    def setUp(self):
+        self.customer = User.objects.create_user(username='plan-customer')
+        self.agent = User.objects.create_user(username='plan-agent', is_staff=True)
+        self.conversation = Conversation.objects.create(customer=self.customer, agent=self.agent)
+        # Em tabelas quase vazias o planner prefere seq scan; aqui interessa
+        # apenas se existe um índice utilizável para cada consulta
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, plan)
+
+    def test_customer_conversations_page(self):
+        queryset = Conversation.objects.filter(customer_id=self.customer.id).order_by('-updated_at', '-id')[:21]
+        self.assertUsesIndex(queryset, 'conv_customer_updated_idx')
+
+    def test_agent_inbox(self):
+        queryset = Conversation.objects.filter(
+            agent_id=self.agent.id, status=Conversation.OPEN
+        ).order_by('-updated_at')[:50]
+        self.assertUsesIndex(queryset, 'conv_agent_status_idx')
+
+    def test_open_conversations(self):
+        queryset = Conversation.objects.filter(status=Conversation.OPEN).order_by('updated_at')[:50]
+        self.assertUsesIndex(queryset, 'conv_open_updated_idx')
+
+    def test_conversation_messages_page(self):
+        queryset = Message.objects.filter(conversation_id=self.conversation.id).order_by('-timestamp', '-id')[:51]
+        self.assertUsesIndex(queryset, 'message_conv_ts_id_idx')
+
+
+class IdempotencyStoreTests(FakeRedisMixin, TestCase):
+    """Reivindicação da chave de idempotência antes do processamento"""
+
+    def make_store(self, claim_wait=0.2):
+        return IdempotencyStore(
+            fakeredis.FakeRedis(server=self.fake_server), ttl=60, local_max_entries=100,
+            claim_wait=claim_wait, poll_interval=0.01
+        )
+
+    def test_concurrent_retry_does_not_claim_again(self):
+        original, retry = self.make_store(), self.make_store()
+        token, cached = original.begin('k')
+        self.assertIsNotNone(token)
+        self.assertIsNone(cached)
+        # A original ainda processa: o reenvio espera e desiste
+        self.assertEqual(retry.begin('k'), (None, None))
+        original.store('k', {'status': 'ok'}, 201)
+        self.assertEqual(retry.begin('k'), (None, ({'status': 'ok'}, 201)))
+
+    def test_retry_waits_for_the_original_response(self):
+        original, retry = self.make_store(), self.make_store(claim_wait=5)
+        original.begin('k')
+        timer = threading.Timer(0.1, original.store, args=('k', {'status': 'ok'}, 201))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(retry.begin('k'), (None, ({'status': 'ok'}, 201)))
+
+    def test_released_claim_can_be_processed_again(self):
+        original, retry = self.make_store(), self.make_store()
+        token, _ = original.begin('k')
+        original.release('k', token)
+        retry_token, cached = retry.begin('k')
+        self.assertIsNotNone(retry_token)
+        self.assertIsNone(cached)
+        # Liberar com um token antigo não remove a reivindicação atual
+        original.release('k', token)
+        self.assertEqual(self.make_store().begin('k'), (None, None))
+
+
+class AsyncWebhookViewTests(FakeRedisMixin, TestCase):
+    """/webhook/async/ com autenticação, estado e fila no event loop"""
+
+    def setUp(self):
+        super().setUp()
+        self.async_redis = fakeredis.FakeAsyncRedis(server=self.fake_server)
+        self.patch_object(token_cache, 'redis')
+        self.patch_object(token_cache, 'async_redis', self.async_redis)
+        self.patch_object(conversation_state, '_cache', ConversationStateCache(
+            self.redis, ttl=3600, local_max_entries=100, local_ttl=60, negative_ttl=5,
+            async_redis_client=self.async_redis
+        ))
+        store = IdempotencyStore(self.redis, ttl=60, local_max_entries=100, async_redis_client=self.async_redis)
+        patcher = mock.patch('webhook_api.views.get_idempotency_store', return_value=store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.patch_object(tasks, 'get_async_redis', mock.Mock(return_value=self.async_redis))
+        self.patch_object(tasks, 'drain_inbound_queue', mock.Mock())
+        self.user = User.objects.create_user(username='async-customer')
+        self.conversation = Conversation.objects.create(customer=self.user)
+        self.headers = {'Authorization': f'Bearer {AuthService.generate_token(self.user)}'}
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+
+    async def post(self, event_type, headers=None, **data):
+        payload = {'type': event_type, 'timestamp': datetime.utcnow().isoformat(), 'data': data}
+        return await self.async_client.post(
+            reverse('webhook-async'), payload, content_type='application/json',
+            headers=self.headers if headers is None else headers
+        )
+
+    async def test_new_conversation_is_created_for_the_token_user(self):
+        conversation_id = str(uuid.uuid4())
+        response = await self.post('NEW_CONVERSATION', id=conversation_id)
+        self.assertEqual(response.status_code, 201, response.content)
+        conversation = await Conversation.objects.aget(id=conversation_id)
+        self.assertEqual(conversation.customer_id, self.user.id)
+
+        replay = await self.post('NEW_CONVERSATION', id=conversation_id)
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay['Idempotent-Replay'], 'true')
+
+    async def test_new_message_is_queued(self):
+        message_id = str(uuid.uuid4())
+        response = await self.post(
+            'NEW_MESSAGE', id=message_id, content='oi', conversation_id=str(self.conversation.id)
+        )
+        self.assertEqual(response.status_code, 202, response.content)
+        [raw] = self.redis.lrange(tasks.INBOUND_QUEUE_KEY, 0, -1)
+        item = json.loads(raw)
+        self.assertEqual((item['data']['id'], item['user_id']), (message_id, self.user.id))
+        tasks.drain_inbound_queue.apply_async.assert_called_once()
+
+    async def test_message_to_closed_conversation_is_rejected(self):
+        await Conversation.objects.filter(id=self.conversation.id).aupdate(status=Conversation.CLOSED)
+        response = await self.post(
+            'NEW_MESSAGE', id=str(uuid.uuid4()), content='oi', conversation_id=str(self.conversation.id)
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['conversation_status'], Conversation.CLOSED)
+        self.assertEqual(self.redis.llen(tasks.INBOUND_QUEUE_KEY), 0)
+
+    async def test_message_to_unknown_conversation_is_rejected(self):
+        response = await self.post('NEW_MESSAGE', id=str(uuid.uuid4()), content='oi', conversation_id=str(uuid.uuid4()))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Conversa não encontrada')
+
+    async def test_missing_or_invalid_token_is_401(self):
+        response = await self.post('NEW_CONVERSATION', headers={}, id=str(uuid.uuid4()))
+        self.assertEqual(response.status_code, 401)
+        response = await self.post('NEW_CONVERSATION', headers={'Authorization': 'Bearer x.y.z'}, id=str(uuid.uuid4()))
+        self.assertEqual(response.status_code, 401)
+
+
+class WebhookIdempotencyTests(FakeRedisMixin, TestCase):
+    """Respostas do /webhook/ para reenvios concorrentes e concluídos"""
+
+    def setUp(self):
+        super().setUp()
+        self.store = IdempotencyStore(self.redis, ttl=60, local_max_entries=100, claim_wait=0.05, poll_interval=0.01)
+        patcher = mock.patch('webhook_api.views.get_idempotency_store', return_value=self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username='idempotency-customer')
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AuthService.generate_token(self.user)}'}
+        self.payload = {
+            'type': 'NEW_CONVERSATION',
+            'timestamp': datetime.utcnow().isoformat(),
+            'data': {'id': str(uuid.uuid4())}
+        }
+
+    def post(self):
+        return self.client.post(reverse('webhook'), self.payload, content_type='application/json', **self.headers)
+
+    def test_retry_while_original_is_processing_gets_409(self):
+        key = f"{self.store.prefix}{self.user.id}:NEW_CONVERSATION:{self.payload['data']['id']}"
+        self.store.begin(key)
+        response = self.post()
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Conversation.objects.filter(id=self.payload['data']['id']).exists())
+
+    def test_completed_request_is_replayed(self):
+        first = self.post()
+        self.assertEqual(first.status_code, 201)
+        self.store.local.clear()
+        second = self.post()
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second['Idempotent-Replay'], 'true')
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(Conversation.objects.filter(id=self.payload['data']['id']).count(), 1)
+
+    def test_failed_request_releases_the_claim(self):
+        Conversation.objects.create(id=self.payload['data']['id'], customer=self.user)
+        self.assertEqual(self.post().status_code, 400)
+        self.assertEqual(self.redis.keys(f'{self.store.prefix}*'), [])
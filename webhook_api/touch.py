@@ -0,0 +1,65 @@
+import threading
+from contextlib import contextmanager
+from django.db import models
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .models import Conversation
+
+_local = threading.local()
+
+
+def touch_conversation(conversation_id, when=None):
+    """Marca atividade na conversa (atualiza apenas updated_at)"""
+    touch_conversations({conversation_id: when or timezone.now()})
+
+
+def touch_conversations(touches):
+    """
+    Atualiza apenas updated_at das conversas em {conversation_id: instante},
+    em um único UPDATE e de forma monotônica (GREATEST), sem reescrever as
+    demais colunas nem sobrescrever status/agent gravados em paralelo.
+
+    Dentro de coalesce_touches() os toques são acumulados e gravados uma
+    única vez ao final do bloco.
+    """
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        for conversation_id, when in touches.items():
+            key = str(conversation_id)
+            if key not in pending or when > pending[key]:
+                pending[key] = when
+        return
+    if not touches:
+        return
+
+    instants = set(touches.values())
+    if len(instants) == 1:
+        new_value = Value(instants.pop(), output_field=models.DateTimeField())
+    else:
+        new_value = Case(
+            *[When(id=conversation_id, then=Value(when)) for conversation_id, when in touches.items()],
+            output_field=models.DateTimeField()
+        )
+    Conversation.objects.filter(id__in=list(touches)).update(
+        updated_at=Greatest(F('updated_at'), new_value)
+    )
+
+
+@contextmanager
+def coalesce_touches():
+    """
+    Agrupa os toques feitos no bloco em um único UPDATE por lote, mantendo
+    o maior instante de cada conversa. Blocos aninhados são gravados pelo
+    bloco mais externo.
+    """
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+    _local.pending = {}
+    try:
+        yield
+        touches = _local.pending
+    finally:
+        _local.pending = None
+    touch_conversations(touches)
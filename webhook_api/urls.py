@@ -1,13 +1,20 @@
 from django.urls import path
 from .views import (
-    WebhookView, ConversationDetailView, 
+    WebhookView, AsyncWebhookView, WebhookBatchView, WebhookStreamView, WebhookStatsView, ConversationDetailView,
+    ConversationHeaderView, ConversationMessagesView,
     RegisterView, LoginView, UserConversationsView,
     AssignAgentView
 )
 
 urlpatterns = [
     path('webhook/', WebhookView.as_view(), name='webhook'),
+    path('webhook/async/', AsyncWebhookView.as_view(), name='webhook-async'),
+    path('webhook/batch/', WebhookBatchView.as_view(), name='webhook-batch'),
+    path('webhook/stream/', WebhookStreamView.as_view(), name='webhook-stream'),
+    path('webhook-stats/', WebhookStatsView.as_view(), name='webhook-stats'),
     path('conversations/<uuid:conversation_id>/', ConversationDetailView.as_view(), name='conversation-detail'),
+    path('conversations/<uuid:conversation_id>/header/', ConversationHeaderView.as_view(), name='conversation-header'),
+    path('conversations/<uuid:conversation_id>/messages/', ConversationMessagesView.as_view(), name='conversation-messages'),
     path('register/', RegisterView.as_view(), name='register'),
     path('login/', LoginView.as_view(), name='login'),
     path('my-conversations/', UserConversationsView.as_view(), name='user-conversations'),
@@ -1,18 +1,42 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.exceptions import ValidationError
+from rest_framework.exceptions import ValidationError, AuthenticationFailed
 from django.shortcuts import get_object_or_404
+from django.http import JsonResponse
+from django.views import View
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 from .models import Conversation, Message, UserProfile
-from .serializers import ConversationSerializer, UserSerializer, UserProfileSerializer
+from .serializers import (
+    ConversationHeaderSerializer,
+    UserSerializer, UserProfileSerializer
+)
+from .pagination import KeysetPaginator
+from .idempotency import get_idempotency_store
+from .conversation_state import get_conversation_state_cache, invalidate_conversation_state
+from .connections import connections
+from .publisher import fanout_publisher
+from .presence import typing_coalescer
+from .send_queue import send_queue_stats
+from .fast_serializers import (
+    MESSAGE_COLUMNS, serialize_conversation, serialize_message_values, serialize_messages_by_conversation
+)
 from .event_handlers import EventFactory
+from .batch import WebhookBatchProcessor, NdjsonIngestor
 import json
+import logging
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
 from rest_framework.authtoken.models import Token
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from uuid import uuid4
-from .auth import AuthService, JWTAuthentication
+from .auth import AuthService, JWTAuthentication, can_access_conversation
+
+logger = logging.getLogger(__name__)
 
 class ErrorHandlerMixin:
     """Mixin para tratamento centralizado de erros"""
@@ -31,6 +55,12 @@ class ErrorHandlerMixin:
         return Response(error_data, status=status.HTTP_400_BAD_REQUEST)
 
 
+# Resposta a um reenvio que chega enquanto a requisição original ainda processa
+IDEMPOTENCY_IN_FLIGHT_ERROR = {
+    'error': 'Requisição com a mesma chave de idempotência ainda em processamento'
+}
+
+
 class WebhookView(ErrorHandlerMixin, APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
@@ -49,100 +79,256 @@ class WebhookView(ErrorHandlerMixin, APIView):
             else:
                 payload = request.data
             
-            # Validar se o payload é um dicionário
-            if not isinstance(payload, dict):
-                raise ValidationError({
-                    'error': 'Payload deve ser um objeto JSON',
-                    'received_type': type(payload).__name__
-                })
+            # Validar envelope (type, timestamp, data)
+            event_type, timestamp, data = EventFactory.validate_payload(payload)
             
-            # Validar campos obrigatórios no payload
-            required_fields = ['type', 'timestamp', 'data']
-            missing_fields = []
-            for field in required_fields:
-                if field not in payload:
-                    missing_fields.append(field)
+            # Reenvios dentro da janela de idempotência recebem a resposta original;
+            # a chave é reivindicada antes de processar, então um reenvio
+            # concorrente espera a resposta em vez de processar de novo
+            idempotency = get_idempotency_store()
+            idempotency_key = idempotency.key_for(request, event_type, data)
+            idempotency_token = None
+            if idempotency_key:
+                idempotency_token, cached = idempotency.begin(idempotency_key)
+                if cached is not None:
+                    body, status_code = cached
+                    return Response(body, status=status_code, headers={'Idempotent-Replay': 'true'})
+                if idempotency_token is None:
+                    return Response(IDEMPOTENCY_IN_FLIGHT_ERROR, status=status.HTTP_409_CONFLICT,
+                                    headers={'Retry-After': '1'})
             
-            if missing_fields:
-                raise ValidationError({
-                    'error': 'Campos obrigatórios ausentes',
-                    'missing_fields': missing_fields,
-                    'received_fields': list(payload.keys())
-                })
-            
-            # Validar tipos dos campos principais
-            type_errors = []
-            if not isinstance(payload.get('type'), str):
-                type_errors.append({
-                    'field': 'type',
-                    'expected_type': 'string',
-                    'received_type': type(payload.get('type')).__name__,
-                    'value': payload.get('type')
-                })
-            
-            if not isinstance(payload.get('timestamp'), str):
-                type_errors.append({
-                    'field': 'timestamp',
-                    'expected_type': 'string',
-                    'received_type': type(payload.get('timestamp')).__name__,
-                    'value': payload.get('timestamp')
-                })
+            try:
+                response = self.handle_event(request, event_type, timestamp, data)
+            except Exception:
+                if idempotency_token:
+                    idempotency.release(idempotency_key, idempotency_token)
+                raise
+            if idempotency_token:
+                if status.is_success(response.status_code):
+                    idempotency.store(idempotency_key, response.data, response.status_code)
+                else:
+                    idempotency.release(idempotency_key, idempotency_token)
+            return response
             
-            if not isinstance(payload.get('data'), dict):
-                type_errors.append({
-                    'field': 'data',
-                    'expected_type': 'object',
-                    'received_type': type(payload.get('data')).__name__,
-                    'value': payload.get('data')
-                })
+        except json.JSONDecodeError:
+            raise ValidationError({
+                'error': 'Payload JSON inválido',
+                'received': request.body.decode('utf-8')[:100] + '...' if len(request.body) > 100 else request.body.decode('utf-8')
+            })
+    
+    def handle_event(self, request, event_type, timestamp, data):
+        """Processa um evento já validado e retorna a resposta"""
+        # Caso seja NEW_CONVERSATION, force o customer_id
+        if event_type == 'NEW_CONVERSATION':
+            data['customer_id'] = request.token_user_id
+
+        # Processar eventos de NEW_MESSAGE de forma assíncrona, apenas se conversa aberta
+        if event_type == 'NEW_MESSAGE':
+            # Verificar se a conversa existe (estado em cache, sem ida ao banco)
+            conversation_id = data.get('conversation_id')
+            convo = get_conversation_state_cache().get(conversation_id)
+            if convo is None:
+                return Response({
+                    'error': 'Conversa não encontrada',
+                    'conversation_id': conversation_id
+                }, status=status.HTTP_400_BAD_REQUEST)
+            # Somente aceitar se estiver aberta
+            if convo['status'] == Conversation.CLOSED:
+                return Response({
+                    'error': 'Não é possível adicionar mensagens a uma conversa fechada',
+                    'conversation_id': conversation_id,
+                    'conversation_status': convo['status']
+                }, status=status.HTTP_400_BAD_REQUEST)
+            # Enfileirar para persistência em micro-lotes pelo Celery
+            from .tasks import enqueue_inbound_message
+            enqueue_inbound_message(data, timestamp, request.user.id)
+            return Response({'status': 'Mensagem recebida'}, status=status.HTTP_202_ACCEPTED)
+        # Para outros eventos, processar sincronicamente
+        event = EventFactory.create_event(event_type, data, timestamp, request.user)
+        response_data, status_code = event.process()
+        return Response(response_data, status=status_code)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncWebhookView(View):
+    """
+    Versão nativamente assíncrona do /webhook/ para rodar sob ASGI (daphne).
+
+    Autenticação, idempotência, estado da conversa e enfileiramento de
+    NEW_MESSAGE usam os caches em memória e o cliente redis.asyncio no
+    próprio event loop, sem ocupar uma thread por requisição. NEW_CONVERSATION
+    e CLOSE_CONVERSATION, que gravam no banco, rodam via sync_to_async.
+    """
+    http_method_names = ['post']
+
+    async def post(self, request):
+        try:
+            user = await self.authenticate(request)
+            if user is None:
+                return JsonResponse({'error': 'Token não fornecido.'}, status=status.HTTP_401_UNAUTHORIZED)
+            request.user = user
             
-            if type_errors:
+            # Validar JSON e envelope (type, timestamp, data)
+            try:
+                payload = json.loads(request.body)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                body = request.body.decode('utf-8', errors='replace')
                 raise ValidationError({
-                    'error': 'Tipos de dados inválidos',
-                    'type_errors': type_errors
+                    'error': 'Payload JSON inválido',
+                    'received': body[:100] + '...' if len(body) > 100 else body
                 })
+            event_type, timestamp, data = EventFactory.validate_payload(payload)
             
-            # Extrair dados do payload
-            event_type = payload['type']
-            timestamp = payload['timestamp']
-            data = payload['data']
+            # Reenvios dentro da janela de idempotência recebem a resposta original
+            idempotency = get_idempotency_store()
+            idempotency_key = idempotency.key_for(request, event_type, data)
+            idempotency_token = None
+            if idempotency_key:
+                idempotency_token, cached = await idempotency.abegin(idempotency_key)
+                if cached is not None:
+                    body, status_code = cached
+                    response = JsonResponse(body, status=status_code, safe=False)
+                    response['Idempotent-Replay'] = 'true'
+                    return response
+                if idempotency_token is None:
+                    response = JsonResponse(IDEMPOTENCY_IN_FLIGHT_ERROR, status=status.HTTP_409_CONFLICT)
+                    response['Retry-After'] = '1'
+                    return response
             
-            # Caso seja NEW_CONVERSATION, force o customer_id
-            if payload['type'] == 'NEW_CONVERSATION':
-                data['customer_id'] = request.token_user_id
-
-            # Processar eventos de NEW_MESSAGE de forma assíncrona, apenas se conversa aberta
-            if event_type == 'NEW_MESSAGE':
-                # Verificar se a conversa existe
-                conversation_id = data.get('conversation_id')
-                try:
-                    convo = Conversation.objects.get(id=conversation_id)
-                except Conversation.DoesNotExist:
-                    return Response({
-                        'error': 'Conversa não encontrada',
-                        'conversation_id': conversation_id
-                    }, status=status.HTTP_400_BAD_REQUEST)
-                # Somente aceitar se estiver aberta
-                if convo.status == Conversation.CLOSED:
-                    return Response({
-                        'error': 'Não é possível adicionar mensagens a uma conversa fechada',
-                        'conversation_id': conversation_id,
-                        'conversation_status': convo.status
-                    }, status=status.HTTP_400_BAD_REQUEST)
-                # Agendar processamento com Celery
-                from .tasks import handle_new_message_event
-                handle_new_message_event.delay(data, timestamp, request.user.id)
-                return Response({'status': 'Mensagem recebida'}, status=status.HTTP_202_ACCEPTED)
-            # Para outros eventos, processar sincronicamente
-            event = EventFactory.create_event(event_type, data, timestamp, request.user)
-            response_data, status_code = event.process()
-            return Response(response_data, status=status_code)
+            try:
+                body, status_code = await self.handle_event(user, event_type, timestamp, data)
+            except Exception:
+                if idempotency_token:
+                    await idempotency.arelease(idempotency_key, idempotency_token)
+                raise
+            if idempotency_token:
+                if status.is_success(status_code):
+                    await idempotency.astore(idempotency_key, body, status_code)
+                else:
+                    await idempotency.arelease(idempotency_key, idempotency_token)
+            return JsonResponse(body, status=status_code, safe=False)
             
-        except json.JSONDecodeError:
+        except AuthenticationFailed as exc:
+            return JsonResponse({'error': str(exc.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+        except ValidationError as exc:
+            return JsonResponse(exc.detail, status=status.HTTP_400_BAD_REQUEST, safe=False)
+        except Exception as exc:
+            # Mesmo formato do ErrorHandlerMixin
+            return JsonResponse({
+                'error': str(exc),
+                'error_type': exc.__class__.__name__
+            }, status=status.HTTP_400_BAD_REQUEST)
+    
+    @staticmethod
+    async def authenticate(request):
+        """Retorna o usuário do 'Authorization: Bearer <token>' ou None se ausente"""
+        auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+        if not auth or auth[0].lower() != JWTAuthentication.keyword.lower():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Header Authorization inválido.')
+        user, _ = await AuthService.aauthenticate_token(auth[1])
+        return user
+    
+    async def handle_event(self, user, event_type, timestamp, data):
+        """Processa um evento já validado e retorna (body, status)"""
+        if event_type == 'NEW_MESSAGE':
+            conversation_id = data.get('conversation_id')
+            convo = await get_conversation_state_cache().aget(conversation_id)
+            if convo is None:
+                return {
+                    'error': 'Conversa não encontrada',
+                    'conversation_id': conversation_id
+                }, status.HTTP_400_BAD_REQUEST
+            if convo['status'] == Conversation.CLOSED:
+                return {
+                    'error': 'Não é possível adicionar mensagens a uma conversa fechada',
+                    'conversation_id': conversation_id,
+                    'conversation_status': convo['status']
+                }, status.HTTP_400_BAD_REQUEST
+            from .tasks import aenqueue_inbound_message
+            await aenqueue_inbound_message(data, timestamp, user.id)
+            return {'status': 'Mensagem recebida'}, status.HTTP_202_ACCEPTED
+        
+        if event_type == 'NEW_CONVERSATION':
+            data['customer_id'] = user.id
+        event = EventFactory.create_event(event_type, data, timestamp, user)
+        return await sync_to_async(event.process)()
+
+
+class WebhookBatchView(ErrorHandlerMixin, APIView):
+    """
+    Recebe um lote de eventos (array JSON ou objeto com 'events') em uma
+    única requisição e retorna o status individual de cada evento.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        payload = request.data
+        if isinstance(payload, dict) and 'events' in payload:
+            payload = payload['events']
+        
+        if not isinstance(payload, list):
             raise ValidationError({
-                'error': 'Payload JSON inválido',
-                'received': request.body.decode('utf-8')[:100] + '...' if len(request.body) > 100 else request.body.decode('utf-8')
+                'error': 'Payload deve ser uma lista de eventos',
+                'received_type': type(payload).__name__
             })
+        
+        max_events = settings.WEBHOOK_BATCH_MAX_EVENTS
+        if len(payload) > max_events:
+            raise ValidationError({
+                'error': 'Lote excede o número máximo de eventos',
+                'received': len(payload),
+                'max_events': max_events
+            })
+        
+        results = WebhookBatchProcessor(request.user).process(payload)
+        failed = sum(1 for r in results if r['status_code'] >= 400)
+        return Response({
+            'processed': len(results),
+            'succeeded': len(results) - failed,
+            'failed': failed,
+            'results': results
+        }, status=status.HTTP_207_MULTI_STATUS if failed else status.HTTP_200_OK)
+
+
+class WebhookStreamView(ErrorHandlerMixin, APIView):
+    """
+    Recebe eventos em NDJSON (application/x-ndjson), lendo o corpo linha a
+    linha e persistindo em blocos de tamanho fixo.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request):
+        chunk_size = settings.WEBHOOK_STREAM_CHUNK_SIZE
+        ingestor = NdjsonIngestor(
+            request.user,
+            chunk_size=chunk_size,
+            on_progress=lambda summary: logger.info(
+                'NDJSON: %(lines)s linhas, %(failed)s erros, %(events_per_second)s eventos/s', summary
+            )
+        )
+        # Itera sobre a requisição Django (readline) sem carregar o corpo inteiro
+        summary = ingestor.ingest(request._request)
+        return Response(summary, status=status.HTTP_207_MULTI_STATUS if summary['failed'] else status.HTTP_200_OK)
+
+
+class WebhookStatsView(APIView):
+    """Métricas de ingestão do processo atual (apenas staff)"""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response({
+            'idempotency': get_idempotency_store().stats(),
+            'conversation_state': get_conversation_state_cache().stats(),
+            'connections': connections.stats(),
+            'fanout': fanout_publisher.stats(),
+            'websocket': send_queue_stats(),
+            'typing': typing_coalescer.stats()
+        })
 
 
 class RegisterView(APIView):
@@ -223,43 +409,120 @@ class LoginView(APIView):
             'token': token
         })
 
-class UserConversationsView(APIView):
+class UserConversationsView(ErrorHandlerMixin, APIView):
+    """
+    Conversas do usuário (mais recentes primeiro), paginadas por cursor
+    sobre (updated_at, id), incluindo apenas mensagens INBOUND. O número de
+    consultas é constante: conversas e mensagens são carregadas em uma
+    consulta cada e serializadas pelo caminho rápido.
+    """
     authentication_classes = [JWTAuthentication]
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         user = request.user
-        # Serializar cada conversa incluindo apenas mensagens INBOUND
-        conversations = Conversation.objects.filter(customer_id=user.id)
-        user_data = UserSerializer(user).data
-        result = []
-        for conv in conversations:
-            conv_data = ConversationSerializer(conv).data
-            # Filtrar mensagens INBOUND
-            inbound_msgs = [m for m in conv_data.get('messages', []) if m.get('type') == 'INBOUND']
-            # Preencher author com base no token (usuário autenticado)
-            for msg in inbound_msgs:
-                msg['author'] = user_data
-            conv_data['messages'] = inbound_msgs
-            result.append(conv_data)
-        return Response(result)
+        conversations = Conversation.objects.filter(customer_id=user.id).select_related('customer', 'agent')
+        
+        paginator = KeysetPaginator(
+            settings.CONVERSATIONS_PAGE_SIZE, settings.CONVERSATIONS_MAX_PAGE_SIZE, time_field='updated_at'
+        )
+        page, older_cursor, newer_cursor = paginator.paginate(conversations, request.query_params)
+        page = list(reversed(page))
+        
+        # Mensagens INBOUND da página em uma única consulta, com author
+        # preenchido com base no token (usuário autenticado)
+        messages = serialize_messages_by_conversation(
+            Message.objects.filter(conversation_id__in=[conv.id for conv in page], direction=Message.INBOUND)
+                .order_by('timestamp'),
+            author=UserSerializer(user).data
+        )
+        result = [serialize_conversation(conv, messages.get(conv.id, [])) for conv in page]
+        
+        url = request.build_absolute_uri()
+        return Response({
+            'results': result,
+            'next': self._page_url(url, 'before', older_cursor),
+            'previous': self._page_url(url, 'after', newer_cursor)
+        })
+    
+    @staticmethod
+    def _page_url(url, param, cursor):
+        if cursor is None:
+            return None
+        url = remove_query_param(url, 'before' if param == 'after' else 'after')
+        return replace_query_param(url, param, cursor)
 
-class ConversationDetailView(ErrorHandlerMixin, APIView):
-    authentication_classes = [JWTAuthentication]
-    permission_classes = [IsAuthenticated]
+class ConversationAccessMixin:
+    """Carrega a conversa e verifica se o usuário tem acesso a ela"""
     
-    def get(self, request, conversation_id):
-        conversation = get_object_or_404(Conversation, id=conversation_id)
+    def get_conversation(self, request, conversation_id, queryset=None):
+        """Retorna (conversation, None) ou (None, resposta 403)"""
+        queryset = Conversation.objects.all() if queryset is None else queryset
+        conversation = get_object_or_404(queryset, id=conversation_id)
         
         # Verificar se o usuário tem acesso à conversa
-        user = request.user
-        if not (conversation.customer == user or conversation.agent == user or user.is_staff):
-            return Response({
+        if not can_access_conversation(request.user, conversation.customer_id, conversation.agent_id):
+            return None, Response({
                 'error': 'Acesso negado a esta conversa'
             }, status=status.HTTP_403_FORBIDDEN)
+        return conversation, None
+
+
+class ConversationDetailView(ConversationAccessMixin, ErrorHandlerMixin, APIView):
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, conversation_id):
+        conversation, denied = self.get_conversation(
+            request, conversation_id,
+            Conversation.objects.select_related('customer', 'agent')
+        )
+        if denied:
+            return denied
         
-        serializer = ConversationSerializer(conversation)
-        return Response(serializer.data)
+        return Response(serialize_conversation(conversation))
+
+
+class ConversationHeaderView(ConversationAccessMixin, ErrorHandlerMixin, APIView):
+    """Cabeçalho leve da conversa (status e participantes, sem mensagens)"""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, conversation_id):
+        conversation, denied = self.get_conversation(
+            request, conversation_id,
+            Conversation.objects.select_related('customer', 'agent')
+        )
+        if denied:
+            return denied
+        return Response(ConversationHeaderSerializer(conversation).data)
+
+
+class ConversationMessagesView(ConversationAccessMixin, ErrorHandlerMixin, APIView):
+    """
+    Histórico de mensagens paginado por cursor sobre (timestamp, id).
+    Parâmetros: before/after (cursor) e page_size.
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, conversation_id):
+        conversation, denied = self.get_conversation(request, conversation_id)
+        if denied:
+            return denied
+        
+        paginator = KeysetPaginator(settings.MESSAGES_PAGE_SIZE, settings.MESSAGES_MAX_PAGE_SIZE)
+        # Página como dicts (autor no mesmo JOIN), serializada pelo caminho rápido
+        messages, previous_cursor, next_cursor = paginator.paginate(
+            Message.objects.filter(conversation=conversation).values(*MESSAGE_COLUMNS),
+            request.query_params
+        )
+        return Response({
+            'conversation_id': str(conversation.id),
+            'results': serialize_message_values(messages),
+            'previous': previous_cursor,
+            'next': next_cursor
+        })
 
 class AssignAgentView(APIView):
     authentication_classes = [JWTAuthentication]
@@ -293,7 +556,8 @@ class AssignAgentView(APIView):
             
             # Atribuir agente à conversa
             conversation.agent = agent
-            conversation.save()
+            conversation.save(update_fields=['agent', 'updated_at'])
+            invalidate_conversation_state(conversation.id)
             
             return Response({
                 'status': 'Agente atribuído com sucesso',
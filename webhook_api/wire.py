@@ -0,0 +1,101 @@
+"""
+Formato binário (msgpack) opcional para os eventos WebSocket.
+
+O cliente o solicita no handshake pelo subprotocolo MSGPACK_SUBPROTOCOL
+(new WebSocket(url, ['realmate.msgpack.v1'])); sem ele a conexão segue em
+JSON. Os frames binários têm a mesma estrutura dos frames JSON, com
+duas diferenças de representação pelo nome do campo:
+
+- UUID_FIELDS ('id', 'conversation_id', 'conversation_ids'): bin de 16
+  bytes (UUID.bytes, big-endian); ids que não são UUID seguem como string;
+- TIMESTAMP_FIELDS ('timestamp'): inteiro com os microssegundos desde a
+  época Unix (UTC); datas sem fuso são tratadas como UTC.
+
+Os publicadores formatam as datas dos eventos com format_timestamp (ISO
+8601 em UTC com 'Z', como a API REST), e unpack_event, o decodificador de
+referência, devolve exatamente o mesmo dict que o frame JSON traria.
+"""
+import uuid
+from datetime import datetime, timedelta, timezone
+import msgpack
+
+MSGPACK_SUBPROTOCOL = 'realmate.msgpack.v1'
+# Subprotocolo explícito para JSON (o padrão): permite ao navegador enviar
+# junto o subprotocolo do token ('bearer.<jwt>') e ter um deles aceito
+JSON_SUBPROTOCOL = 'realmate.json.v1'
+
+UUID_FIELDS = frozenset(('id', 'conversation_id', 'conversation_ids'))
+TIMESTAMP_FIELDS = frozenset(('timestamp',))
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def format_timestamp(value):
+    """Data de um evento no formato canônico dos frames (ISO 8601, UTC, sufixo 'Z')"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def pack_event(content):
+    """Codifica um frame (dict/list) em msgpack com UUIDs e datas compactos"""
+    return msgpack.packb(_compact(content), use_bin_type=True)
+
+
+def unpack_event(data):
+    """Decodifica um frame msgpack para a mesma estrutura do frame JSON"""
+    return _expand(msgpack.unpackb(data, raw=False))
+
+
+def _compact(value, field=None):
+    if isinstance(value, dict):
+        return {key: _compact(item, key) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_compact(item, field) for item in value]
+    if field in UUID_FIELDS:
+        return _uuid_bytes(value)
+    if field in TIMESTAMP_FIELDS:
+        return _epoch_us(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def _expand(value, field=None):
+    if isinstance(value, dict):
+        return {key: _expand(item, key) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand(item, field) for item in value]
+    if field in UUID_FIELDS and isinstance(value, bytes) and len(value) == 16:
+        hex_value = value.hex()
+        return f"{hex_value[:8]}-{hex_value[8:12]}-{hex_value[12:16]}-{hex_value[16:20]}-{hex_value[20:]}"
+    if field in TIMESTAMP_FIELDS and isinstance(value, int):
+        # Aritmética inteira: sem o arredondamento de fromtimestamp(float)
+        return format_timestamp(EPOCH + timedelta(microseconds=value))
+    return value
+
+
+def _uuid_bytes(value):
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    if isinstance(value, str) and len(value) == 36:
+        # Mais barato que uuid.UUID(value).bytes no caminho quente
+        try:
+            return bytes.fromhex(value.replace('-', ''))
+        except ValueError:
+            pass
+    return value
+
+
+def _epoch_us(value):
+    if isinstance(value, str):
+        try:
+            # fromisoformat só aceita o sufixo 'Z' a partir do Python 3.11
+            value = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (value - EPOCH) // timedelta(microseconds=1)
+    return value